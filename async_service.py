@@ -0,0 +1,325 @@
+"""
+asyncio version of main.py.
+
+Runs the same pipeline on a single event loop instead of paho's network
+thread plus worker threads: MQTT through asyncio-mqtt, PSQL reads through
+asyncpg, device timeouts as loop.call_at handles and inference in an
+executor. Readings are still stored through psql_func.writer.
+
+Requires Python >= 3.7 and the asyncio-mqtt and asyncpg packages pinned in
+requirements.txt. asyncio-mqtt 0.x runs on paho-mqtt 1.x, like the rest of
+the services.
+"""
+
+# Basic libraries
+import asyncio
+import itertools
+import json
+import logging
+import re
+from concurrent.futures import ThreadPoolExecutor
+from warnings import filterwarnings
+
+# Scientific Libraries
+import numpy as np
+
+# MQTT and PSQL Libraries
+import asyncio_mqtt
+import asyncpg
+
+# Custom modules
+import calculations, psql_func, settings
+from catalog import Catalog, build_snapshot
+from device_state import DeviceTable
+from log_setup import configure_logging
+from model_registry import BRIX, CLF, ModelRegistry
+filterwarnings("ignore")
+
+# Logging
+configure_logging(settings.MQTT_LOG_FILE,
+                  settings.LOG_LEVEL,
+                  settings.LOG_MAX_BYTES,
+                  settings.LOG_BACKUP_COUNT,
+                  settings.LOG_QUEUE_SIZE,
+                  settings.LOG_SAMPLE_RATES)
+
+
+def asyncpg_query(query):
+    """Converts psycopg2 %s placeholders to asyncpg's $1, $2, ..."""
+    counter = itertools.count(1)
+    return re.sub('%s', lambda match: f"${next(counter)}", query)
+
+
+DEVICE_DATA_QUERY = asyncpg_query(psql_func.DEVICE_DATA_QUERY)
+FRUIT_VARIETY_CATALOG_QUERY = asyncpg_query(psql_func.FRUIT_VARIETY_CATALOG_QUERY)
+CHANGE_FRUIT_VARIETY_QUERY = asyncpg_query(psql_func.CHANGE_FRUIT_VARIETY_QUERY)
+
+
+def predict(model_registry, fruit, variety, normalized_values):
+    """Predicts brix and status of one reading, runs in the executor
+
+    Returns:
+        tuple: predicted brix, status (% good), r, g and b
+    """
+    brix_model = model_registry.get(BRIX, fruit, variety)
+    clf_model = model_registry.get(CLF, fruit, variety)
+
+    # Predict brix
+    try:
+        predicted_brix = calculations.predict_brix(normalized_values, brix_model)
+    except Exception as e:
+        logging.error("Brix prediction failed - %s" % e)
+        predicted_brix = -1
+
+    # Classify status
+    values = np.append(normalized_values, predicted_brix, axis=None)
+    fruit_status, r, g, b = calculations.predict_status(values, clf_model)
+    return predicted_brix, fruit_status, r, g, b
+
+
+class AsyncIngestionService:
+    """Subscribes to SUB_TOPIC and handles readings, MR and MC messages.
+
+    Work for one device runs in the order its messages arrived, work for
+    different devices runs concurrently. At most ASYNC_MAX_PENDING jobs are
+    in flight, after which reading from the broker pauses.
+    """
+
+    def __init__(self):
+        self.devices = DeviceTable(settings.MESSAGE_LIMIT, len(settings.DEVICE_READINGS))
+        self.catalog = Catalog(settings.CATALOG_REFRESH_INTERVAL, settings.CATALOG_CHANNEL)
+        self.model_registry = ModelRegistry(settings.MODEL_DIR,
+                                            {BRIX: settings.DEFAULT_BRIX_MODEL, CLF: settings.DEFAULT_CLF_MODEL},
+                                            settings.MODEL_MEMORY_BUDGET,
+                                            settings.MODEL_FAST_PATH,
+                                            settings.MODEL_SHARED_DIR,
+                                            settings.MODEL_ARTIFACTS,
+                                            settings.MODEL_RECHECK_INTERVAL)
+        self.executor = ThreadPoolExecutor(settings.ASYNC_EXECUTOR_WORKERS)
+
+        self.loop = None
+        self.client = None
+        self.db = None
+        self._timeouts = {}
+        self._tails = {}
+        self._pending = None
+
+    async def run(self):
+        self.loop = asyncio.get_running_loop()
+        self._pending = asyncio.Semaphore(settings.ASYNC_MAX_PENDING)
+
+        self.db = await asyncpg.create_pool(database=settings.PSQL_DB_NAME,
+                                            user=settings.PSQL_USER,
+                                            password=settings.PSQL_PASSWORD,
+                                            host=settings.PSQL_HOST,
+                                            port=settings.PSQL_PORT,
+                                            min_size=settings.PSQL_POOL_MIN,
+                                            max_size=settings.PSQL_POOL_MAX,
+                                            init=self._init_connection)
+        refresh = None
+        try:
+            # Stops here rather than dropping every batch
+            await self.loop.run_in_executor(self.executor, psql_func.check_schema)
+            await self.load_catalog()
+            varieties = self.catalog.varieties if settings.MODEL_PRELOAD else []
+            await self.loop.run_in_executor(self.executor, self.model_registry.preload, varieties,
+                                       settings.MODEL_PRELOAD_WORKERS)
+            logging.info("Models loaded")
+
+            refresh = asyncio.ensure_future(self._refresh_catalog())
+            async with asyncio_mqtt.Client(settings.BROKER_ADDRESS, settings.MQTT_PORT,
+                                           username=settings.MQTT_USER,
+                                           password=settings.MQTT_PASSWORD) as client:
+                self.client = client
+                async with client.messages() as messages:
+                    await client.subscribe(settings.SUB_TOPIC)
+                    logging.info(f"Connected via asyncio service ({settings.MQTT_USER})")
+
+                    async for message in messages:
+                        await self.on_message(message.payload)
+        finally:
+            if refresh is not None:
+                refresh.cancel()
+            await self.loop.run_in_executor(self.executor, psql_func.writer.close)
+            await self.db.close()
+            self.executor.shutdown()
+
+    async def _init_connection(self, conn):
+        # white_standard is returned as a dict, like psycopg2 does
+        for type_name in ('json', 'jsonb'):
+            await conn.set_type_codec(type_name, encoder=json.dumps, decoder=json.loads,
+                                      schema='pg_catalog')
+
+    async def load_catalog(self):
+        rows = await self.db.fetch(FRUIT_VARIETY_CATALOG_QUERY)
+        self.catalog.snapshot = build_snapshot([tuple(row) for row in rows])
+        logging.info("Catalog loaded with %d varieties" % len(self.catalog.varieties))
+
+    async def _refresh_catalog(self):
+        # Reload on NOTIFY and every CATALOG_REFRESH_INTERVAL seconds
+        changed = asyncio.Event()
+        listen_conn = await asyncpg.connect(database=settings.PSQL_DB_NAME,
+                                            user=settings.PSQL_USER,
+                                            password=settings.PSQL_PASSWORD,
+                                            host=settings.PSQL_HOST,
+                                            port=settings.PSQL_PORT)
+        await listen_conn.add_listener(settings.CATALOG_CHANNEL, lambda *args: changed.set())
+        try:
+            while True:
+                try:
+                    await asyncio.wait_for(changed.wait(), settings.CATALOG_REFRESH_INTERVAL)
+                except asyncio.TimeoutError:
+                    pass
+                changed.clear()
+                try:
+                    await self.load_catalog()
+                except Exception as e:
+                    logging.error("Catalog refresh failed - %s" % e)
+        finally:
+            await listen_conn.close()
+
+    async def get_device_settings(self, mac_id):
+        """Same as psql_func.get_device_settings, sharing its cache"""
+        device_settings = psql_func.device_cache.get(mac_id)
+        if device_settings is None:
+            row = await self.db.fetchrow(DEVICE_DATA_QUERY, mac_id)
+            if row is None:
+                raise IndexError("No device with MAC ID %s" % mac_id)
+            device_settings = psql_func.device_settings_from_row(tuple(row))
+            psql_func.device_cache.set(mac_id, device_settings)
+        return device_settings
+
+    """
+    ORDERED JOBS
+    """
+
+    async def submit(self, mac_id, job):
+        """Runs a coroutine after all earlier jobs of the same device"""
+        await self._pending.acquire()
+        previous = self._tails.get(mac_id)
+        task = self.loop.create_task(self._run_after(previous, job))
+        self._tails[mac_id] = task
+        task.add_done_callback(lambda done: self._job_done(mac_id, done))
+
+    async def _run_after(self, previous, job):
+        if previous is not None:
+            await asyncio.wait([previous])
+        try:
+            await job
+        except Exception as e:
+            logging.error("Job failed - %s" % e)
+
+    def _job_done(self, mac_id, task):
+        self._pending.release()
+        if self._tails.get(mac_id) is task:
+            del self._tails[mac_id]
+
+    """
+    HANDLERS
+    """
+
+    async def on_message(self, payload):
+        if not payload.startswith(calculations.BINARY_MAGIC):
+            kind = payload.split(b",", 1)[0].strip()
+
+            if kind in (b'MR', b'MC'):
+                fields = payload.decode("utf-8").split(",")
+                mac_id = fields[-1].strip()
+
+                if kind == b'MR':
+                    await self.submit(mac_id, self.handle_boot(mac_id))
+                else:
+                    await self.submit(mac_id, self.handle_model_change(mac_id, fields[-2].strip()))
+                return
+
+        try:
+            if payload.startswith(calculations.BINARY_MAGIC):
+                mac_id, values = calculations.parse_binary_reading(payload)
+            else:
+                mac_id, values = calculations.parse_reading(payload)
+        except Exception as e:
+            logging.error("Failed to parse message %r - %s" % (payload, e))
+            return
+
+        device_name = f"/{mac_id}"
+        device = self.devices.get(device_name, mac_id)
+        self.devices.add(device, values)
+
+        # Start the timeout on the first message of a batch
+        if device_name not in self._timeouts:
+            self._timeouts[device_name] = self.loop.call_at(
+                self.loop.time() + settings.TIMEOUT, self.on_timeout, device_name)
+            logging.info(f"Timeout initiated for {device_name}")
+
+        if device.message_count == self.devices.message_limit:
+            raw_mean_values = self.devices.mean(device)
+            self.reset_variables(device_name)
+            await self.submit(mac_id, self.process_batch(mac_id, device_name, raw_mean_values))
+
+    def reset_variables(self, device_name):
+        self.devices.reset(device_name)
+        handle = self._timeouts.pop(device_name, None)
+        if handle is not None:
+            handle.cancel()
+        logging.info('Reset value for %s' % device_name)
+
+    def on_timeout(self, device_name):
+        self._timeouts.pop(device_name, None)
+        logging.error(f"Timeout exceeded for {device_name}")
+        self.reset_variables(device_name)
+
+    async def handle_boot(self, mac_id):
+        try:
+            device_settings = await self.get_device_settings(mac_id)
+            message_to_client = self.catalog.boot_response(device_settings.fruit, device_settings.variety)
+            await self.client.publish(f"/{mac_id}", message_to_client)
+        except Exception as e:
+            logging.error("BOOT FAIL !!! - %s" % e)
+
+    async def handle_model_change(self, mac_id, model_name):
+        try:
+            fruit_vid = self.catalog.model_id(model_name)
+            await self.db.execute(CHANGE_FRUIT_VARIETY_QUERY, fruit_vid, mac_id)
+            psql_func.device_cache.invalidate(mac_id)
+            await self.client.publish(f"/{mac_id}", f"@{fruit_vid}")
+        except Exception as e:
+            logging.error("Failed to change the model - %s" % e)
+
+    async def process_batch(self, mac_id, pub_topic, raw_mean_values):
+        # Get device settings from PSQL Table
+        try:
+            fruit, variety, white_standard, batch_number, vendor_code, device_id, warehouse_id = \
+                await self.get_device_settings(mac_id)
+        except Exception as e:
+            logging.critical("Failed to load device data - %s" % e)
+
+            fruit, variety = 'default', 'default'
+            batch_number, vendor_code = 'default', 'default'
+            white_standard = settings.DEFAULT_WHITE_STANDARD
+            device_id = warehouse_id = None
+
+        normalized_values = calculations.normalize_mean(raw_mean_values, white_standard)
+
+        # CPU-bound, keep it off the event loop
+        predicted_brix, fruit_status, r, g, b = await self.loop.run_in_executor(
+            self.executor, predict, self.model_registry, fruit, variety, normalized_values)
+
+        # Send feedback
+        message_to_client = f"${round(float(predicted_brix), 2)},{fruit_status}% GOOD,{r},{g},{b};"
+        await self.client.publish(pub_topic, message_to_client)
+
+        # Update to DB
+        if device_id is None:
+            logging.error("Failed to store data in PSQL: unknown device %s" % mac_id)
+            return
+        try:
+            # Blocks up to WRITE_BUFFER_TIMEOUT while the write buffer is full
+            await self.loop.run_in_executor(
+                self.executor, psql_func.write_data, warehouse_id, device_id, raw_mean_values,
+                predicted_brix, fruit_status, fruit, variety, batch_number, vendor_code, mac_id)
+        except Exception as e:
+            logging.error("Failed to store data in PSQL: %s" % e)
+
+
+if __name__ == "__main__":
+    asyncio.run(AsyncIngestionService().run())
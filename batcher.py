@@ -0,0 +1,142 @@
+# Basic libraries
+import logging
+import threading
+import time
+from collections import namedtuple
+from concurrent.futures import Future
+
+# Scientific Libraries
+import numpy as np
+
+# Custom modules
+import calculations
+from metrics import STAGE_SECONDS
+
+# Result of one reading
+Prediction = namedtuple('Prediction', ['brix', 'brix_level', 'status', 'r', 'g', 'b'])
+
+
+class InferenceBatcher:
+    """Runs brix and status predictions for many devices at once.
+
+    Readings submitted within `window` seconds of each other are grouped by
+    model key, usually (fruit, variety), and each group is predicted with a
+    single model.predict and model.predict_proba call. A batch is started
+    early once `max_batch` readings are pending.
+
+    Args:
+        window (float): Seconds to wait for more readings after the first one
+        max_batch (int): Number of pending readings that starts a batch at once
+    """
+
+    def __init__(self, window, max_batch):
+        self.window = window
+        self.max_batch = max_batch
+        self._pending = []
+        self._cond = threading.Condition()
+        self._stopped = False
+        self._thread = threading.Thread(target=self._run, name="inference-batcher", daemon=True)
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        with self._cond:
+            self._stopped = True
+            self._cond.notify()
+        self._thread.join()
+
+    def submit(self, key, normalized_values, brix_model, clf_model):
+        """Queues one reading for prediction
+
+        Args:
+            key (hashable): Readings with the same key share the same models
+            normalized_values (np.ndarray): Normalized wavelength values
+            brix_model (regression model): Model to predict brix values
+            clf_model (linear model): Model to classify fruits
+
+        Returns:
+            Future: Resolves to a Prediction
+        """
+        future = Future()
+        with self._cond:
+            self._pending.append((key, normalized_values, brix_model, clf_model, future))
+            if len(self._pending) == 1 or len(self._pending) >= self.max_batch:
+                self._cond.notify()
+        return future
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._pending and not self._stopped:
+                    self._cond.wait()
+                if not self._pending:
+                    return
+
+                # Give other devices a short window to join the batch
+                deadline = time.monotonic() + self.window
+                while len(self._pending) < self.max_batch and not self._stopped:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    self._cond.wait(remaining)
+
+                batch, self._pending = self._pending, []
+
+            groups = {}
+            for item in batch:
+                groups.setdefault(item[0], []).append(item)
+
+            for items in groups.values():
+                try:
+                    self._predict_group(items)
+                except Exception as e:
+                    logging.error("Batched prediction failed - %s" % e)
+                    # Only the readings that fail on their own get the error
+                    for item in items:
+                        if item[4].done():
+                            continue
+                        try:
+                            self._predict_group([item])
+                        except Exception as e:
+                            item[4].set_exception(e)
+
+    def _predict_group(self, items):
+        _, _, brix_model, clf_model, _ = items[0]
+        values = np.vstack([item[1] for item in items])
+
+        for item, prediction in zip(items, predict_values(values, brix_model, clf_model)):
+            item[4].set_result(prediction)
+
+
+def predict_values(values, brix_model, clf_model):
+    """Predicts brix and status of several readings with the same models
+
+    Args:
+        values (np.ndarray): Normalized wavelength values, one row per reading
+        brix_model (regression model): Model to predict brix values
+        clf_model (linear model): Model to classify fruits
+
+    Returns:
+        list: One Prediction per row
+    """
+    # Predict brix
+    start = time.perf_counter()
+    try:
+        predicted_brix = calculations.predict_brix_batch(values, brix_model)
+    except Exception as e:
+        logging.error("Brix prediction failed - %s" % e)
+        predicted_brix = np.full(len(values), -1.0)
+
+    brix_levels = calculations.calculate_brix_levels(predicted_brix)
+    brix_done = time.perf_counter()
+    STAGE_SECONDS.observe(brix_done - start, 'predict_brix')
+
+    # Classify status
+    values = np.column_stack([values, predicted_brix])
+    fruit_status, r, g, b = calculations.predict_status_batch(values, clf_model)
+    STAGE_SECONDS.observe(time.perf_counter() - brix_done, 'predict_status')
+
+    return [Prediction(float(predicted_brix[i]), str(brix_levels[i]),
+                       int(fruit_status[i]), int(r[i]), int(g[i]), int(b[i]))
+            for i in range(len(values))]
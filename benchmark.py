@@ -0,0 +1,441 @@
+"""
+End-to-end benchmark of main.py.
+
+Simulates a fleet of devices sending readings, MR and MC messages through
+an in-process broker to main.on_message, with psql_func running on an
+SQLite database instead of PSQL. Reports throughput, feedback latency,
+CPU and memory, and can compare the results with an earlier run:
+
+    python benchmark.py --devices 500 --rate 2 --duration 30 --json before.json
+    python benchmark.py --devices 500 --rate 2 --duration 30 --baseline before.json
+
+The models are loaded from --models, which needs default_brix.sav and
+default_clf.sav. CPU time of inference processes (INFERENCE_PROCESSES) is
+not included.
+"""
+
+# Basic libraries
+import argparse
+import itertools
+import json
+import queue
+import random
+import re
+import resource
+import sqlite3
+import sys
+import threading
+import time
+from collections import deque, namedtuple
+from contextlib import contextmanager
+
+# Scientific Libraries
+import numpy as np
+
+# Custom modules
+import calculations, settings
+
+# The part of a paho message used by the handlers
+FakeMessage = namedtuple('FakeMessage', ['topic', 'payload'])
+
+# (fruit_variety_id, fruit, variety) of the benchmark catalog
+CATALOG = [(1, 'APPLE', 'FUJI'), (2, 'APPLE', 'RED DELICIOUS'), (3, 'MANGO', 'ALPHONSO')]
+
+
+"""
+FAKE BROKER
+"""
+
+
+class Subscriber:
+    """Receives the messages of its topics on its own thread, like a paho client"""
+
+    def __init__(self, callback, name):
+        self.callback = callback
+        self._queue = queue.Queue()
+        self._thread = threading.Thread(target=self._run, name=name, daemon=True)
+        self._thread.start()
+
+    def deliver(self, message):
+        self._queue.put(message)
+
+    def stop(self):
+        self._queue.put(None)
+        self._thread.join()
+
+    def _run(self):
+        while True:
+            message = self._queue.get()
+            if message is None:
+                return
+            self.callback(message)
+
+
+class FakeBroker:
+    """In-process broker with exact topic matching"""
+
+    def __init__(self):
+        self._subscribers = {}
+
+    def subscribe(self, topic, subscriber):
+        self._subscribers.setdefault(topic, []).append(subscriber)
+
+    def publish(self, topic, payload):
+        if isinstance(payload, str):
+            payload = payload.encode("utf-8")
+        for subscriber in self._subscribers.get(topic, ()):
+            subscriber.deliver(FakeMessage(topic, payload))
+
+
+class FakeClient:
+    """Stands in for the service's paho client"""
+
+    def __init__(self, broker):
+        self.broker = broker
+
+    def publish(self, topic, payload):
+        self.broker.publish(topic, payload)
+
+
+"""
+SQLITE BACKED PSQL_FUNC
+"""
+
+
+class SqliteCursor:
+    """Runs psql_func's queries on SQLite, translating the few PSQL-only bits"""
+
+    def __init__(self, cursor):
+        self._cursor = cursor
+
+    def execute(self, query, params=()):
+        query = re.sub(r'::\w+|public\.', '', query).replace('%s', '?')
+        # psycopg2 adapts one-element tuples, SQLite binds plain values only
+        params = [value[0] if isinstance(value, tuple) else value for value in params]
+        self._cursor.execute(query, params)
+
+    def fetchall(self):
+        # JSON columns come back as text
+        return [tuple(json.loads(value) if isinstance(value, str) and value.startswith('{') else value
+                      for value in row)
+                for row in self._cursor.fetchall()]
+
+
+class SqlitePool:
+    """Single SQLite connection with the interface of db_pool.ConnectionPool"""
+
+    def __init__(self, path, devices, columns):
+        self.rows_inserted = 0
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._lock = threading.Lock()
+        self._create(devices, columns)
+
+    def _create(self, devices, columns):
+        columns = ', '.join(columns)
+        self._conn.executescript(f"""
+            CREATE TABLE fruits (id INTEGER PRIMARY KEY, fruit_name TEXT);
+            CREATE TABLE fruit_varieties (id INTEGER PRIMARY KEY, fruit_id INTEGER, variety TEXT);
+            CREATE TABLE device_types (id INTEGER PRIMARY KEY, white_standard TEXT);
+            CREATE TABLE warehouses (id INTEGER PRIMARY KEY, warehouse_id TEXT);
+            CREATE TABLE devices (mac_id TEXT PRIMARY KEY, device_id TEXT, warehouse_id INTEGER,
+                                  device_type_id INTEGER, fruit_variety_id INTEGER,
+                                  batch_number TEXT, vendor_code TEXT);
+            CREATE TABLE warehouse_data ({columns});
+            CREATE TABLE device_last_reading (warehouse_id TEXT, device_id TEXT, row_id INTEGER,
+                                              PRIMARY KEY (warehouse_id, device_id));
+        """)
+
+        fruits = {fruit: index for index, fruit in enumerate(sorted({fruit for _, fruit, _ in CATALOG}), 1)}
+        self._conn.executemany("INSERT INTO fruits VALUES (?, ?)", [(i, fruit) for fruit, i in fruits.items()])
+        self._conn.executemany("INSERT INTO fruit_varieties VALUES (?, ?, ?)",
+                               [(i, fruits[fruit], variety) for i, fruit, variety in CATALOG])
+        white_standard = json.dumps({wavelength: 1000 for wavelength in settings.DEVICE_READINGS[:6]})
+        self._conn.execute("INSERT INTO device_types VALUES (1, ?)", (white_standard,))
+        self._conn.execute("INSERT INTO warehouses VALUES (1, 'BENCH')")
+        self._conn.executemany("INSERT INTO devices VALUES (?, ?, 1, 1, ?, 'B1', 'V1')",
+                               [(mac_id, f"DEV_{i}", CATALOG[i % len(CATALOG)][0])
+                                for i, mac_id in enumerate(devices)])
+        self._conn.commit()
+
+    def open(self):
+        pass
+
+    @contextmanager
+    def cursor(self):
+        with self._lock:
+            try:
+                yield SqliteCursor(self._conn.cursor())
+                self._conn.commit()
+            except Exception:
+                self._conn.rollback()
+                raise
+
+    def execute_values(self, cursor, query, rows, page_size=None):
+        """Replaces psycopg2.extras.execute_values for the INSERTs of BufferedWriter"""
+        sqlite_query = query.replace('%s', '(' + ', '.join('?' * len(rows[0])) + ')')
+        cursor._cursor.executemany(sqlite_query, rows)
+        if query.startswith('INSERT INTO warehouse_data'):
+            self.rows_inserted += len(rows)
+
+    def stats(self):
+        return 1, 1
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+class CountingAllocator:
+    """Replaces psql_func.IdAllocator, SQLite has no sequences"""
+
+    def __init__(self):
+        self._ids = itertools.count(1)
+        self._lock = threading.Lock()
+
+    def take(self, count, cursor):
+        with self._lock:
+            return [next(self._ids) for _ in range(count)]
+
+
+def use_sqlite(psql_func, path, devices):
+    """Points psql_func at an SQLite database holding the benchmark devices
+
+    Returns:
+        SqlitePool: The pool now used by psql_func
+    """
+    sqlite_pool = SqlitePool(path, devices, psql_func.INSERT_COLUMNS)
+    psql_func.pool = sqlite_pool
+    psql_func.execute_values = sqlite_pool.execute_values
+    psql_func.id_allocator = CountingAllocator()
+    # Created by SqlitePool, which has no sequence to check
+    psql_func.check_schema = lambda: None
+    return sqlite_pool
+
+
+"""
+DEVICE FLEET
+"""
+
+
+class Fleet:
+    """Simulated devices, records how long the service takes to answer them
+
+    Args:
+        broker (FakeBroker): Broker the devices are connected to
+        devices (int): Number of devices
+        control_ratio (float): Share of messages that are MR or MC requests
+        binary (bool): Send readings in the compact binary format
+    """
+
+    def __init__(self, broker, devices, control_ratio, binary=False, seed=0):
+        self.broker = broker
+        self.control_ratio = control_ratio
+        self.binary = binary
+        self.mac_ids = ['02:00:00:%02X:%02X:%02X' % ((i >> 16) & 255, (i >> 8) & 255, i & 255)
+                        for i in range(devices)]
+        self.models = [f"{fruit}[{variety[0:2]}]" for _, fruit, variety in CATALOG]
+
+        self.sent = 0
+        self.feedback_latencies = []
+        self.control_latencies = []
+
+        self._random = random.Random(seed)
+        self._values = np.random.RandomState(seed)
+        self._counts = {mac_id: 0 for mac_id in self.mac_ids}
+        # Send times of completed batches and control requests awaiting an answer
+        self._batches = {mac_id: deque() for mac_id in self.mac_ids}
+        self._controls = {mac_id: deque() for mac_id in self.mac_ids}
+        self._lock = threading.Lock()
+
+        self.subscriber = Subscriber(self.on_message, "bench-fleet")
+        for mac_id in self.mac_ids:
+            broker.subscribe(f"/{mac_id}", self.subscriber)
+
+    def pending(self):
+        with self._lock:
+            return sum(map(len, self._batches.values())) + sum(map(len, self._controls.values()))
+
+    def send(self, index):
+        """Sends the next message of a device"""
+        mac_id = self.mac_ids[index]
+
+        if self._random.random() < self.control_ratio:
+            if self._random.random() < 0.5:
+                payload = f"MR, {mac_id}"
+            else:
+                payload = f"MC, {self._random.choice(self.models)}, {mac_id}"
+            with self._lock:
+                self._controls[mac_id].append(time.perf_counter())
+        else:
+            values = np.round(self._values.uniform(100, 900, len(settings.DEVICE_READINGS)), 2)
+            if self.binary:
+                payload = calculations.pack_binary_reading(mac_id, values)
+            else:
+                payload = ', '.join(map(str, values)) + f", BENCH, {mac_id}"
+
+            self._counts[mac_id] += 1
+            if self._counts[mac_id] % settings.MESSAGE_LIMIT == 0:
+                with self._lock:
+                    self._batches[mac_id].append(time.perf_counter())
+
+        self.broker.publish(settings.SUB_TOPIC, payload)
+        self.sent += 1
+
+    def on_message(self, message):
+        received = time.perf_counter()
+        mac_id = message.topic[1:]
+        with self._lock:
+            if message.payload.startswith(b'$'):
+                pending, latencies = self._batches[mac_id], self.feedback_latencies
+            else:
+                pending, latencies = self._controls[mac_id], self.control_latencies
+            if pending:
+                latencies.append(received - pending.popleft())
+
+
+def run_load(fleet, devices, rate, duration):
+    """Sends `rate` messages per second per device for `duration` seconds,
+    as fast as possible if rate is 0"""
+    interval = 1 / (devices * rate) if rate else 0
+    start = time.perf_counter()
+    end = start + duration
+    next_send = start
+
+    for i in itertools.count():
+        now = time.perf_counter()
+        if now >= end:
+            break
+        fleet.send(i % devices)
+
+        if interval:
+            next_send += interval
+            if next_send > now:
+                time.sleep(next_send - now)
+    return time.perf_counter() - start
+
+
+"""
+REPORT
+"""
+
+
+def percentiles(latencies):
+    if not latencies:
+        return {'p50': None, 'p95': None, 'p99': None}
+    p50, p95, p99 = np.percentile(np.asarray(latencies) * 1000, [50, 95, 99])
+    return {'p50': round(p50, 2), 'p95': round(p95, 2), 'p99': round(p99, 2)}
+
+
+def rss_mb():
+    with open('/proc/self/status') as status:
+        for line in status:
+            if line.startswith('VmRSS:'):
+                return round(int(line.split()[1]) / 1024, 1)
+    return None
+
+
+def compare(results, baseline, tolerance):
+    """Returns the regressions of results against a baseline run"""
+    regressions = []
+    if results['msgs_per_s'] < baseline['msgs_per_s'] * (1 - tolerance):
+        regressions.append("throughput %.0f msgs/s, was %.0f" % (results['msgs_per_s'], baseline['msgs_per_s']))
+    for key in ('p50', 'p95', 'p99'):
+        now, before = results['feedback_ms'][key], baseline['feedback_ms'][key]
+        if now is not None and before is not None and now > before * (1 + tolerance):
+            regressions.append("feedback %s %.2f ms, was %.2f ms" % (key, now, before))
+    if results['lost'] > baseline['lost']:
+        regressions.append("%d answers lost, was %d" % (results['lost'], baseline['lost']))
+    return regressions
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="End-to-end benchmark of main.py")
+    parser.add_argument('--devices', type=int, default=100)
+    parser.add_argument('--rate', type=float, default=1,
+                        help="messages per second per device, 0 sends as fast as possible")
+    parser.add_argument('--duration', type=float, default=10, help="seconds of load")
+    parser.add_argument('--drain', type=float, default=30,
+                        help="seconds to wait for outstanding answers after the load")
+    parser.add_argument('--control-ratio', type=float, default=0.01,
+                        help="share of messages that are MR or MC requests")
+    parser.add_argument('--binary', action='store_true', help="send binary readings")
+    parser.add_argument('--models', default=settings.MODEL_DIR, help="directory with the models")
+    parser.add_argument('--db', default=':memory:', help="SQLite database file")
+    parser.add_argument('--log', default='benchmark.log', help="log file of the service")
+    parser.add_argument('--json', help="write the results to this file")
+    parser.add_argument('--baseline', help="results of an earlier run to compare with")
+    parser.add_argument('--tolerance', type=float, default=0.1,
+                        help="allowed relative regression against the baseline")
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+
+    # Before importing main, it configures logging and loads models from these
+    settings.MQTT_LOG_FILE = args.log
+    settings.MODEL_DIR = args.models.rstrip('/') + '/'
+    settings.DEFAULT_BRIX_MODEL = f"{settings.MODEL_DIR}default_brix.sav"
+    settings.DEFAULT_CLF_MODEL = f"{settings.MODEL_DIR}default_clf.sav"
+    settings.CATALOG_CHANNEL = None
+
+    import main as service
+    import psql_func
+
+    broker = FakeBroker()
+    fleet = Fleet(broker, args.devices, args.control_ratio, args.binary)
+    sqlite_pool = use_sqlite(psql_func, args.db, fleet.mac_ids)
+
+    service.start_services()
+    client = FakeClient(broker)
+    service_subscriber = Subscriber(lambda message: service.on_message(client, None, message), "bench-service")
+    broker.subscribe(settings.SUB_TOPIC, service_subscriber)
+
+    cpu_start = resource.getrusage(resource.RUSAGE_SELF)
+    elapsed = run_load(fleet, args.devices, args.rate, args.duration)
+
+    # Wait for the answers still on their way
+    drain_start = time.perf_counter()
+    while fleet.pending() and time.perf_counter() < drain_start + args.drain:
+        time.sleep(0.05)
+    total = elapsed + time.perf_counter() - drain_start
+    cpu_end = resource.getrusage(resource.RUSAGE_SELF)
+    memory = rss_mb()
+
+    service_subscriber.stop()
+    service.stop_services()
+    fleet.subscriber.stop()
+
+    cpu = (cpu_end.ru_utime - cpu_start.ru_utime) + (cpu_end.ru_stime - cpu_start.ru_stime)
+    results = {
+        'devices': args.devices,
+        'rate': args.rate,
+        'duration_s': round(elapsed, 2),
+        'messages': fleet.sent,
+        'msgs_per_s': round(fleet.sent / total, 1),
+        'feedbacks': len(fleet.feedback_latencies),
+        'lost': fleet.pending(),
+        'feedback_ms': percentiles(fleet.feedback_latencies),
+        'control_ms': percentiles(fleet.control_latencies),
+        'rows_written': sqlite_pool.rows_inserted,
+        'cpu_percent': round(100 * cpu / total, 1),
+        'rss_mb': memory,
+        'peak_rss_mb': round(cpu_end.ru_maxrss / 1024, 1),
+    }
+
+    print(json.dumps(results, indent=2))
+    if args.json:
+        with open(args.json, 'w') as results_file:
+            json.dump(results, results_file, indent=2)
+
+    if args.baseline:
+        with open(args.baseline) as baseline_file:
+            regressions = compare(results, json.load(baseline_file), args.tolerance)
+        for regression in regressions:
+            print("REGRESSION:", regression)
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
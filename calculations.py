@@ -1,8 +1,115 @@
+# Basic libraries
+import logging
+
 # Scientific Libraries
 import numpy as np
 
-# Custom modules
-import settings
+# Compact binary reading, for devices that opt in:
+#   1 byte   BINARY_MAGIC
+#   6 bytes  MAC address
+#   4 bytes  per reading, little-endian float32, same order as the text format
+# The magic byte never starts a text message, so both formats share a topic
+BINARY_MAGIC = b'\xb1'
+BINARY_HEADER_SIZE = 7
+BINARY_READING_DTYPE = np.dtype('<f4')
+
+
+def parse_reading(payload):
+    """Parses a text reading in a single pass.
+    All fields except the last two are readings, the last one is the MAC ID
+    b'1, 2, 3, 4, 5, 6, 82.5, WC0001, AC:67:B2:3C:00:1C'
+        -> ('AC:67:B2:3C:00:1C', [1.0, 2.0, 3.0, 4.0, 5.0, 6.0, 82.5])
+
+    Args:
+        payload (bytes): Message payload
+
+    Returns:
+        tuple: MAC ID and float array of the readings
+    """
+    mac_start = payload.rindex(b',')
+    values_end = payload.rindex(b',', 0, mac_start)
+
+    values = np.fromstring(payload[:values_end], sep=',')
+    # fromstring stops quietly at the first field that is not a number
+    if len(values) != payload.count(b',', 0, values_end) + 1:
+        raise ValueError("Invalid reading %r" % payload)
+
+    return payload[mac_start + 1:].strip().decode("utf-8"), values
+
+
+def parse_binary_reading(payload):
+    """Parses a compact binary reading, see BINARY_MAGIC
+
+    Args:
+        payload (bytes): Message payload
+
+    Returns:
+        tuple: MAC ID and float array of the readings
+    """
+    if (len(payload) - BINARY_HEADER_SIZE) % BINARY_READING_DTYPE.itemsize:
+        raise ValueError("Invalid binary reading of %d bytes" % len(payload))
+
+    mac_id = ':'.join('%02X' % byte for byte in payload[1:BINARY_HEADER_SIZE])
+    values = np.frombuffer(payload, dtype=BINARY_READING_DTYPE, offset=BINARY_HEADER_SIZE)
+    return mac_id, values.astype(float)
+
+
+def pack_binary_reading(mac_id, values):
+    """Builds a compact binary reading, the inverse of parse_binary_reading
+
+    Args:
+        mac_id (str): MAC ID, e.g. AC:67:B2:3C:00:1C
+        values (list): Readings
+
+    Returns:
+        bytes: Message payload
+    """
+    mac = bytes(int(part, 16) for part in mac_id.split(':'))
+    return BINARY_MAGIC + mac + np.asarray(values, dtype=BINARY_READING_DTYPE).tobytes()
+
+
+def message_mac_id(payload):
+    """MAC ID of any incoming message (reading, MR or MC) without parsing
+    the rest of it. It is always the last field of text messages
+
+    Args:
+        payload (bytes): Message payload
+
+    Returns:
+        str: MAC ID
+    """
+    if payload.startswith(BINARY_MAGIC):
+        return ':'.join('%02X' % byte for byte in payload[1:BINARY_HEADER_SIZE])
+    return payload[payload.rindex(b',') + 1:].strip().decode("utf-8")
+
+
+def normalize_readings(sensor_data, white_standard):
+    """Averages a set of parsed readings and normalizes the wavelength values
+
+    Args:
+        sensor_data (np.ndarray): One row of readings per message
+        white_standard (list): Normalization values for specific device
+
+    Returns:
+        list: Both raw values and normalized values
+    """
+    # Calculate mean values
+    raw_mean_values = np.mean(sensor_data, axis=0)
+
+    return raw_mean_values, normalize_mean(raw_mean_values, white_standard)
+
+
+def normalize_mean(raw_mean_values, white_standard):
+    """Normalizes the wavelength values of averaged readings
+
+    Args:
+        raw_mean_values (np.ndarray): Mean of a set of readings
+        white_standard (list): Normalization values for specific device
+
+    Returns:
+        np.ndarray: Normalized wavelength values
+    """
+    return raw_mean_values[: len(white_standard)] / white_standard
 
 
 def normalize_fruit_data(data, white_standard):
@@ -16,22 +123,14 @@ def normalize_fruit_data(data, white_standard):
     Returns:
         list: Both raw values and normalized values
     """
-    LENGTH = len(white_standard)
 
     """Converting sensor readings to float
     Converts all readings except Warehouse ID and Device ID
     '1, 2, 3, 4, 5, 6, 82.5, WC0001, D20' -> [1.0, 2.0, 3.0, 4.0, 5.0, 6.0, 82.5]
     """
-    sensor_data = np.array([list(map(float, i.split(', ')
-                                     [: -2])) for i in data])
-
-    # Calculate mean values
-    raw_mean_values = np.mean(sensor_data, axis=0)
+    sensor_data = np.vstack([parse_reading(i.encode("utf-8"))[1] for i in data])
 
-    # Normalizes only the wavelength values
-    normalized_values = (raw_mean_values[: LENGTH] / white_standard)
-
-    return raw_mean_values, normalized_values
+    return normalize_readings(sensor_data, white_standard)
 
 
 def predict_status(values, model):
@@ -51,9 +150,8 @@ def predict_status(values, model):
         predictions = model.predict_proba(values[0:1])
         fruit_status = predictions[0][1]
     except Exception as e:
-        print("ERROR",e)
+        logging.error("Status classification failed - %s" % e)
         fruit_status = -1
-    print(fruit_status)
     
     r,g,b = ((255 - int(fruit_status*255)),int(fruit_status*255),0)
     #fruit_status = fruit_status+'% GOOD'
@@ -101,3 +199,102 @@ def calculate_brix_level(predicted_brix):
     elif predicted_brix >= 15 and predicted_brix < 18:
         return 'D'
     return 'E'
+
+
+def predict_brix_batch(values, model):
+    """Predicts the brix values for several sets of wavelength values
+    with a single model call
+
+    Args:
+        values (np.ndarray): One row of normalized values per reading
+        model (regression model): Model to predict brix values
+
+    Returns:
+        np.ndarray: The predicted brix value of every row, -1 for the rows the
+            model rejects when there are several
+    """
+    try:
+        predicted_brix_values = np.asarray(model.predict(values), dtype=float)
+    except Exception as e:
+        if len(values) == 1:
+            raise
+        # One reading the model rejects (NaN, inf) fails the whole call
+        logging.error("Brix prediction failed, predicting %d readings one at a time - %s" % (len(values), e))
+        predicted_brix_values = np.full(len(values), -1.0)
+        for i in range(len(values)):
+            try:
+                predicted_brix_values[i] = predict_brix_batch(values[i:i + 1], model)[0]
+            except Exception as e:
+                logging.error("Brix prediction failed - %s" % e)
+        return predicted_brix_values
+
+    # Some models return nested values, keep the first output of each row
+    return predicted_brix_values.reshape(len(values), -1)[:, 0]
+
+
+def predict_status_batch(values, model):
+    """Classifies fruit status for several sets of values with a single
+    model call. Same output as predict_status, one entry per row
+
+    Args:
+        values (np.ndarray): One row of normalized values and brix per reading
+        model (linear model): Model to classify fruits
+
+    Returns:
+        tuple: Status (% good), r, g and b arrays
+    """
+    fruit_status = predict_good_probabilities(values, model)
+    r, g, b = status_colours(fruit_status)
+    return (fruit_status * 100).astype(int), r, g, b
+
+
+def predict_good_probabilities(values, model):
+    """Probability of each row being a good fruit, -1 for the rows the
+    model rejects. One reading the model rejects (NaN, inf) fails the whole
+    call, the rows are then classified one at a time
+
+    Args:
+        values (np.ndarray): One row of normalized values and brix per reading
+        model (linear model): Model to classify fruits
+
+    Returns:
+        np.ndarray: Probabilities of the fruits being good
+    """
+    try:
+        return model.predict_proba(values)[:, 1]
+    except Exception as e:
+        logging.error("Status classification failed - %s" % e)
+        if len(values) == 1:
+            return np.full(1, -1.0)
+        return np.concatenate([predict_good_probabilities(values[i:i + 1], model)
+                               for i in range(len(values))])
+
+
+def status_colours(fruit_status):
+    """Maps the probability of a fruit being good to an RGB colour,
+    red for bad and green for good
+
+    Args:
+        fruit_status (np.ndarray): Probabilities of the fruits being good
+
+    Returns:
+        tuple: r, g and b arrays
+    """
+    g = (fruit_status * 255).astype(int)
+    return 255 - g, g, np.zeros_like(g)
+
+
+BRIX_LEVEL_BOUNDS = [9, 12, 15, 18]
+BRIX_LEVELS = np.array(['A', 'B', 'C', 'D', 'E'])
+
+
+def calculate_brix_levels(predicted_brix):
+    """Same as calculate_brix_level for an array of brix values
+
+    Args:
+        predicted_brix (np.ndarray): The predicted brix values
+
+    Returns:
+        np.ndarray: The range under which every brix value falls
+    """
+    return BRIX_LEVELS[np.digitize(predicted_brix, BRIX_LEVEL_BOUNDS)]
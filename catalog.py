@@ -0,0 +1,131 @@
+# Basic libraries
+import logging
+import select
+import threading
+import time
+from collections import namedtuple
+
+# Custom modules
+import psql_func
+
+# One consistent view of the catalog, replaced as a whole on refresh
+CatalogSnapshot = namedtuple('CatalogSnapshot', ['varieties', 'boot_suffix', 'model_ids'])
+
+
+def short_name(fruit, variety):
+    """Name of a model as shown on the device
+
+    Args:
+        fruit (str): Fruit name, e.g. APPLE
+        variety (str): Variety name, e.g. FUJI
+
+    Returns:
+        str: Shortened name, e.g. APPLE[FU]
+    """
+    return f"{fruit}[{variety[0:2]}]"
+
+
+def build_snapshot(rows):
+    """Precomputes everything the MR and MC handlers need from the catalog
+
+    Args:
+        rows (list): (fruit_variety_id, fruit, variety) tuples
+
+    Returns:
+        CatalogSnapshot: (fruit, variety) list, the shortened list sent after
+        the device's own model on boot and the shortened name -> fruit_variety_id map
+    """
+    varieties = [(fruit, variety) for _, fruit, variety in rows]
+    boot_suffix = ''.join(',' + short_name(fruit, variety) for fruit, variety in varieties)
+
+    model_ids = {}
+    for fruit_variety_id, fruit, variety in rows:
+        # Varieties sharing a short name resolve to the lowest fruit_variety_id
+        model_ids.setdefault(short_name(fruit, variety), fruit_variety_id)
+
+    return CatalogSnapshot(varieties, boot_suffix, model_ids)
+
+
+class Catalog:
+    """Fruit/variety catalog loaded once and shared by all handlers.
+
+    The catalog is reloaded every `refresh_interval` seconds, or as soon as
+    a NOTIFY arrives on `channel` (see migrations/002_catalog_notify.sql).
+
+    Args:
+        refresh_interval (float): Seconds between reloads
+        channel (str): PostgreSQL channel to LISTEN on, None to only use the timer
+    """
+
+    def __init__(self, refresh_interval, channel=None):
+        self.refresh_interval = refresh_interval
+        self.channel = channel
+        self.snapshot = CatalogSnapshot([], '', {})
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="catalog-refresh", daemon=True)
+
+    @property
+    def varieties(self):
+        return self.snapshot.varieties
+
+    def load(self):
+        self.snapshot = build_snapshot(psql_func.get_fruit_variety_catalog())
+        logging.info("Catalog loaded with %d varieties" % len(self.snapshot.varieties))
+
+    def boot_response(self, fruit, variety):
+        """Response to an MR boot message: the device's model followed by all models"""
+        return f"!{short_name(fruit, variety)}{self.snapshot.boot_suffix}"
+
+    def model_id(self, name):
+        """fruit_variety_id of a shortened model name, raises KeyError if unknown"""
+        return self.snapshot.model_ids[name]
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+        self._thread.join()
+
+    def _reload(self):
+        try:
+            self.load()
+        except Exception as e:
+            logging.error("Catalog refresh failed - %s" % e)
+
+    def _wait_for_notify(self, listen_conn, timeout):
+        # Returns True once a NOTIFY arrived, wakes up every second to check for stop()
+        deadline = time.monotonic() + timeout
+        while not self._stopped.is_set() and time.monotonic() < deadline:
+            select.select([listen_conn], [], [], min(1, deadline - time.monotonic()))
+            listen_conn.poll()
+            if listen_conn.notifies:
+                listen_conn.notifies.clear()
+                return True
+        return False
+
+    def _run(self):
+        listen_conn = None
+        while not self._stopped.is_set():
+            if self.channel and listen_conn is None:
+                try:
+                    listen_conn = psql_func.listen_connection(self.channel)
+                except Exception as e:
+                    logging.error("LISTEN on %s failed - %s" % (self.channel, e))
+
+            if listen_conn is None:
+                if self._stopped.wait(self.refresh_interval):
+                    break
+            else:
+                try:
+                    if self._wait_for_notify(listen_conn, self.refresh_interval):
+                        logging.info("Catalog change notified on %s" % self.channel)
+                except Exception as e:
+                    logging.error("Catalog listener lost its connection - %s" % e)
+                    listen_conn = None
+
+            if not self._stopped.is_set():
+                self._reload()
+
+        if listen_conn is not None:
+            listen_conn.close()
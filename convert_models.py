@@ -0,0 +1,62 @@
+"""
+Converts the .sav models to memory-mappable artifacts.
+
+For every .sav file that compiles to a NumPy kernel (see
+linear_models.compile_model), <name>.json and <name>.bin are written next
+to it and loaded by model_registry instead of the pickle. Other models
+stay .sav only. An artifact is ignored once its .sav changes, run this
+again after replacing a model.
+
+Usage: python convert_models.py [model_dir]
+"""
+
+# Basic libraries
+import logging
+import os
+import pickle
+import sys
+
+# Custom modules
+import settings
+from linear_models import LinearKernel, compile_model, save_artifact
+
+
+def convert(path):
+    """Writes the artifact of one .sav file
+
+    Returns:
+        bool: False if the model has no NumPy kernel
+    """
+    with open(path, 'rb') as model_file:
+        model = pickle.load(model_file)
+
+    kernel = compile_model(model)
+    if not isinstance(kernel, LinearKernel):
+        return False
+
+    save_artifact(kernel, os.path.splitext(path)[0], type(model).__name__, path)
+    return True
+
+
+if __name__ == "__main__":
+
+    logging.basicConfig(level=logging.INFO, format="%(levelname)s %(message)s")
+    model_dir = sys.argv[1] if len(sys.argv) > 1 else settings.MODEL_DIR
+
+    converted = skipped = 0
+    for name in sorted(os.listdir(model_dir)):
+        if not name.endswith('.sav'):
+            continue
+        path = os.path.join(model_dir, name)
+        try:
+            if convert(path):
+                converted += 1
+                logging.info("Converted %s" % name)
+            else:
+                skipped += 1
+                logging.info("Kept %s as .sav, not a supported linear model" % name)
+        except Exception as e:
+            skipped += 1
+            logging.error("Failed to convert %s - %s" % (name, e))
+
+    logging.info("Converted %d models, kept %d as .sav" % (converted, skipped))
@@ -0,0 +1,156 @@
+# PSQL Library
+import psycopg2
+
+# Basic libraries
+import logging
+import threading
+import time
+from contextlib import contextmanager
+
+# Errors after which a connection is not reused
+CONNECTION_ERRORS = (psycopg2.OperationalError, psycopg2.InterfaceError)
+
+
+class PoolTimeout(Exception):
+    """No connection became available within the pool's timeout"""
+
+
+class ConnectionPool:
+    """Thread-safe pool of PSQL connections.
+
+    Connections are opened on demand, so creating the pool never blocks.
+    An idle connection is checked with `SELECT 1` before reuse once it has
+    been idle for `health_check_interval` seconds. Connections that fail
+    the check or raise a connection error are closed and replaced by a new
+    one on the next checkout.
+
+    Args:
+        connect (callable): Returns a new psycopg2 connection
+        minconn (int): Connections opened by open()
+        maxconn (int): Maximum number of open connections
+        health_check_interval (float): Idle seconds after which a connection is checked
+        timeout (float): Seconds to wait for a free connection before raising PoolTimeout
+    """
+
+    def __init__(self, connect, minconn, maxconn, health_check_interval, timeout):
+        self._connect = connect
+        self.minconn = minconn
+        self.maxconn = maxconn
+        self.health_check_interval = health_check_interval
+        self.timeout = timeout
+
+        self._idle = []
+        self._open = 0
+        self._closed = False
+        self._cond = threading.Condition()
+
+    def open(self):
+        """Opens `minconn` connections ahead of the first request"""
+        while True:
+            with self._cond:
+                if self._open >= self.minconn:
+                    return
+                self._open += 1
+            try:
+                conn = self._connect()
+            except Exception:
+                with self._cond:
+                    self._open -= 1
+                    self._cond.notify()
+                raise
+            self._release(conn, broken=False)
+
+    def close(self):
+        with self._cond:
+            self._closed = True
+            idle, self._idle = self._idle, []
+            self._open -= len(idle)
+        for conn, _ in idle:
+            conn.close()
+
+    def stats(self):
+        """(open connections, idle connections)"""
+        with self._cond:
+            return self._open, len(self._idle)
+
+    @contextmanager
+    def connection(self):
+        """Checks out a connection, rolling back and returning it afterwards"""
+        conn = self._acquire()
+        broken = False
+        try:
+            yield conn
+        except CONNECTION_ERRORS:
+            broken = True
+            raise
+        except Exception:
+            if not conn.closed:
+                conn.rollback()
+            raise
+        finally:
+            self._release(conn, broken or bool(conn.closed))
+
+    @contextmanager
+    def cursor(self):
+        """Checks out a connection and yields a cursor, committing on success"""
+        with self.connection() as conn:
+            with conn.cursor() as cur:
+                yield cur
+            conn.commit()
+
+    def _acquire(self):
+        deadline = time.monotonic() + self.timeout
+        with self._cond:
+            while True:
+                if self._closed:
+                    raise PoolTimeout("Pool is closed")
+                if self._idle:
+                    conn, idle_since = self._idle.pop()
+                    break
+                if self._open < self.maxconn:
+                    self._open += 1
+                    conn = None
+                    break
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise PoolTimeout("No PSQL connection free after %ss" % self.timeout)
+                self._cond.wait(remaining)
+
+        if conn is not None and time.monotonic() - idle_since < self.health_check_interval:
+            return conn
+
+        if conn is not None:
+            if self._healthy(conn):
+                return conn
+            logging.error("Replacing broken PSQL connection")
+            conn.close()
+
+        try:
+            return self._connect()
+        except Exception:
+            with self._cond:
+                self._open -= 1
+                self._cond.notify()
+            raise
+
+    def _healthy(self, conn):
+        try:
+            with conn.cursor() as cur:
+                cur.execute("SELECT 1")
+            conn.rollback()
+            return True
+        except Exception:
+            return False
+
+    def _release(self, conn, broken):
+        with self._cond:
+            if broken or self._closed:
+                self._open -= 1
+            else:
+                self._idle.append((conn, time.monotonic()))
+            self._cond.notify()
+        if broken or self._closed:
+            try:
+                conn.close()
+            except Exception:
+                pass
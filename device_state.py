@@ -0,0 +1,92 @@
+# Basic libraries
+import threading
+
+# Scientific Libraries
+import numpy as np
+
+
+class DeviceState:
+    """Batch state of one device, see DeviceTable
+
+    Args:
+        mac_id (str): MAC ID of the device
+        slot (int): Row of the device in DeviceTable's array
+    """
+
+    __slots__ = ('mac_id', 'slot', 'message_count', 'end_time')
+
+    def __init__(self, mac_id, slot):
+        self.mac_id = mac_id
+        self.slot = slot
+        self.message_count = 0
+        self.end_time = -1
+
+
+class DeviceTable:
+    """Batch state of all devices, indexed by device name.
+
+    The readings of every device live in one preallocated array with a
+    ring of `message_limit` rows per device plus a row of running sums, so
+    the mean of a batch is ready as soon as it completes. Adding a reading
+    allocates nothing and there are no per-device arrays or lists.
+    Readings with fewer than `width` values are padded with NaN, extra
+    values are ignored.
+
+    Args:
+        message_limit (int): Number of readings in a batch
+        width (int): Number of values stored per reading
+        capacity (int): Number of devices to allocate room for, grows as needed
+    """
+
+    def __init__(self, message_limit, width, capacity=1024):
+        self.message_limit = message_limit
+        self.width = width
+        self._data = np.zeros((capacity, message_limit + 1, width))
+        self._states = {}
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._states)
+
+    def __contains__(self, device_name):
+        return device_name in self._states
+
+    def get(self, device_name, mac_id):
+        """Returns the state of a device, creating it on its first message"""
+        state = self._states.get(device_name)
+        if state is None:
+            with self._lock:
+                slot = len(self._states)
+                if slot == len(self._data):
+                    grown = np.zeros((2 * len(self._data),) + self._data.shape[1:])
+                    grown[:slot] = self._data
+                    self._data = grown
+                state = self._states[device_name] = DeviceState(mac_id, slot)
+        return state
+
+    def add(self, state, values):
+        """Adds one parsed reading to the device's current batch
+
+        Args:
+            state (DeviceState): State returned by get()
+            values (np.ndarray): Readings of one message
+        """
+        count = min(len(values), self.width)
+        with self._lock:
+            row = state.message_count % self.message_limit
+            self._data[state.slot, row, :count] = values[:count]
+            self._data[state.slot, row, count:] = np.nan
+            self._data[state.slot, self.message_limit] += self._data[state.slot, row]
+            state.message_count += 1
+
+    def mean(self, state):
+        """Mean of the readings in the device's current batch"""
+        with self._lock:
+            return self._data[state.slot, self.message_limit] / state.message_count
+
+    def reset(self, device_name):
+        state = self._states[device_name]
+        with self._lock:
+            state.message_count = 0
+            state.end_time = -1
+            self._data[state.slot, self.message_limit] = 0
@@ -0,0 +1,78 @@
+# Basic libraries
+import logging
+import queue
+import threading
+import zlib
+
+
+class OrderedDispatcher:
+    """Runs jobs on a fixed pool of worker threads.
+
+    Every job is submitted with a key (the device's MAC ID). Jobs with the
+    same key always go to the same worker, so they run one at a time and in
+    the order they were submitted, while different devices run in parallel.
+
+    Args:
+        workers (int): Number of worker threads
+        queue_size (int): Maximum number of pending jobs per worker
+        submit_timeout (float): Seconds submit() waits for space in a full
+            queue before the job is dropped
+    """
+
+    def __init__(self, workers, queue_size, submit_timeout=None):
+        self.submit_timeout = submit_timeout
+        self._queues = [queue.Queue(maxsize=queue_size) for _ in range(workers)]
+        self._threads = [
+            threading.Thread(target=self._run, args=(q,),
+                             name=f"dispatch-worker-{i}", daemon=True)
+            for i, q in enumerate(self._queues)
+        ]
+
+    def start(self):
+        for thread in self._threads:
+            thread.start()
+
+    def stop(self):
+        """Lets the workers finish their pending jobs and waits for them"""
+        for q in self._queues:
+            q.put(None)
+        for thread in self._threads:
+            thread.join()
+
+    def worker_index(self, key):
+        # crc32 is stable across processes, unlike hash() on str
+        return zlib.crc32(key.encode("utf-8")) % len(self._queues)
+
+    def submit(self, key, func, *args):
+        """Queues func(*args) on the worker that owns the key
+
+        Args:
+            key (str): Ordering key, jobs with equal keys run in order
+            func (callable): Job to run
+
+        Returns:
+            bool: False if the job was dropped because the queue stayed full
+        """
+        try:
+            self._queues[self.worker_index(key)].put(
+                (func, args), timeout=self.submit_timeout
+            )
+            return True
+        except queue.Full:
+            logging.error("Dispatch queue full, dropped job for %s" % key)
+            return False
+
+    def queue_depth(self):
+        return sum(q.qsize() for q in self._queues)
+
+    def _run(self, jobs):
+        while True:
+            job = jobs.get()
+            if job is None:
+                return
+
+            func, args = job
+            try:
+                func(*args)
+            except Exception as e:
+                logging.error("Dispatched job %s failed - %s" % (func.__name__, e))
@@ -1,8 +1,8 @@
 # Basic libraries
 import logging
+import signal
 import threading
 import time
-import pickle
 from warnings import filterwarnings
 
 # MQTT Library
@@ -10,15 +10,18 @@ import paho.mqtt.client as mqttClient
 
 # Custom modules
 import calculations, psql_func, settings
+from log_setup import configure_logging
+from model_registry import BRIX, CLF, ModelRegistry
+from scheduler import DeadlineScheduler
 filterwarnings("ignore")
 
 # Logging
-logging.basicConfig(
-    filename=settings.MQTT_LOG_FILE,
-    filemode="a",
-    format="%(asctime)s - %(levelname)s %(message)s",
-    level=logging.INFO,
-)
+configure_logging(settings.MQTT_LOG_FILE,
+                  settings.LOG_LEVEL,
+                  settings.LOG_MAX_BYTES,
+                  settings.LOG_BACKUP_COUNT,
+                  settings.LOG_QUEUE_SIZE,
+                  settings.LOG_SAMPLE_RATES)
 
 # Topics
 SUB_TOPIC = settings.SUB_TOPIC
@@ -79,6 +82,7 @@ def reset_variables(device_name):
         device_dictionary[device_name]["message_count"] = 0
         device_dictionary[device_name]["message_arr"] = []
         device_dictionary[device_name]["end_time"] = -1
+        timeout_scheduler.cancel(device_name)
         logging.info('Reset value for %s' % device_name)
     except Exception as e:
         logging.error('Reset for %s failed - %s' % (device_name, e))
@@ -87,6 +91,17 @@ def reset_variables(device_name):
         lock.release()
 
 
+def on_timeout(device_name):
+    """Called by the timeout scheduler when a device's batch is not
+    completed within TIMEOUT seconds
+
+    Args:
+        device_name (str): Key of the device in device_dictionary
+    """
+    logging.error(f"Timeout exceeded for {device_name}")
+    reset_variables(device_name)
+
+
 """
 CALLBACKS
 """
@@ -138,6 +153,12 @@ def on_message(client, userdata, message):
     # Increment message count by 1
     device_dictionary[device_name]["message_count"] += 1
 
+    # Start the timeout on the first message of a batch
+    if device_dictionary[device_name]["end_time"] == -1:
+        device_dictionary[device_name]["end_time"] = time.time() + TIMEOUT
+        timeout_scheduler.arm(device_name, TIMEOUT)
+        logging.info(f"Timeout initiated for {device_name}")
+
     # If device dictionary's message count is equal to the messsage limit
     if (device_dictionary[device_name]["message_count"]
             == device_dictionary[device_name]["message_limit"]
@@ -152,8 +173,8 @@ def on_message(client, userdata, message):
             fruit, variety, white_standard, batch_number, vendor_code = psql_func.get_device_data(warehouse_id, device_id)[0]
             white_standard = [float(x) for x in white_standard.values()]
 
-            brix_model = BRIX_MODEL_DICT[fruit][variety]
-            clf_model = CLF_MODEL_DICT[fruit][variety]
+            brix_model = model_registry.get(BRIX, fruit, variety)
+            clf_model = model_registry.get(CLF, fruit, variety)
 
         except Exception as e:
             logging.critical("Failed to load device data - %s" % e)
@@ -162,8 +183,8 @@ def on_message(client, userdata, message):
             batch_number, vendor_code = 'default', 'default'
             white_standard = settings.DEFAULT_WHITE_STANDARD
 
-            brix_model = BRIX_MODEL_DICT['default']
-            clf_model = CLF_MODEL_DICT['default']
+            brix_model = model_registry.get(BRIX, 'default', 'default')
+            clf_model = model_registry.get(CLF, 'default', 'default')
 
         # Normalize the message array with respective white standard
         raw_mean_values, normalized_values = calculations.normalize_fruit_data(
@@ -189,7 +210,7 @@ def on_message(client, userdata, message):
 
         # Send feedback
         message_to_client = f"{str(fruit_status)}{brix_level},{round(float(predicted_brix), 2)};"
-        print(message_to_client)
+        logging.debug("Sent %s to %s" % (message_to_client, device_name))
         client.publish(pub_topic, message_to_client)
 
         # Update to DB
@@ -244,6 +265,21 @@ if __name__ == "__main__":
     # Threading lock (to prevent to write statements occuring at the same time)
     lock = threading.Lock()
 
+    # Fires on_timeout for devices that do not complete a batch in time
+    timeout_scheduler = DeadlineScheduler(on_timeout, name="device-timeouts")
+
+    # Brix and classification models, shared between varieties
+    model_registry = ModelRegistry(settings.MODEL_DIR,
+                                   {BRIX: settings.DEFAULT_BRIX_MODEL, CLF: settings.DEFAULT_CLF_MODEL},
+                                   settings.MODEL_MEMORY_BUDGET,
+                                   settings.MODEL_FAST_PATH,
+                                   settings.MODEL_SHARED_DIR,
+                                   settings.MODEL_ARTIFACTS,
+                                   settings.MODEL_RECHECK_INTERVAL)
+
+    # Stops here rather than dropping every batch
+    psql_func.check_schema()
+
     # Create client
     client = create_client()
 
@@ -254,85 +290,30 @@ if __name__ == "__main__":
     # Subscribe to MQTT Topic
     client.subscribe(SUB_TOPIC)
 
-    # Load pickle models for brix
+    # Load models, varieties added later are loaded on first use
     try:
-
-        BRIX_MODEL_DICT = {'default': settings.DEFAULT_BRIX_MODEL}
-        CLF_MODEL_DICT = {'default': settings.DEFAULT_CLF_MODEL}
-
         # List of tuples -> [(fruit, variety), (fruit, variety)]
         FRUIT_VARIETY_LIST = psql_func.get_fruit_variety_list()
 
-        DEFAULT_BRIX_MODEL = settings.DEFAULT_BRIX_MODEL
-        DEFAULT_CLF_MODEL = settings.DEFAULT_CLF_MODEL
-
-        for fruit, variety in FRUIT_VARIETY_LIST:
-
-            # Create dictionary for fruit if it doesn't exist
-            if fruit not in BRIX_MODEL_DICT:
-                BRIX_MODEL_DICT[fruit] = {}
-
-            BRIX_MODEL_DICT[fruit][variety] = None
-
-            # Create dictionary for fruit if it doesn't exist
-            if fruit not in CLF_MODEL_DICT:
-                CLF_MODEL_DICT[fruit] = {}
-
-            CLF_MODEL_DICT[fruit][variety] = None
-
-            # Assign models to variables
-            brix_file = f"{settings.MODEL_DIR}BRIX_{fruit}_{variety}.sav"
-            clf_file = f"{settings.MODEL_DIR}CLF_{fruit}_{variety}.sav"
-
-            # Load models and store in respective dictionary
-            try:
-                BRIX_MODEL_DICT[fruit][variety] = pickle.load(open(brix_file, 'rb'))
-            # Else, load default model and store it in respective dictionary
-            except:
-                BRIX_MODEL_DICT[fruit][variety] = pickle.load(open(DEFAULT_BRIX_MODEL, 'rb'))
-                logging.info("Using default brix model for %s-%s" %(fruit, variety))
-
-            # Load models and store in respective dictionary
-            try:
-                CLF_MODEL_DICT[fruit][variety] = pickle.load(open(clf_file, 'rb'))
-            # Else, load default model and store it in respective dictionary
-            except:
-                CLF_MODEL_DICT[fruit][variety] = pickle.load(open(DEFAULT_CLF_MODEL, 'rb'))
-                logging.info("Using default clf model for %s-%s" %(fruit, variety))
-
+        model_registry.preload(FRUIT_VARIETY_LIST if settings.MODEL_PRELOAD else [])
         logging.info("Models loaded")
 
+        for path, size, varieties, idle in model_registry.report():
+            logging.info("Model %s - %d bytes, used by %d varieties" % (path, size, varieties))
+
     except Exception as e:
         logging.error("Failed to load models - %s" % e)
 
 
-    # Start listening
-    client.loop_start()
-
-    # Time out functionality
-    while True:
-
-        for device_name in device_list:
+    # systemctl stop sends SIGTERM, handled like Ctrl+C so the writer is closed
+    signal.signal(signal.SIGTERM, signal.default_int_handler)
 
-            end_time = device_dictionary[device_name]["end_time"]
-            message_count = device_dictionary[device_name]["message_count"]
-            message_limit = device_dictionary[device_name]["message_limit"]
-
-            # If device has sent one or more messages
-            if message_count >= 1:
-
-                # If timeout has not been set (when message_count == 1)
-                if end_time == -1:
-                    # Sets end_time to current time + TIMEOUT
-                    device_dictionary[device_name]["end_time"] = time.time() + TIMEOUT
-                    logging.info(f"Timeout initiated for {device_name}")
-
-                # If timeout has been set
-                if end_time != -1:
-                    # If time is past the end_time, resets the variables
-                    if time.time() > end_time:
-                        logging.error(f"Timeout exceeded for {device_name}")
-                        reset_variables(device_name)
-
-    client.loop_stop()
-    client.disconnect()
+    # Start listening
+    timeout_scheduler.start()
+    try:
+        client.loop_forever()
+    finally:
+        timeout_scheduler.stop()
+        client.disconnect()
+        # Flush the buffered rows
+        psql_func.writer.close()
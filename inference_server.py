@@ -0,0 +1,106 @@
+# Basic libraries
+import gc
+import logging
+import multiprocessing
+import os
+from concurrent.futures import Future
+
+# Scientific Libraries
+import numpy as np
+
+# Custom modules
+import settings
+from batcher import predict_values
+from log_setup import configure_logging
+from model_registry import BRIX, CLF
+
+# Workers are forked so they inherit the loaded models instead of loading their own
+mp = multiprocessing.get_context('fork')
+
+# Registry of a worker process, inherited from the server
+_registry = None
+
+
+def _init_worker(model_registry):
+    global _registry
+
+    # The log writer thread of the server is not forked, every worker gets its own
+    root, extension = os.path.splitext(settings.MQTT_LOG_FILE)
+    configure_logging(f"{root}-{mp.current_process().name}{extension}",
+                      settings.LOG_LEVEL,
+                      settings.LOG_MAX_BYTES,
+                      settings.LOG_BACKUP_COUNT,
+                      settings.LOG_QUEUE_SIZE,
+                      settings.LOG_SAMPLE_RATES)
+
+    model_registry.after_fork()
+    _registry = model_registry
+
+
+def _predict(fruit, variety, normalized_values):
+    brix_model = _registry.get(BRIX, fruit, variety)
+    clf_model = _registry.get(CLF, fruit, variety)
+    return predict_values(np.atleast_2d(normalized_values), brix_model, clf_model)[0]
+
+
+class InferenceServer:
+    """Runs predictions on a pool of worker processes, so they are not
+    limited to one core by the GIL.
+
+    The workers are forked from the service once the registry has loaded
+    the models, so the model weights are shared copy-on-write instead of
+    being loaded by every worker. The GC is frozen while forking so it
+    does not touch (and copy) the pages of the inherited objects. Weights
+    of NumPy kernels are memory-mapped when the registry has a shared_dir,
+    which also shares models a worker only loads later.
+
+    Start the server before starting any threads that use the registry.
+    Workers that die are replaced by the pool; predictions they were
+    running never complete, so wait for results with a timeout.
+
+    Workers log to their own files next to MQTT_LOG_FILE. Metrics recorded
+    in the workers stay there, so the predict_brix and predict_status
+    stages are missing from /metrics, only the server's inference stage
+    (submit to result) is exported.
+
+    Args:
+        model_registry (ModelRegistry): Registry with the models preloaded
+        processes (int): Number of worker processes
+    """
+
+    def __init__(self, model_registry, processes):
+        self.model_registry = model_registry
+        self.processes = processes
+        self._pool = None
+
+    def start(self):
+        gc.collect()
+        gc.freeze()
+        try:
+            self._pool = mp.Pool(self.processes, initializer=_init_worker,
+                                 initargs=(self.model_registry,))
+        finally:
+            gc.unfreeze()
+        logging.info("Inference server started %d processes" % self.processes)
+
+    def stop(self):
+        """Finishes the pending predictions and stops the workers"""
+        self._pool.close()
+        self._pool.join()
+
+    def submit(self, fruit, variety, normalized_values):
+        """Queues one reading for prediction
+
+        Args:
+            fruit (str): Fruit name, 'default' for the default models
+            variety (str): Variety name
+            normalized_values (np.ndarray): Normalized wavelength values
+
+        Returns:
+            Future: Resolves to a batcher.Prediction
+        """
+        future = Future()
+        self._pool.apply_async(_predict, (fruit, variety, normalized_values),
+                               callback=future.set_result,
+                               error_callback=future.set_exception)
+        return future
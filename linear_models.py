@@ -0,0 +1,277 @@
+# Basic libraries
+import hashlib
+import json
+import logging
+import os
+
+# Scientific Libraries
+import numpy as np
+
+# Preprocessing steps that can be folded into the linear model
+SCALERS = ('StandardScaler', 'MinMaxScaler')
+
+# Model artifacts, see save_artifact
+ARTIFACT_FORMAT = 'linear-kernel'
+ARTIFACT_VERSION = 1
+ARTIFACT_HEADER = '.json'
+ARTIFACT_WEIGHTS = '.bin'
+
+
+class LinearKernel:
+    """Evaluates an exported linear sklearn model with plain NumPy.
+
+    Has the same predict / predict_proba interface as the sklearn model it
+    was exported from, without sklearn's input validation.
+
+    Args:
+        coef (np.ndarray): Coefficients, shape of the model's coef_
+        intercept (np.ndarray or float): Intercept, shape of the model's intercept_
+        classes (np.ndarray): Class labels, None for regressors
+        multi_class (str): 'softmax' or 'ovr', how multiclass probabilities are computed
+    """
+
+    def __init__(self, coef, intercept, classes=None, multi_class='softmax'):
+        self.coef = np.asarray(coef, dtype=float)
+        self.intercept = np.asarray(intercept, dtype=float)
+        self.classes = classes
+        self.multi_class = multi_class
+        self.n_features = self.coef.shape[-1]
+
+    def _decision(self, values):
+        return np.dot(np.asarray(values, dtype=float), self.coef.T) + self.intercept
+
+    def predict(self, values):
+        decision = self._decision(values)
+        if self.classes is None:
+            return decision
+        if decision.ndim == 1 or decision.shape[1] == 1:
+            return self.classes[(decision.reshape(-1) > 0).astype(int)]
+        return self.classes[np.argmax(decision, axis=1)]
+
+    def predict_proba(self, values):
+        if self.classes is None:
+            raise AttributeError("Regressors have no predict_proba")
+
+        decision = self._decision(values)
+        if decision.ndim == 1 or decision.shape[1] == 1:
+            positive = 1 / (1 + np.exp(-decision.reshape(-1)))
+            return np.column_stack([1 - positive, positive])
+
+        if self.multi_class == 'ovr':
+            proba = 1 / (1 + np.exp(-decision))
+        else:
+            proba = np.exp(decision - decision.max(axis=1, keepdims=True))
+        return proba / proba.sum(axis=1, keepdims=True)
+
+    def share(self, directory, name):
+        """Moves the coefficients into read-only memory-mapped files, so all
+        processes loading the same model use one copy (use a tmpfs like /dev/shm)
+
+        Args:
+            directory (str): Directory of the files, created if needed
+            name (str): Unique name of the model version
+        """
+        os.makedirs(directory, exist_ok=True)
+        self.coef = _shared_array(self.coef, os.path.join(directory, f"{name}.coef"))
+        self.intercept = _shared_array(self.intercept, os.path.join(directory, f"{name}.intercept"))
+        return self
+
+
+def _shared_array(array, path):
+    # Maps `path` read-only, writing `array` to it first unless another
+    # process already did. Written to a temporary file and renamed, so
+    # readers never see a partial file
+    if not os.path.isfile(path) or os.path.getsize(path) != array.nbytes:
+        tmp_path = f"{path}.{os.getpid()}"
+        shared = np.memmap(tmp_path, dtype=array.dtype, mode='w+', shape=array.size)
+        shared[:] = array.reshape(-1)
+        shared.flush()
+        del shared
+        os.replace(tmp_path, path)
+    return np.memmap(path, dtype=array.dtype, mode='r', shape=array.size).reshape(array.shape)
+
+
+def file_digest(path):
+    """SHA-256 of a file, ties an artifact to the pickle it was converted from"""
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def save_artifact(kernel, root, estimator, source):
+    """Writes a kernel as <root>.json, a small header, and <root>.bin,
+    the coefficients followed by the intercept as raw float64
+
+    Args:
+        kernel (LinearKernel): Kernel to save
+        root (str): Path of the artifact without extension
+        estimator (str): Class name of the sklearn model it was exported from
+        source (str): Path of the .sav file it was converted from
+    """
+    coef = np.ascontiguousarray(kernel.coef, dtype='<f8')
+    intercept = np.ascontiguousarray(kernel.intercept, dtype='<f8')
+    header = {
+        'format': ARTIFACT_FORMAT,
+        'version': ARTIFACT_VERSION,
+        'estimator': estimator,
+        'n_features': kernel.n_features,
+        'dtype': '<f8',
+        'coef_shape': list(coef.shape),
+        'intercept_shape': list(intercept.shape),
+        'classes': None if kernel.classes is None else np.asarray(kernel.classes).tolist(),
+        'multi_class': kernel.multi_class,
+        'source': os.path.basename(source),
+        'source_sha256': file_digest(source),
+    }
+
+    # Weights first, so a header always describes a complete weights file
+    with open(root + ARTIFACT_WEIGHTS + '.tmp', 'wb') as f:
+        f.write(coef.tobytes())
+        f.write(intercept.tobytes())
+    os.replace(root + ARTIFACT_WEIGHTS + '.tmp', root + ARTIFACT_WEIGHTS)
+
+    with open(root + ARTIFACT_HEADER + '.tmp', 'w') as f:
+        json.dump(header, f, indent=2)
+    os.replace(root + ARTIFACT_HEADER + '.tmp', root + ARTIFACT_HEADER)
+
+
+def load_artifact(root, source=None):
+    """Loads a kernel saved by save_artifact. The weights are memory-mapped
+    read-only, so loading copies nothing and processes share the pages
+
+    Args:
+        root (str): Path of the artifact without extension
+        source (str): .sav file the artifact must have been converted from
+
+    Returns:
+        LinearKernel: Raises ValueError if the artifact is of another format
+        or version, was converted from another pickle or is incomplete
+    """
+    with open(root + ARTIFACT_HEADER) as f:
+        header = json.load(f)
+
+    if header.get('format') != ARTIFACT_FORMAT or header.get('version') != ARTIFACT_VERSION:
+        raise ValueError("Unsupported artifact %s version %s" % (header.get('format'), header.get('version')))
+    if source is not None and header['source_sha256'] != file_digest(source):
+        raise ValueError("Converted from another version of %s" % os.path.basename(source))
+
+    dtype = np.dtype(header['dtype'])
+    coef_shape = tuple(header['coef_shape'])
+    intercept_shape = tuple(header['intercept_shape'])
+    coef_size = int(np.prod(coef_shape))
+    size = coef_size + int(np.prod(intercept_shape))
+
+    weights_path = root + ARTIFACT_WEIGHTS
+    if os.path.getsize(weights_path) != size * dtype.itemsize:
+        raise ValueError("Incomplete weights %s" % weights_path)
+
+    weights = np.memmap(weights_path, dtype=dtype, mode='r', shape=(size,))
+    classes = header['classes']
+    return LinearKernel(weights[:coef_size].reshape(coef_shape),
+                        weights[coef_size:].reshape(intercept_shape),
+                        None if classes is None else np.asarray(classes),
+                        header['multi_class'])
+
+
+def _is_linear(model):
+    return (type(model).__module__.startswith('sklearn.linear_model')
+            and hasattr(model, 'coef_') and hasattr(model, 'intercept_'))
+
+
+def _scaler_affine(step, n_features):
+    # Returns (a, b) so that step.transform(x) == x * a + b
+    name = type(step).__name__
+    if name == 'StandardScaler':
+        mean = step.mean_ if step.mean_ is not None else np.zeros(n_features)
+        scale = step.scale_ if step.scale_ is not None else np.ones(n_features)
+        return 1 / scale, -mean / scale
+    return step.scale_, step.min_
+
+
+def export_linear(model):
+    """Exports a linear model, or a pipeline of scalers ending in one,
+    to LinearKernels. Scalers are folded into the coefficients
+
+    Args:
+        model: Unpickled sklearn model
+
+    Returns:
+        list: Candidate LinearKernels, empty if the model is not supported
+    """
+    steps = []
+    if type(model).__name__ == 'Pipeline':
+        steps = [step for _, step in model.steps[:-1]]
+        model = model.steps[-1][1]
+        if any(type(step).__name__ not in SCALERS for step in steps if step is not None):
+            return []
+
+    if not _is_linear(model):
+        return []
+
+    coef = np.asarray(model.coef_, dtype=float)
+    intercept = np.asarray(model.intercept_, dtype=float)
+
+    # Fold the scalers, applied first to last: x -> x * a + b
+    a = np.ones(coef.shape[-1])
+    b = np.zeros(coef.shape[-1])
+    for step in steps:
+        if step is None:
+            continue
+        step_a, step_b = _scaler_affine(step, coef.shape[-1])
+        a, b = a * step_a, b * step_a + step_b
+    intercept = intercept + np.dot(coef, b)
+    coef = coef * a
+
+    if not hasattr(model, 'predict_proba'):
+        # Classifiers without probabilities are not used by this service
+        if hasattr(model, 'classes_'):
+            return []
+        return [LinearKernel(coef, intercept)]
+
+    classes = np.asarray(model.classes_)
+    return [LinearKernel(coef, intercept, classes, multi_class)
+            for multi_class in ('softmax', 'ovr')]
+
+
+def matches(kernel, model, n_probes=32, rtol=1e-6, atol=1e-8):
+    """Checks that a kernel gives the same results as the sklearn model
+
+    Args:
+        kernel (LinearKernel): Exported kernel
+        model: Unpickled sklearn model
+
+    Returns:
+        bool: True if predict (and predict_proba) agree within tolerance
+    """
+    probes = np.random.RandomState(0).uniform(0, 2, (n_probes, kernel.n_features))
+
+    if kernel.classes is None:
+        expected = np.asarray(model.predict(probes), dtype=float)
+        return np.allclose(kernel.predict(probes), expected, rtol=rtol, atol=atol)
+
+    return (np.array_equal(kernel.predict(probes), model.predict(probes))
+            and np.allclose(kernel.predict_proba(probes), model.predict_proba(probes),
+                            rtol=rtol, atol=atol))
+
+
+def compile_model(model):
+    """Returns a NumPy kernel for linear models that pass the self-check,
+    the model itself otherwise
+
+    Args:
+        model: Unpickled sklearn model
+
+    Returns:
+        LinearKernel or the original model
+    """
+    try:
+        for kernel in export_linear(model):
+            if matches(kernel, model):
+                logging.info("Using NumPy kernel for %s" % type(model).__name__)
+                return kernel
+    except Exception as e:
+        logging.error("Failed to export %s - %s" % (type(model).__name__, e))
+
+    return model
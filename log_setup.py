@@ -0,0 +1,112 @@
+# Basic libraries
+import atexit
+import logging
+import os
+import queue
+import threading
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
+
+# Extra fields appended to a log line as key=value when a record has them:
+# logging.info("Batch done", extra={'mac_id': mac_id, 'stage': 'batch', 'latency': 0.012})
+STRUCTURED_FIELDS = ('mac_id', 'stage', 'latency')
+
+LOG_FORMAT = "%(asctime)s - %(levelname)s %(message)s"
+
+
+class StructuredFormatter(logging.Formatter):
+    """LOG_FORMAT followed by the STRUCTURED_FIELDS of the record"""
+
+    def format(self, record):
+        line = super().format(record)
+        fields = []
+        for field in STRUCTURED_FIELDS:
+            value = getattr(record, field, None)
+            if value is None:
+                continue
+            if field == 'latency':
+                fields.append("latency_ms=%.2f" % (value * 1000))
+            else:
+                fields.append(f"{field}={value}")
+        return f"{line} {' '.join(fields)}" if fields else line
+
+
+class SamplingFilter(logging.Filter):
+    """Keeps one record in every 1/rate of each level, e.g. {'DEBUG': 0.01}
+    keeps every 100th debug record. Levels without a rate are all kept
+
+    Args:
+        rates (dict): Level name -> share of records kept, between 0 and 1
+    """
+
+    def __init__(self, rates):
+        super().__init__()
+        self._every = {logging.getLevelName(level): (round(1 / rate) if rate > 0 else 0)
+                       for level, rate in rates.items()}
+        self._seen = {}
+        self._lock = threading.Lock()
+
+    def filter(self, record):
+        every = self._every.get(record.levelno)
+        if every is None or every == 1:
+            return True
+        if every == 0:
+            return False
+        with self._lock:
+            seen = self._seen[record.levelno] = self._seen.get(record.levelno, 0) + 1
+        return seen % every == 1
+
+
+class DroppingQueueHandler(QueueHandler):
+    """QueueHandler that drops records while the queue is full instead of
+    blocking or printing an error for each of them"""
+
+    def __init__(self, log_queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+def configure_logging(log_file, level=logging.INFO, max_bytes=50 * 1024 * 1024,
+                      backup_count=5, queue_size=10000, sample_rates=None):
+    """Sends the records of every thread through a queue to a single thread
+    that writes them to a rotating log file, so logging never waits on disk.
+    Replaces any handlers the root logger already has
+
+    Args:
+        log_file (str): Path of the log file
+        level (int): Lowest level logged
+        max_bytes (int): Size at which the log file is rotated
+        backup_count (int): Number of rotated files kept
+        queue_size (int): Records waiting to be written, more are dropped
+        sample_rates (dict): Per-level sampling, see SamplingFilter
+
+    Returns:
+        QueueListener: Thread writing the records, stopped at exit
+    """
+    log_dir = os.path.dirname(log_file)
+    if log_dir:
+        os.makedirs(log_dir, exist_ok=True)
+
+    file_handler = RotatingFileHandler(log_file, maxBytes=max_bytes, backupCount=backup_count)
+    file_handler.setFormatter(StructuredFormatter(LOG_FORMAT))
+
+    log_queue = queue.Queue(queue_size)
+    queue_handler = DroppingQueueHandler(log_queue)
+    if sample_rates:
+        queue_handler.addFilter(SamplingFilter(sample_rates))
+
+    root = logging.getLogger()
+    for handler in list(root.handlers):
+        root.removeHandler(handler)
+    root.addHandler(queue_handler)
+    root.setLevel(level)
+
+    listener = QueueListener(log_queue, file_handler, respect_handler_level=True)
+    listener.start()
+    atexit.register(listener.stop)
+    return listener
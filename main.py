@@ -1,26 +1,39 @@
 # Basic libraries
+import time
+# Cold start timing, see log_startup
+STARTED = time.perf_counter()
+
 import logging
+import signal
 import threading
-import time
-import pickle
 from warnings import filterwarnings
 from time import sleep
-import numpy as np
 
 # MQTT Library
 import paho.mqtt.client as mqttClient
 
 # Custom modules
-import calculations, psql_func, settings
+import calculations, metrics, psql_func, settings
+from batcher import InferenceBatcher
+from catalog import Catalog
+from device_state import DeviceTable
+from dispatcher import OrderedDispatcher
+from inference_server import InferenceServer
+from log_setup import configure_logging
+from model_registry import BRIX, CLF, ModelRegistry
+from profiling import Profiler, parse_command
+from publisher import Publisher
+from scheduler import DeadlineScheduler
 filterwarnings("ignore")
+IMPORTED = time.perf_counter()
 
 # Logging
-logging.basicConfig(
-    filename=settings.MQTT_LOG_FILE,
-    filemode="a",
-    format="%(asctime)s - %(levelname)s %(message)s",
-    level=logging.INFO,
-)
+configure_logging(settings.MQTT_LOG_FILE,
+                  settings.LOG_LEVEL,
+                  settings.LOG_MAX_BYTES,
+                  settings.LOG_BACKUP_COUNT,
+                  settings.LOG_QUEUE_SIZE,
+                  settings.LOG_SAMPLE_RATES)
 
 # Topics
 SUB_TOPIC = settings.SUB_TOPIC
@@ -37,32 +50,8 @@ MQTT_PORT = settings.MQTT_PORT
 Connected = False
 TIMEOUT = settings.TIMEOUT
 
-device_dictionary = {}
-device_list = []
-
-
-def create_dictionary(mac_id):
-    """Creates a dictionary for every device.
-    Keeps track of message count.
-    Keeps track of time out
-
-    Args:
-        warehouse_id (str): Warehouse ID of the device
-        device_id (str): Device ID of the device
-
-    Returns:
-        dict: Dictionary containing device information
-    """
-
-    
-    return {
-        "mac_id": mac_id,
-        "message_count": 0,
-        "message_limit": settings.MESSAGE_LIMIT,
-        "message_arr": [],
-        "end_time": -1,
-        "pub_topic": f"/{mac_id}",
-    }
+# Batch state of every device, keyed by device name
+devices = DeviceTable(settings.MESSAGE_LIMIT, len(settings.DEVICE_READINGS))
 
 
 def reset_variables(device_name):
@@ -72,14 +61,11 @@ def reset_variables(device_name):
         device_name (str): Combination of warehouseID and deviceID
     """
 
-    global device_dictionary
-
     lock.acquire()
 
     try:
-        device_dictionary[device_name]["message_count"] = 0
-        device_dictionary[device_name]["message_arr"] = []
-        device_dictionary[device_name]["end_time"] = -1
+        devices.reset(device_name)
+        timeout_scheduler.cancel(device_name)
         logging.info('Reset value for %s' % device_name)
     except Exception as e:
         logging.error('Reset for %s failed - %s' % (device_name, e))
@@ -88,6 +74,18 @@ def reset_variables(device_name):
         lock.release()
 
 
+def on_timeout(device_name):
+    """Called by the timeout scheduler when a device's batch is not
+    completed within TIMEOUT seconds
+
+    Args:
+        device_name (str): Key of the device in devices
+    """
+    logging.error(f"Timeout exceeded for {device_name}")
+    metrics.TIMEOUTS.inc()
+    reset_variables(device_name)
+
+
 """
 CALLBACKS
 """
@@ -101,8 +99,7 @@ def on_connect(client, userdata, flags, rc):
         Connected = True
 
     else:
-        logging.error("Connection failed printing rc " )
-        print(rc)
+        logging.error("Connection failed, rc %s" % rc)
 
 
 def on_disconnect(client, userdata, rc):
@@ -114,172 +111,237 @@ def on_disconnect(client, userdata, rc):
         logging.error("Still running printing rc ")
 
 
-def on_message(client, userdata, message):
-    global device_list, device_dictionary
+def handle_boot(client, mac_id):
+    """Boot call from a device.
+    Provides the model it is running on and the formatted (shortened)
+    list of all fruits and varieties
 
-    # Read the message from the device into msg
-    msg = str(message.payload.decode("utf-8"))
-    #Strip mac_id from the last 
-    mac_id = msg.split(",")[-1].strip()
+    Args:
+        client (mqttClient): MQTT client used to send the response
+        mac_id (str): MAC ID of the device
+    """
+    try:
+        #Get the model its currently running on
+        try:
+            device_settings = psql_func.get_device_settings(mac_id)
+            fruit, variety = device_settings.fruit, device_settings.variety
+        except Exception:
+            fruit, variety = psql_func.read_most_recent_fruit_id(mac_id)
+
+        message_to_client = fruit_catalog.boot_response(fruit, variety)
+        pub_topic = f"/{mac_id}"
+        publisher.publish(client, pub_topic, message_to_client, 'boot')
+    except Exception as e:
+        logging.error("BOOT FAIL !!! - %s" % e)
 
 
-    #Boot call from a device
-    #Provide the model its running on+
-    #Provide the formatted(shortened) list of all fruits and varieties
-    if (msg.split(",")[0].strip()=='MR'):
+def handle_model_change(client, mac_id, model_name):
+    """Model change request.
+    Takes model shortened name as input
+
+    Args:
+        client (mqttClient): MQTT client used to send the response
+        mac_id (str): MAC ID of the device
+        model_name (str): Shortened model name, e.g. APPLE[FU]
+    """
+    try:
+        fruit_vid = fruit_catalog.model_id(model_name)
         try:
-            #Get the model its currently running on
-            dev_model_name = psql_func.read_most_recent_fruit_id(msg.split(",")[-1].strip())
-            dev_model_name = dev_model_name[0]+'['+dev_model_name[1][0:2]+']'
-            #print("Model_recieved",dev_model_name)
-            #Get the list of models
-            FRUIT_VARIETY_LIST = psql_func.get_fruit_variety_list()
-            f_v_list = ''
-            #Get the shortened list
-            for i in range(len(FRUIT_VARIETY_LIST)):
-                f_v_list = f_v_list + str(','+FRUIT_VARIETY_LIST[i][0]+'['+(FRUIT_VARIETY_LIST[i][1])[0:2]+']')
-            #print(FRUIT_VARIETY_LIST)
-            message_to_client = f"!{dev_model_name}{f_v_list}"
-            pub_topic = f"/{mac_id}"
-            #print('pub_topic = ',pub_topic)
-            #print("This is the message length ",len(message_to_client))
-            client.publish(pub_topic,message_to_client)
-            #print("Device_informed")
-        except Exception as e:
-            #print(e)
-            logging.error("BOOT FAIL !!!")
-        reset_variables(device_name)
+            new_model_no = psql_func.change_fruit_variety(fruit_vid,mac_id)
+        except Exception:
+            metrics.DB_FAILURES.inc('change_fruit_variety')
+            raise
+        message_to_client = f"@{new_model_no}"
+        pub_topic = f"/{mac_id}"
+        publisher.publish(client, pub_topic, message_to_client, 'model')
+    except Exception as e:
+        logging.error("Failed to change the model - %s" % e)
 
 
-    #Model change request
-    #Takes model shortened name as input
-    elif(msg.split(",")[0].strip()=='MC'):
-        #print("MC started")
-        #print(msg.split(",")[-2].strip())
+def process_batch(client, mac_id, pub_topic, raw_mean_values):
+    """Runs inference on a completed batch of readings, sends the feedback
+    to the device and stores the result.
+    Runs on a dispatcher worker, never on the paho network thread
+
+    Args:
+        client (mqttClient): MQTT client used to send the feedback
+        mac_id (str): MAC ID of the device
+        pub_topic (str): Topic the feedback is published to
+        raw_mean_values (np.ndarray): Mean of the readings in the batch
+    """
+
+    start = time.perf_counter()
+
+    # Get device settings from PSQL Table
+    try:
+        with metrics.STAGE_SECONDS.time('device_settings'):
+            fruit, variety, white_standard, batch_number, vendor_code, device_id, warehouse_id = psql_func.get_device_settings(mac_id)
+
+    except Exception as e:
+        logging.critical("Failed to load device data - %s" % e, extra={'mac_id': mac_id, 'stage': 'device_settings'})
+        metrics.DB_FAILURES.inc('device_settings')
+
+        fruit, variety = 'default', 'default'
+        batch_number, vendor_code = 'default', 'default'
+        white_standard = settings.DEFAULT_WHITE_STANDARD
+
+    # Models of the variety, stored rows keep the device's fruit and variety
+    model_fruit, model_variety = fruit, variety
+    try:
+        brix_model = model_registry.get(BRIX, fruit, variety)
+        clf_model = model_registry.get(CLF, fruit, variety)
+
+    except Exception as e:
+        logging.error("Failed to load models for %s-%s - %s" % (fruit, variety, e), extra={'mac_id': mac_id, 'stage': 'model'})
+        model_fruit, model_variety = 'default', 'default'
+        brix_model = model_registry.get(BRIX, 'default', 'default')
+        clf_model = model_registry.get(CLF, 'default', 'default')
+
+    # Also varieties without their own model files
+    if model_registry.uses_default(model_fruit, model_variety):
+        metrics.MODEL_FALLBACKS.inc()
+
+    # Normalize the message array with respective white standard
+    normalized_values = calculations.normalize_mean(raw_mean_values, white_standard)
+    inference_start = time.perf_counter()
+
+    # Predict brix and classify status, on the inference processes if there are any,
+    # otherwise batched with other devices on the same model
+    prediction = None
+    if inference_server is not None:
         try:
-            variety_list_dict = {'APPLE[GR]':2,'APPLE[SH]':3,'APPLE[FU]':4,'APPLE[GA]':5,'APPLE[RE]':6,'BANANA[RO]':9,'MANGO[AL]':1,'CITRUS[OR]':10,'CITRUS[MO]':11,'WHITE STD[WH]':12,'APPLE[KI]':13,'CITRUS[KI]':14,'GRAPE[GS]':15,'GRAPE[BS]':16,'GRAPE[RE]':17,'GRAPE[TH]':18}
-            fruit_vid = variety_list_dict[msg.split(",")[-2].strip()]
-            new_model_no = psql_func.change_fruit_variety(fruit_vid,msg.split(",")[-1].strip())
-            message_to_client = f"@{new_model_no}"
-            pub_topic = f"/{mac_id}"
-            #print(pub_topic)
-            #print("This is the message ",message_to_client
-            client.publish(pub_topic, message_to_client)
-            #print('done')
+            prediction = inference_server.submit(model_fruit, model_variety, normalized_values).result(settings.INFERENCE_TIMEOUT)
         except Exception as e:
-            #print(e)
-            logging.error("Failed to change the model")
-            reset_variables(device_name)
+            # Timed out or the worker failed, the reading still gets a row and feedback
+            logging.error("Inference process failed, predicting in this process - %r" % e,
+                          extra={'mac_id': mac_id, 'stage': 'inference'})
+    if prediction is None:
+        prediction = inference_batcher.submit((model_fruit, model_variety), normalized_values,
+                                              brix_model, clf_model).result()
+    metrics.STAGE_SECONDS.observe(time.perf_counter() - inference_start, 'inference')
+    predicted_brix, fruit_status = prediction.brix, prediction.status
+    r, g, b = prediction.r, prediction.g, prediction.b
+    p = str(fruit_status)+'% GOOD'
+
+    # Update to DB, before the feedback so a flip after it finds this row
+    try:
+        write_start = time.perf_counter()
+        psql_func.write_data(warehouse_id,
+                             device_id,
+                             raw_mean_values,
+                             predicted_brix,
+                             fruit_status,
+                             fruit,
+                             variety,
+                             batch_number,
+                             vendor_code,
+                             mac_id)
+        metrics.STAGE_SECONDS.observe(time.perf_counter() - write_start, 'write_data')
+
+    except Exception as e:
+        logging.error("Failed to store data in PSQL: %s" % e, extra={'mac_id': mac_id, 'stage': 'write_data'})
+        metrics.DB_FAILURES.inc('write_data')
+
+    # Send feedback
+    message_to_client = f"${round(float(predicted_brix), 2)},{p},{r},{g},{b};"
+    with metrics.STAGE_SECONDS.time('publish'):
+        publisher.publish(client, pub_topic, message_to_client)
+
+    latency = time.perf_counter() - start
+    metrics.STAGE_SECONDS.observe(latency, 'batch')
+    logging.debug("Sent %s" % message_to_client, extra={'mac_id': mac_id, 'stage': 'batch', 'latency': latency})
+
 
+def message_kind(payload):
+    """Kind of a message on SUB_TOPIC: 'MR', 'MC' or 'reading'"""
+    if not payload.startswith(calculations.BINARY_MAGIC):
+        kind = payload.split(b",", 1)[0].strip()
+        if kind in (b'MR', b'MC'):
+            return kind.decode("utf-8")
+    return 'reading'
+
+
+# Boot and model change requests are handled on the device's worker
+# so they stay ordered with its readings
+
+def on_boot_message(client, message):
+    #Strip mac_id from the last 
+    mac_id = message.payload.decode("utf-8").split(",")[-1].strip()
+    metrics.MESSAGES.inc('MR')
+    dispatcher.submit(mac_id, handle_boot, client, mac_id)
 
 
-    # Extract device id and warehouse id
-    #warehouse_id = msg.split(",")[-2].strip()
-    #mac_id = msg.split(",")[-1].strip()
+def on_model_change_message(client, message):
+    fields = message.payload.decode("utf-8").split(",")
+    mac_id = fields[-1].strip()
+    metrics.MESSAGES.inc('MC')
+    dispatcher.submit(mac_id, handle_model_change, client, mac_id, fields[-2].strip())
+
+
+def on_reading(client, message):
+    payload = message.payload
+
+    # Parse the reading straight from the payload
+    start = time.perf_counter()
+    try:
+        if payload.startswith(calculations.BINARY_MAGIC):
+            mac_id, values = calculations.parse_binary_reading(payload)
+        else:
+            mac_id, values = calculations.parse_reading(payload)
+    except Exception as e:
+        metrics.MESSAGES.inc('invalid')
+        logging.error("Failed to parse message %r - %s" % (payload, e))
+        return
+    metrics.MESSAGES.inc('reading')
+    metrics.STAGE_SECONDS.observe(time.perf_counter() - start, 'parse')
+
     # Create device name
     device_name = f"/{mac_id}"
 
-    # Create device dictionary
-    if device_name not in device_list:
-        device_dictionary[device_name] = create_dictionary(mac_id)
-        device_list.append(device_name)
-
-    # Add message to device dictionary's message array
-    device_dictionary[device_name]["message_arr"].append(msg)
-
-    # Increment message count by 1
-    device_dictionary[device_name]["message_count"] += 1
-
-    # If device dictionary's message count is equal to the messsage limit
-
-    if (device_dictionary[device_name]["message_count"]
-            == device_dictionary[device_name]["message_limit"]
-       ):
-        #print('entered if')
-        # Assign the device dictionary parameters to variables
-        #print(device_dictionary)
-        message_arr = device_dictionary[device_name]["message_arr"]
-        pub_topic = device_dictionary[device_name]["pub_topic"]
-    
-        # Get device settings from PSQL Table
-        try:
-            #print('Entered try')
-            fruit, variety, white_standard, batch_number, vendor_code, device_id, warehouse_id = psql_func.get_device_data(mac_id)[0]
-            #print('get_device_data',psql_func.get_device_data(mac_id)[0])
-            #print('warehouse_id',warehouse_id)
-            white_standard = [float(x) for x in white_standard.values()]
-            #print(BRIX_MODEL_DICT[fruit][variety])
-            brix_model = BRIX_MODEL_DICT[fruit][variety]
-            clf_model = CLF_MODEL_DICT[fruit][variety]
+    # Create device state
+    device = devices.get(device_name, mac_id)
 
-        except Exception as e:
-            print('Failed to load device data',e)
-            logging.critical("Failed to load device data - %s" % e)
+    # Add readings to the device's batch
+    devices.add(device, values)
 
-            fruit, variety = 'default', 'default'
-            batch_number, vendor_code = 'default', 'default'
-            white_standard = settings.DEFAULT_WHITE_STANDARD
+    # Start the timeout on the first message of a batch
+    if device.end_time == -1:
+        device.end_time = time.time() + TIMEOUT
+        timeout_scheduler.arm(device_name, TIMEOUT)
+        logging.info(f"Timeout initiated for {device_name}")
 
+    # If the device's message count is equal to the messsage limit
+    if device.message_count == devices.message_limit:
+        # Hand the completed batch to the device's worker and start a new one
+        raw_mean_values = devices.mean(device)
+        reset_variables(device_name)
+        metrics.BATCHES.inc()
 
-            brix_model = BRIX_MODEL_DICT['default']
-            clf_model = CLF_MODEL_DICT['default']
+        dispatcher.submit(mac_id, process_batch, client, mac_id, device_name, raw_mean_values)
 
-        # Normalize the message array with respective white standard
-        raw_mean_values, normalized_values = calculations.normalize_fruit_data(
-            message_arr, white_standard
-        )
 
-        # Predict brix
-        try:
-            predicted_brix = calculations.predict_brix(normalized_values, brix_model)
-        except Exception as e:
-            logging.error("Brix prediction failed - %s" % e)
-            predicted_brix = -1
+# Handler of each kind of message on SUB_TOPIC
+MESSAGE_HANDLERS = {'MR': on_boot_message, 'MC': on_model_change_message, 'reading': on_reading}
 
-        # Assign a category to the brix value
-        #brix_level = calculations.calculate_brix_level(predicted_brix)
 
-        # Classify status
-        try:
-            normalized_values = np.append(normalized_values,predicted_brix ,axis=None)
-            fruit_status,r,g,b = calculations.predict_status(normalized_values, clf_model)
-            p = str(fruit_status)+'% GOOD'
-        except Exception as e:
-            print("error calculating status",e)
-            logging.error("Status classification failed - %s" % e)
-            fruit_status = -1
-
-        # Send feedback
-        print("about to send feedback")
-        #r,g,b = 255,255,255
-        print(f"${round(float(predicted_brix), 2)},{str(fruit_status)},{r},{g},{b};")
-        message_to_client = f"${round(float(predicted_brix), 2)},{p},{r},{g},{b};"
-        print("message_to_client = ",message_to_client)
-        client.publish(pub_topic, message_to_client)
-        #print("printing pridicted brix",predicted_brix)
-
-        # Update to DB
-        try:
-            print('Updating to DB')
-            psql_func.write_data(warehouse_id,
-                                 device_id,
-                                 raw_mean_values,
-                                 predicted_brix,
-                                 fruit_status,
-                                 fruit,
-                                 variety,
-                                 batch_number,
-                                 vendor_code,
-                                 mac_id)
-            print("Successfully uploaded psql data")
+def on_message(client, userdata, message):
+    MESSAGE_HANDLERS[message_kind(message.payload)](client, message)
 
-        except Exception as e:
-            print(e)
-            logging.error("Failed to store data in PSQL: %s" % e)
 
+def on_control(client, userdata, message):
+    """Profiling commands on CONTROL_TOPIC, see profiling.parse_command.
+    The summary is published on PROFILE_RESULT_TOPIC"""
+    try:
+        action, seconds, memory = parse_command(message.payload, settings.PROFILE_MAX_SECONDS)
+    except Exception as e:
+        logging.error("Invalid control message %r - %s" % (message.payload, e))
+        return
 
-        # Resets variables for device
-        reset_variables(device_name)
+    if action == 'stop':
+        profiler.stop()
+    elif not profiler.start(seconds, memory,
+                            lambda summary: client.publish(settings.PROFILE_RESULT_TOPIC, summary)):
+        logging.error("Profiler already running")
 
 
 """
@@ -291,11 +353,15 @@ def create_client():
     # Create client instance
     client = mqttClient.Client()
     client.username_pw_set(USER, password=PASSWORD)
+    client.max_inflight_messages_set(settings.MQTT_MAX_INFLIGHT)
+    client.max_queued_messages_set(settings.MQTT_MAX_QUEUED)
 
     # Callbacks
     client.on_connect = on_connect
     client.on_message = on_message
     client.on_disconnect = on_disconnect
+    # Control messages never reach on_message
+    client.message_callback_add(settings.CONTROL_TOPIC, on_control)
 
     return client
 
@@ -305,108 +371,208 @@ def client_disconnect(client):
     client.disconnect()
 
 
-"""
-MAIN LOOP
-"""
-
-if __name__ == "__main__":
+def start_services():
+    """Creates, loads and starts everything on_message depends on.
+    Also used by the workers of supervisor.py
+    """
+    global lock, timeout_scheduler, fruit_catalog, dispatcher, inference_batcher, model_registry, inference_server, profiler, publisher
 
     # Threading lock (to prevent to write statements occuring at the same time)
     lock = threading.Lock()
 
-    # Create client
-    client = create_client()
+    # Fires on_timeout for devices that do not complete a batch in time
+    timeout_scheduler = DeadlineScheduler(on_timeout, name="device-timeouts")
 
-    # Connect
-    client.connect(BROKER_ADDRESS, port=MQTT_PORT)
-    logging.info(f"Connected via Script ({USER})")
+    # Fruit/variety catalog for boot responses and model changes
+    fruit_catalog = Catalog(settings.CATALOG_REFRESH_INTERVAL, settings.CATALOG_CHANNEL)
 
-    # Subscribe to MQTT Topic
-    client.subscribe(SUB_TOPIC)
+    # Runs completed batches off the paho network thread, in order per device
+    dispatcher = OrderedDispatcher(settings.DISPATCH_WORKERS,
+                                   settings.DISPATCH_QUEUE_SIZE,
+                                   settings.DISPATCH_SUBMIT_TIMEOUT)
+
+    # Groups predictions of devices using the same model
+    inference_batcher = InferenceBatcher(settings.INFERENCE_BATCH_WINDOW,
+                                         settings.INFERENCE_BATCH_SIZE)
 
-    # Load pickle models for brix
+    # Brix and classification models, shared between varieties
+    model_registry = ModelRegistry(settings.MODEL_DIR,
+                                   {BRIX: settings.DEFAULT_BRIX_MODEL, CLF: settings.DEFAULT_CLF_MODEL},
+                                   settings.MODEL_MEMORY_BUDGET,
+                                   settings.MODEL_FAST_PATH,
+                                   settings.MODEL_SHARED_DIR,
+                                   settings.MODEL_ARTIFACTS,
+                                   settings.MODEL_RECHECK_INTERVAL)
+
+    # PSQL_POOL_MIN connections up front, the pool opens the others on demand
     try:
+        psql_func.pool.open()
+    except Exception as e:
+        logging.error("Failed to open PSQL connections - %s" % e)
+
+    # Stops here rather than dropping every batch
+    psql_func.check_schema()
+
+    # Load models, varieties added later are loaded on first use
+    timings = {'imports': IMPORTED - STARTED}
+    timings.update(load_startup())
+
+    # Forked now, after the models are loaded and before the threads start
+    inference_server = None
+    if settings.INFERENCE_PROCESSES:
+        inference_server = InferenceServer(model_registry, settings.INFERENCE_PROCESSES)
+        inference_server.start()
+
+    # Sends the feedback, newest message per device only
+    publisher = Publisher(settings.PUBLISH_QUEUE_SIZE,
+                          settings.PUBLISH_RETRY_INTERVAL,
+                          metrics.PUBLISH_DROPS.inc)
+
+    # Idle until switched on through CONTROL_TOPIC
+    profiler = Profiler(settings.PROFILE_INTERVAL, settings.PROFILE_TOP, settings.PROFILE_DIR)
+
+    # Read when the metrics are scraped
+    metrics.ACTIVE_DEVICES.set_function(lambda: len(timeout_scheduler))
+    metrics.QUEUE_DEPTH.set_function(dispatcher.queue_depth)
+    metrics.PUBLISH_QUEUE.set_function(publisher.queue_depth)
+    if settings.METRICS_PORT:
+        try:
+            metrics.start_http_server(settings.METRICS_PORT, settings.METRICS_ADDRESS)
+        except OSError as e:
+            logging.error("Failed to serve metrics on port %d - %s" % (settings.METRICS_PORT, e))
+
+    timeout_scheduler.start()
+    inference_batcher.start()
+    psql_func.writer.start()
+    publisher.start()
+    dispatcher.start()
+    fruit_catalog.start()
+
+    log_startup(timings)
 
-        BRIX_MODEL_DICT = {'default': settings.DEFAULT_BRIX_MODEL}
-        CLF_MODEL_DICT = {'default': settings.DEFAULT_CLF_MODEL}
 
+def load_startup():
+    """Loads the catalog and the models, also retried by wait_until_ready
+
+    Returns:
+        dict: Seconds taken by each step
+    """
+    timings = {}
+
+    start = time.perf_counter()
+    try:
         # List of tuples -> [(fruit, variety), (fruit, variety)]
-        FRUIT_VARIETY_LIST = psql_func.get_fruit_variety_list()
+        fruit_catalog.load()
+    except Exception as e:
+        logging.error("Failed to load the catalog - %s" % e)
+    timings['catalog'] = time.perf_counter() - start
 
-        DEFAULT_BRIX_MODEL = settings.DEFAULT_BRIX_MODEL
-        DEFAULT_CLF_MODEL = settings.DEFAULT_CLF_MODEL
-        print(FRUIT_VARIETY_LIST)
+    # Default models first, then the varieties' models in parallel
+    start = time.perf_counter()
+    try:
+        files = model_registry.preload(fruit_catalog.varieties if settings.MODEL_PRELOAD else [],
+                                       settings.MODEL_PRELOAD_WORKERS)
+        logging.info("Loaded %d model files" % files)
 
-        for fruit, variety in FRUIT_VARIETY_LIST:
+        for path, size, varieties, idle in model_registry.report():
+            logging.info("Model %s - %d bytes, used by %d varieties" % (path, size, varieties))
 
-            # Create dictionary for fruit if it doesn't exist
-            if fruit not in BRIX_MODEL_DICT:
-                BRIX_MODEL_DICT[fruit] = {}
+    except Exception as e:
+        logging.error("Failed to load models - %s" % e)
+    timings['models'] = time.perf_counter() - start
 
-            BRIX_MODEL_DICT[fruit][variety] = None
+    return timings
 
-            # Create dictionary for fruit if it doesn't exist
-            if fruit not in CLF_MODEL_DICT:
-                CLF_MODEL_DICT[fruit] = {}
 
-            CLF_MODEL_DICT[fruit][variety] = None
+def log_startup(timings):
+    """Logs and exports the seconds each startup step took"""
+    timings['total'] = time.perf_counter() - STARTED
+    for stage, seconds in timings.items():
+        metrics.STARTUP_SECONDS.set(seconds, stage)
+    logging.info("Startup took %s" % ', '.join("%s %.2fs" % item for item in timings.items()))
 
-            # Assign models to variables
-            brix_file = f"{settings.MODEL_DIR}BRIX_{fruit}_{variety}.sav"
-            clf_file = f"{settings.MODEL_DIR}CLF_{fruit}_{variety}.sav"
 
-            # Load models and store in respective dictionary
-            try:
-                BRIX_MODEL_DICT[fruit][variety] = pickle.load(open(brix_file, 'rb'))
-            # Else, load default model and store it in respective dictionary
-            except:
-                BRIX_MODEL_DICT[fruit][variety] = pickle.load(open(DEFAULT_BRIX_MODEL, 'rb'))
-                print("Failed to load model",fruit,variety)
-                logging.info("Using default brix model for %s-%s" %(fruit, variety))
+def not_ready():
+    """What messages cannot be handled without, an empty list once ready"""
+    missing = []
+    if not fruit_catalog.varieties:
+        missing.append('catalog')
+    for kind in (BRIX, CLF):
+        if not model_registry.is_loaded(kind, 'default', 'default'):
+            missing.append(f"default {kind.lower()} model")
+    return missing
 
-            # Load models and store in respective dictionary
-            try:
-                CLF_MODEL_DICT[fruit][variety] = pickle.load(open(clf_file, 'rb'))
-            # Else, load default model and store it in respective dictionary
-            except:
-                print("Failed to load clfmodel",fruit,variety)
-                CLF_MODEL_DICT[fruit][variety] = pickle.load(open(DEFAULT_CLF_MODEL, 'rb'))
-                logging.info("Using default clf model for %s-%s" %(fruit, variety))
 
-        logging.info("Models loaded")
+def wait_until_ready(timeout, retry_interval):
+    """Readiness gate passed before subscribing. Retries load_startup
+    until not_ready() is empty
 
-    except Exception as e:
-        logging.error("Failed to load models - %s" % e)
+    Returns:
+        bool: False if still not ready after timeout seconds
+    """
+    deadline = time.monotonic() + timeout
+    missing = not_ready()
+    while missing:
+        if time.monotonic() >= deadline:
+            logging.critical("Not ready after %ds, missing %s" % (timeout, ', '.join(missing)))
+            return False
+
+        logging.error("Not ready, missing %s, retrying in %ds" % (', '.join(missing), retry_interval))
+        sleep(retry_interval)
+        load_startup()
+        missing = not_ready()
+
+    logging.info("Ready")
+    return True
+
+
+def stop_services():
+    """Stops what start_services started, finishing queued work"""
+    profiler.stop()
+    timeout_scheduler.stop()
+    dispatcher.stop()
+    publisher.stop()
+    inference_batcher.stop()
+    if inference_server is not None:
+        inference_server.stop()
+    fruit_catalog.stop()
+    psql_func.writer.close()
+    psql_func.pool.close()
 
 
-    # Start listening
-    client.loop_start()
+"""
+MAIN LOOP
+"""
 
-    # Time out functionality
-    while True:
+if __name__ == "__main__":
 
-        for device_name in device_list:
+    # systemctl stop sends SIGTERM, handled like Ctrl+C so stop_services runs
+    signal.signal(signal.SIGTERM, signal.default_int_handler)
 
-            end_time = device_dictionary[device_name]["end_time"]
-            message_count = device_dictionary[device_name]["message_count"]
-            message_limit = device_dictionary[device_name]["message_limit"]
+    start_services()
 
-            # If device has sent one or more messages
-            if message_count >= 1:
+    # Subscribe only once messages can be handled
+    if not wait_until_ready(settings.READY_TIMEOUT, settings.READY_RETRY_INTERVAL):
+        stop_services()
+        raise SystemExit(1)
 
-                # If timeout has not been set (when message_count == 1)
-                if end_time == -1:
-                    # Sets end_time to current time + TIMEOUT
-                    device_dictionary[device_name]["end_time"] = time.time() + TIMEOUT
-                    logging.info(f"Timeout initiated for {device_name}")
+    # Create client
+    client = create_client()
 
-                # If timeout has been set
-                if end_time != -1:
-                    # If time is past the end_time, resets the variables
-                
-                    if time.time() > end_time:
-                            logging.error(f"Timeout exceeded for {device_name}")
-                            reset_variables(device_name)
+    # Connect
+    client.connect(BROKER_ADDRESS, port=MQTT_PORT)
+    logging.info(f"Connected via Script ({USER})")
 
-    client.loop_stop()
-    client.disconnect()
+    # Subscribe to MQTT Topic
+    client.subscribe(SUB_TOPIC)
+    client.subscribe(settings.CONTROL_TOPIC)
+
+    # Start listening
+    try:
+        client.loop_forever()
+    finally:
+        # Keep the network loop running while the queued feedback is sent
+        client.loop_start()
+        stop_services()
+        client.loop_stop()
+        client.disconnect()
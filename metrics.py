@@ -0,0 +1,195 @@
+# Basic libraries
+import bisect
+import logging
+import threading
+import time
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Latency buckets in seconds, from 100us to 10s
+DEFAULT_BUCKETS = (0.0001, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05,
+                   0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+# Every metric created, in creation order
+_metrics = []
+
+
+class _Metric:
+    """Base of the metrics, one value per combination of label values"""
+
+    kind = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+        _metrics.append(self)
+
+    def _labels(self, label_values):
+        if not self.labelnames:
+            return ''
+        pairs = ','.join('%s="%s"' % (name, value) for name, value in zip(self.labelnames, label_values))
+        return '{%s}' % pairs
+
+    def samples(self):
+        """(suffix, labels, value) of every sample"""
+        with self._lock:
+            items = list(self._values.items())
+        return [('', self._labels(label_values), value) for label_values, value in items]
+
+
+class Counter(_Metric):
+    """Value that only goes up, e.g. messages received"""
+
+    kind = 'counter'
+
+    def __init__(self, name, documentation, labelnames=()):
+        super().__init__(name, documentation, labelnames)
+        if not self.labelnames:
+            self._values[()] = 0
+
+    def inc(self, *label_values, amount=1):
+        with self._lock:
+            self._values[label_values] = self._values.get(label_values, 0) + amount
+
+
+class Gauge(_Metric):
+    """Value that goes up and down. With `function`, the value is read from
+    it when the metrics are scraped, so nothing is done on the hot path
+
+    Args:
+        function (callable): Returns the current value, for gauges without labels
+    """
+
+    kind = 'gauge'
+
+    def __init__(self, name, documentation, labelnames=(), function=None):
+        super().__init__(name, documentation, labelnames)
+        self.function = function
+
+    def set(self, value, *label_values):
+        with self._lock:
+            self._values[label_values] = value
+
+    def set_function(self, function):
+        self.function = function
+
+    def samples(self):
+        if self.function is None:
+            return super().samples()
+        try:
+            return [('', '', self.function())]
+        except Exception as e:
+            logging.error("Gauge %s failed - %s" % (self.name, e))
+            return []
+
+
+class Histogram(_Metric):
+    """Distribution of observed values, e.g. latencies in seconds
+
+    Args:
+        buckets (tuple): Upper bounds of the buckets, ascending
+    """
+
+    kind = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, *label_values):
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            counts = self._values.get(label_values)
+            if counts is None:
+                # Bucket counts, +Inf bucket last, then the sum
+                counts = self._values[label_values] = [0] * (len(self.buckets) + 1) + [0.0]
+            counts[index] += 1
+            counts[-1] += value
+
+    @contextmanager
+    def time(self, *label_values):
+        """Observes the seconds spent in the with block"""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, *label_values)
+
+    def samples(self):
+        with self._lock:
+            items = [(label_values, list(counts)) for label_values, counts in self._values.items()]
+
+        samples = []
+        for label_values, counts in items:
+            labels = list(zip(self.labelnames, label_values))
+            cumulative = 0
+            for bound, count in zip(self.buckets + ('+Inf',), counts):
+                cumulative += count
+                pairs = ','.join('%s="%s"' % pair for pair in labels + [('le', bound)])
+                samples.append(('_bucket', '{%s}' % pairs, cumulative))
+            samples.append(('_sum', self._labels(label_values), counts[-1]))
+            samples.append(('_count', self._labels(label_values), cumulative))
+        return samples
+
+
+def render():
+    """All metrics in the Prometheus text exposition format"""
+    lines = []
+    for metric in _metrics:
+        lines.append(f"# HELP {metric.name} {metric.documentation}")
+        lines.append(f"# TYPE {metric.name} {metric.kind}")
+        for suffix, labels, value in metric.samples():
+            lines.append(f"{metric.name}{suffix}{labels} {value}")
+    return '\n'.join(lines) + '\n'
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        if self.path.split('?')[0] != '/metrics':
+            self.send_error(404)
+            return
+        body = render().encode("utf-8")
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        # Scrapes are not worth a log line
+        pass
+
+
+def start_http_server(port, address='127.0.0.1'):
+    """Serves the metrics on http://<address>:<port>/metrics from a daemon thread
+
+    Returns:
+        ThreadingHTTPServer: Call shutdown() to stop it
+    """
+    server = ThreadingHTTPServer((address, port), _MetricsHandler)
+    server.daemon_threads = True
+    thread = threading.Thread(target=server.serve_forever, name="metrics-http", daemon=True)
+    thread.start()
+    logging.info("Serving metrics on %s:%d" % (address, port))
+    return server
+
+
+# Metrics of the ingestion service
+MESSAGES = Counter('ingest_messages_total', 'Messages received, by kind', ['kind'])
+BATCHES = Counter('ingest_batches_total', 'Completed batches of readings')
+TIMEOUTS = Counter('ingest_timeouts_total', 'Batches discarded after TIMEOUT')
+DB_FAILURES = Counter('ingest_db_failures_total', 'Failed PSQL operations', ['operation'])
+MODEL_FALLBACKS = Counter('ingest_model_fallbacks_total', 'Batches predicted with a default model file')
+STAGE_SECONDS = Histogram('ingest_stage_seconds', 'Seconds spent in each stage of the pipeline', ['stage'])
+ACTIVE_DEVICES = Gauge('ingest_active_devices', 'Devices with a batch in progress')
+QUEUE_DEPTH = Gauge('ingest_queue_depth', 'Jobs waiting for a dispatcher worker')
+PUBLISH_QUEUE = Gauge('ingest_publish_queue_depth', 'Messages waiting to be published')
+PUBLISH_DROPS = Counter('ingest_publish_drops_total', 'Outgoing messages dropped, by reason', ['reason'])
+SPOOL_BYTES = Gauge('ingest_spool_bytes', 'Bytes of spool segments on disk')
+SPOOL_ROWS = Counter('ingest_spool_rows_total', 'Rows spooled, replayed or dropped', ['operation'])
+STARTUP_SECONDS = Gauge('ingest_startup_seconds', 'Seconds taken by each startup step', ['stage'])
+WRITE_BUFFER = Gauge('ingest_write_buffer_rows', 'Rows waiting to be written to PSQL')
@@ -0,0 +1,12 @@
+-- Primary keys of warehouse_data are allocated from this sequence in blocks
+-- (see psql_func.IdAllocator) instead of reading MAX(id) before every insert.
+-- Safe to run more than once.
+
+CREATE SEQUENCE IF NOT EXISTS warehouse_data_id_seq OWNED BY warehouse_data.id;
+
+-- Continue after the IDs that were assigned by read_most_recent_id() + 1
+SELECT setval('warehouse_data_id_seq',
+              GREATEST((SELECT COALESCE(MAX(id), 0) FROM warehouse_data),
+                       (SELECT last_value FROM warehouse_data_id_seq)));
+
+ALTER TABLE warehouse_data ALTER COLUMN id SET DEFAULT nextval('warehouse_data_id_seq');
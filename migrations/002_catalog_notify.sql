@@ -0,0 +1,20 @@
+-- Notifies the ingestion service (catalog.Catalog) whenever the fruit or
+-- variety catalog changes, so boot responses and MC lookups refresh at once.
+-- Safe to run more than once.
+
+CREATE OR REPLACE FUNCTION notify_catalog_changed() RETURNS trigger AS $$
+BEGIN
+    PERFORM pg_notify('catalog_changed', TG_TABLE_NAME);
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS fruits_catalog_changed ON fruits;
+CREATE TRIGGER fruits_catalog_changed
+    AFTER INSERT OR UPDATE OR DELETE OR TRUNCATE ON fruits
+    FOR EACH STATEMENT EXECUTE PROCEDURE notify_catalog_changed();
+
+DROP TRIGGER IF EXISTS fruit_varieties_catalog_changed ON fruit_varieties;
+CREATE TRIGGER fruit_varieties_catalog_changed
+    AFTER INSERT OR UPDATE OR DELETE OR TRUNCATE ON fruit_varieties
+    FOR EACH STATEMENT EXECUTE PROCEDURE notify_catalog_changed();
@@ -0,0 +1,23 @@
+-- Last row of warehouse_data written for each device, upserted by
+-- psql_func.BufferedWriter in the same transaction as the rows, so
+-- psql_func.flip_status can update the row by primary key.
+-- Safe to run more than once.
+
+CREATE TABLE IF NOT EXISTS device_last_reading (
+    warehouse_id TEXT NOT NULL,
+    device_id TEXT NOT NULL,
+    row_id BIGINT NOT NULL,
+    PRIMARY KEY (warehouse_id, device_id)
+);
+
+-- Start from the rows written before this migration
+INSERT INTO device_last_reading (warehouse_id, device_id, row_id)
+SELECT warehouse_id, device_id, MAX(id) FROM warehouse_data
+GROUP BY warehouse_id, device_id
+ON CONFLICT (warehouse_id, device_id) DO NOTHING;
+
+-- Fallback of flip_status for devices without a device_last_reading row.
+-- CONCURRENTLY does not lock out the writers but cannot run inside a
+-- transaction block, run this file with psql without --single-transaction.
+CREATE INDEX CONCURRENTLY IF NOT EXISTS warehouse_data_device_id_desc
+    ON warehouse_data (warehouse_id, device_id, id DESC);
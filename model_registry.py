@@ -0,0 +1,248 @@
+# Basic libraries
+import logging
+import os
+import pickle
+import threading
+import time
+from collections import OrderedDict, namedtuple
+from concurrent.futures import ThreadPoolExecutor
+
+# Custom modules
+from linear_models import ARTIFACT_HEADER, ARTIFACT_WEIGHTS, LinearKernel, compile_model, load_artifact
+
+# Loaded model file
+LoadedModel = namedtuple('LoadedModel', ['path', 'model', 'size'])
+
+BRIX = 'BRIX'
+CLF = 'CLF'
+
+
+class ModelRegistry:
+    """Loads brix and classification models on demand and shares them.
+
+    Every distinct model file is loaded once, however many varieties use it,
+    so all varieties without their own file share the default model.
+    Models are loaded on first use and the least recently used ones are
+    evicted once the loaded models exceed `memory_budget` bytes.
+    The default models are never evicted.
+    A model's size is approximated by the size of its pickle file.
+
+    Args:
+        model_dir (str): Directory containing <KIND>_<FRUIT>_<VARIETY>.sav files
+        default_models (dict): Default model file per kind (BRIX, CLF)
+        memory_budget (int): Bytes of models to keep loaded
+        fast_path (bool): Evaluate linear models with NumPy, see linear_models
+        shared_dir (str): Directory where the weights of NumPy kernels are
+            memory-mapped, shared by every process loading the same model
+        artifacts (bool): Memory-map the artifact next to a .sav file
+            (see convert_models.py) instead of unpickling it, when there is
+            one converted from that .sav
+        recheck_interval (float): Seconds after which a variety using a
+            default model is checked again for a file of its own
+    """
+
+    def __init__(self, model_dir, default_models, memory_budget, fast_path=False, shared_dir=None,
+                 artifacts=False, recheck_interval=60):
+        self.model_dir = model_dir
+        self.default_models = default_models
+        self.memory_budget = memory_budget
+        self.fast_path = fast_path
+        self.shared_dir = shared_dir
+        self.artifacts = artifacts
+        self.recheck_interval = recheck_interval
+
+        # Varieties with their own file, and when the others were last checked
+        self._paths = {}
+        self._fallbacks = {}
+        self._loaded = OrderedDict()
+        self._last_used = {}
+        self._path_locks = {}
+        self._lock = threading.Lock()
+
+    def path(self, kind, fruit, variety):
+        """Model file used for a variety, the default one if it has none.
+        A file added for a variety is used within recheck_interval seconds"""
+        key = (kind, fruit, variety)
+        with self._lock:
+            path = self._paths.get(key)
+            if path is not None:
+                return path
+
+            if fruit == 'default':
+                path = self._paths[key] = os.path.realpath(self.default_models[kind])
+                return path
+
+            default = os.path.realpath(self.default_models[kind])
+            checked_at = self._fallbacks.get(key)
+            now = time.monotonic()
+            if checked_at is not None and now - checked_at < self.recheck_interval:
+                return default
+
+            path = f"{self.model_dir}{kind}_{fruit}_{variety}.sav"
+            if not os.path.isfile(path):
+                if checked_at is None:
+                    logging.info("Using default %s model for %s-%s" % (kind.lower(), fruit, variety))
+                self._fallbacks[key] = now
+                return default
+
+            if checked_at is not None:
+                logging.info("Found %s model for %s-%s" % (kind.lower(), fruit, variety))
+                del self._fallbacks[key]
+            path = self._paths[key] = os.path.realpath(path)
+            return path
+
+    def uses_default(self, fruit, variety):
+        """True if a variety is predicted with a default model file"""
+        return any(self.path(kind, fruit, variety) == os.path.realpath(path)
+                   for kind, path in self.default_models.items())
+
+    def get(self, kind, fruit, variety):
+        """Returns the model of a variety, loading it if needed
+
+        Args:
+            kind (str): BRIX or CLF
+            fruit (str): Fruit name, 'default' for the default model
+            variety (str): Variety name
+
+        Returns:
+            model: Unpickled sklearn model
+        """
+        path = self.path(kind, fruit, variety)
+
+        with self._lock:
+            loaded = self._loaded.get(path)
+            if loaded is not None:
+                self._loaded.move_to_end(path)
+                self._last_used[path] = time.time()
+                return loaded.model
+            path_lock = self._path_locks.setdefault(path, threading.Lock())
+
+        # Only one thread loads a given file, others wait for it
+        with path_lock:
+            with self._lock:
+                loaded = self._loaded.get(path)
+            if loaded is None:
+                loaded = self._load(path)
+                with self._lock:
+                    self._loaded[path] = loaded
+                    self._evict()
+
+        with self._lock:
+            self._last_used[path] = time.time()
+        return loaded.model
+
+    def preload(self, varieties, workers=1):
+        """Loads the default models, then the models of the given varieties
+        on `workers` threads. The defaults are loaded first, so the modules
+        the pickles need are imported once, before the threads start
+
+        Args:
+            varieties (list): (fruit, variety) tuples
+            workers (int): Number of files loaded at the same time
+
+        Returns:
+            int: Number of distinct model files loaded
+        """
+        loaded = set()
+        for kind in self.default_models:
+            self.get(kind, 'default', 'default')
+            loaded.add(self.path(kind, 'default', 'default'))
+
+        # One job per file, varieties sharing a file wait for the same load
+        jobs = {}
+        for kind in self.default_models:
+            for fruit, variety in varieties:
+                path = self.path(kind, fruit, variety)
+                if path not in loaded:
+                    jobs.setdefault(path, (kind, fruit, variety))
+
+        with ThreadPoolExecutor(max(workers, 1), thread_name_prefix="model-preload") as executor:
+            futures = {path: executor.submit(self.get, *key) for path, key in jobs.items()}
+            for path, future in futures.items():
+                try:
+                    future.result()
+                    loaded.add(path)
+                except Exception as e:
+                    kind, fruit, variety = jobs[path]
+                    logging.error("Failed to load %s model for %s-%s - %s" % (kind.lower(), fruit, variety, e))
+        return len(loaded)
+
+    def is_loaded(self, kind, fruit, variety):
+        """True if the model of a variety is loaded, without loading it"""
+        path = self.path(kind, fruit, variety)
+        with self._lock:
+            return path in self._loaded
+
+    def report(self):
+        """Loaded models, least recently used first
+
+        Returns:
+            list: (path, size in bytes, number of varieties using it, seconds since last use)
+        """
+        now = time.time()
+        with self._lock:
+            users = {}
+            for path in self._paths.values():
+                users[path] = users.get(path, 0) + 1
+            for kind, _, _ in self._fallbacks:
+                path = os.path.realpath(self.default_models[kind])
+                users[path] = users.get(path, 0) + 1
+            return [(loaded.path, loaded.size, users.get(loaded.path, 0),
+                     round(now - self._last_used.get(loaded.path, now), 1))
+                    for loaded in self._loaded.values()]
+
+    def after_fork(self):
+        """Replaces the locks in a forked child, threads of the parent may
+        have held them at the time of the fork"""
+        self._lock = threading.Lock()
+        self._path_locks = {}
+
+    def loaded_size(self):
+        with self._lock:
+            return sum(loaded.size for loaded in self._loaded.values())
+
+    def _load(self, path):
+        start = time.time()
+        model = self._load_artifact(path) if self.artifacts else None
+        if model is not None:
+            # Already memory-mapped, shared through the page cache
+            size = os.path.getsize(os.path.splitext(path)[0] + ARTIFACT_WEIGHTS)
+            logging.info("Loaded model artifact of %s (%d bytes) in %.3fs" % (path, size, time.time() - start))
+            return LoadedModel(path, model, size)
+
+        with open(path, 'rb') as model_file:
+            model = pickle.load(model_file)
+        if self.fast_path:
+            model = compile_model(model)
+        stat = os.stat(path)
+        if self.shared_dir and isinstance(model, LinearKernel):
+            # Size and mtime tell versions of a model file apart
+            model.share(self.shared_dir, f"{os.path.basename(path)}-{stat.st_size}-{stat.st_mtime_ns}")
+        size = stat.st_size
+        logging.info("Loaded model %s (%d bytes) in %.3fs" % (path, size, time.time() - start))
+        return LoadedModel(path, model, size)
+
+    def _load_artifact(self, path):
+        # None when there is no usable artifact, the .sav is loaded instead
+        root = os.path.splitext(path)[0]
+        if not os.path.isfile(root + ARTIFACT_HEADER):
+            return None
+        try:
+            return load_artifact(root, path)
+        except (OSError, ValueError, KeyError) as e:
+            logging.error("Ignoring model artifact of %s - %s" % (path, e))
+            return None
+
+    def _evict(self):
+        pinned = {os.path.realpath(path) for path in self.default_models.values()}
+        total = sum(loaded.size for loaded in self._loaded.values())
+
+        # Least recently used first, the newest model always stays
+        for path in list(self._loaded)[:-1]:
+            if total <= self.memory_budget:
+                break
+            if path in pinned:
+                continue
+            total -= self._loaded.pop(path).size
+            self._last_used.pop(path, None)
+            logging.info("Evicted model %s" % path)
@@ -0,0 +1,179 @@
+# Basic libraries
+import json
+import logging
+import os
+import sys
+import threading
+import time
+import tracemalloc
+from collections import Counter
+from datetime import datetime
+
+# Threads waiting in these modules are idle and not sampled
+IDLE_MODULES = ('threading.py', 'queue.py', 'selectors.py')
+
+
+def parse_command(payload, max_seconds):
+    """Parses a message of the control topic
+
+    Accepts JSON, e.g. {"action": "profile", "seconds": 30, "memory": true},
+    or the same as text, e.g. b'profile 30 memory'. `action` is profile or stop
+
+    Returns:
+        tuple: action, seconds (at most max_seconds), memory
+    """
+    text = payload.decode("utf-8").strip()
+    if text.startswith('{'):
+        command = json.loads(text)
+        action = command.get('action', 'profile')
+        seconds = float(command.get('seconds', max_seconds))
+        memory = bool(command.get('memory', False))
+    else:
+        words = text.split()
+        action = words[0] if words else 'profile'
+        seconds = float(words[1]) if len(words) > 1 else max_seconds
+        memory = 'memory' in words[2:]
+
+    if action not in ('profile', 'stop'):
+        raise ValueError("Unknown profiling action %r" % action)
+    return action, min(max(seconds, 0), max_seconds), memory
+
+
+class Profiler:
+    """Sampling CPU profiler with optional tracemalloc snapshots, switched
+    on for a bounded window while the service runs.
+
+    Every `interval` seconds the stacks of all other threads are sampled
+    with sys._current_frames(), except threads waiting in IDLE_MODULES.
+    A function's self count is the samples in which it was running, its
+    total count the samples in which it was on the stack. Nothing runs and
+    no hooks are installed outside a window.
+
+    Args:
+        interval (float): Seconds between samples
+        top (int): Number of functions and allocation sites in the summary
+        output_dir (str): Directory the summaries are written to, None to not write them
+    """
+
+    def __init__(self, interval, top, output_dir=None):
+        self.interval = interval
+        self.top = top
+        self.output_dir = output_dir
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+        self._thread = None
+
+    @property
+    def running(self):
+        return self._thread is not None and self._thread.is_alive()
+
+    def start(self, seconds, memory=False, on_done=None):
+        """Profiles for `seconds` in a background thread
+
+        Args:
+            seconds (float): Length of the window
+            memory (bool): Also trace allocations with tracemalloc
+            on_done (callable): Called with the summary text at the end
+
+        Returns:
+            bool: False if a window is already running
+        """
+        with self._lock:
+            if self.running:
+                return False
+            self._stopped.clear()
+            self._thread = threading.Thread(target=self._run, args=(seconds, memory, on_done),
+                                            name="profiler", daemon=True)
+            self._thread.start()
+        logging.info("Profiling for %ss%s" % (seconds, " with tracemalloc" if memory else ""))
+        return True
+
+    def stop(self):
+        """Ends the current window early, its summary is still produced"""
+        self._stopped.set()
+
+    def _run(self, seconds, memory, on_done):
+        if memory:
+            tracemalloc.start(10)
+
+        self_counts = Counter()
+        total_counts = Counter()
+        module_counts = Counter()
+        samples = idle = 0
+        own_id = threading.get_ident()
+        start = time.monotonic()
+        deadline = start + seconds
+
+        while not self._stopped.is_set() and time.monotonic() < deadline:
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == own_id:
+                    continue
+                if os.path.basename(frame.f_code.co_filename) in IDLE_MODULES:
+                    idle += 1
+                    continue
+                samples += 1
+                self_counts[_location(frame)] += 1
+                module_counts[os.path.basename(frame.f_code.co_filename)] += 1
+
+                # Count recursive functions once per sample
+                seen = set()
+                while frame is not None:
+                    location = _location(frame)
+                    if location not in seen:
+                        seen.add(location)
+                        total_counts[location] += 1
+                    frame = frame.f_back
+            self._stopped.wait(self.interval)
+
+        snapshot = None
+        if memory:
+            snapshot = tracemalloc.take_snapshot()
+            tracemalloc.stop()
+
+        summary = self._summary(time.monotonic() - start, samples, idle, self_counts,
+                                total_counts, module_counts, snapshot)
+        self._write(summary)
+        if on_done is not None:
+            try:
+                on_done(summary)
+            except Exception as e:
+                logging.error("Failed to publish the profile - %s" % e)
+
+    def _summary(self, elapsed, samples, idle, self_counts, total_counts, module_counts, snapshot):
+        lines = [f"Profile of process {os.getpid()}: {elapsed:.1f}s, {samples} samples, {idle} idle"]
+        if samples:
+            lines.append("")
+            lines.append("Top functions by samples running (self) and on the stack (total):")
+            for location, count in self_counts.most_common(self.top):
+                lines.append(f"{100 * count / samples:6.1f}% self {100 * total_counts[location] / samples:6.1f}% total  {location}")
+
+            lines.append("")
+            lines.append("Samples running in each module:")
+            for module, count in module_counts.most_common(self.top):
+                lines.append(f"{100 * count / samples:6.1f}%  {module}")
+
+        if snapshot is not None:
+            lines.append("")
+            lines.append("Top allocation sites:")
+            for stat in snapshot.statistics('lineno')[:self.top]:
+                frame = stat.traceback[0]
+                lines.append(f"{stat.size / 1024:10.1f} KiB {stat.count:8d} blocks  {frame.filename}:{frame.lineno}")
+        return '\n'.join(lines)
+
+    def _write(self, summary):
+        if not self.output_dir:
+            return
+        try:
+            os.makedirs(self.output_dir, exist_ok=True)
+            name = datetime.now().strftime(f"profile-%Y%m%d-%H%M%S-{os.getpid()}.txt")
+            path = os.path.join(self.output_dir, name)
+            with open(path, 'w') as profile_file:
+                profile_file.write(summary + '\n')
+            logging.info("Profile written to %s" % path)
+        except OSError as e:
+            logging.error("Failed to write the profile - %s" % e)
+
+
+def _location(frame):
+    code = frame.f_code
+    return f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
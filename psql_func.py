@@ -1,21 +1,45 @@
-# SSH and PSQL Library
-from sshtunnel import SSHTunnelForwarder
+# PSQL Library
 import psycopg2
+from psycopg2.extras import execute_values
 
 # Misc Libraries
 import json
+from collections import deque, namedtuple
+import logging
+import threading
+import time
 from datetime import datetime
 import pytz
+import numpy as np
 
 # Custom Modules
 import settings
 import math
+from cache import TTLCache
+from db_pool import CONNECTION_ERRORS, ConnectionPool, PoolTimeout
+from metrics import DB_FAILURES, SPOOL_BYTES, SPOOL_ROWS, STAGE_SECONDS, WRITE_BUFFER
+from spool import Spool
+
+# Errors after which PSQL may take the same rows again later
+UNAVAILABLE_ERRORS = CONNECTION_ERRORS + (PoolTimeout,)
 
 # Global settings
 DEVICE_SETTINGS_TABLE = settings.PSQL_DEVICE_SETTINGS_TABLE
 DEVICE_READINGS = settings.DEVICE_READINGS
 TIMEZONE = pytz.timezone(settings.TIMEZONE)
 
+# Row returned by get_device_settings
+DeviceSettings = namedtuple('DeviceSettings', ['fruit', 'variety', 'white_standard', 'batch_number',
+                                               'vendor_code', 'device_id', 'warehouse_id'])
+
+# Device settings by MAC ID, see get_device_settings
+device_cache = TTLCache(settings.DEVICE_CACHE_TTL, settings.DEVICE_CACHE_SIZE)
+
+# Last row written by this process per (warehouse_id, device_id), see flip_status.
+# Only rows written by this process are known, so it is only used by processes
+# that write all rows of their devices (service.py)
+last_row_ids = {}
+
 
 def create_dictionary(keys, values):
     """Creates a dictionary of sensor names and its respective sensor values
@@ -35,8 +59,467 @@ def create_dictionary(keys, values):
     return json.dumps({key: value for key, value in zip(keys, values)})
 
 
+# Queries shared with async_service, which converts the placeholders
+DEVICE_DATA_QUERY = """SELECT fruit_name AS fruit, variety, white_standard, batch_number, vendor_code,device_id,W.warehouse_id FROM devices D, fruit_varieties V, fruits F, device_types T,warehouses W WHERE D.mac_id=%s AND D.FRUIT_VARIETY_ID = V.ID AND V.FRUIT_ID = F.ID AND D.device_type_id = T.id AND D.warehouse_id = W.id"""
+FRUIT_VARIETY_CATALOG_QUERY = """SELECT fruit_varieties.id, fruit_name AS fruit, variety from fruits, fruit_varieties where fruit_varieties.fruit_id = fruits.id ORDER BY fruit_varieties.id"""
+CHANGE_FRUIT_VARIETY_QUERY = """UPDATE public.devices SET fruit_variety_id =%s::integer WHERE mac_id =%s;"""
+RESERVE_IDS_QUERY = """SELECT nextval(%s) FROM generate_series(1, %s)"""
+
+INSERT_COLUMNS = ('id', 'warehouse_id', 'device_id',
+                  'fruit', 'variety', 'batch_number',
+                  'brix', 'status', 'date', 'timestamp', 'device_info',
+                  'wv_610nm', 'wv_680nm', 'wv_730nm', 'wv_760nm', 'wv_810nm', 'wv_860nm', 'mac_id')
+INSERT_QUERY = f"""INSERT INTO warehouse_data({','.join(INSERT_COLUMNS)}) VALUES %s"""
+
+# Last row written per device, upserted with every batch of INSERT_QUERY
+# (see migrations/003_device_last_reading.sql)
+LAST_READING_QUERY = """INSERT INTO device_last_reading (warehouse_id, device_id, row_id) VALUES %s
+                        ON CONFLICT (warehouse_id, device_id) DO UPDATE SET row_id = EXCLUDED.row_id"""
+
+# Flips the status of a device's last row by primary key. Devices missing
+# from device_last_reading fall back to the (warehouse_id, device_id, id DESC) index
+FLIP_STATUS_QUERY = """UPDATE warehouse_data SET status = CASE WHEN status = 0 THEN 1 ELSE status END
+                       WHERE id = COALESCE(
+                           (SELECT row_id FROM device_last_reading WHERE warehouse_id = %s AND device_id = %s),
+                           (SELECT id FROM warehouse_data WHERE warehouse_id = %s AND device_id = %s
+                            ORDER BY id DESC LIMIT 1))
+                       RETURNING status"""
+FLIP_ROW_STATUS_QUERY = """UPDATE warehouse_data SET status = CASE WHEN status = 0 THEN 1 ELSE status END
+                           WHERE id = %s RETURNING status"""
+
+# Relations created by the migrations the writer depends on, NULL if missing
+SCHEMA_QUERY = "SELECT to_regclass(%s), to_regclass('device_last_reading')"
+
+
+# Positions in the rows of write_data (INSERT_COLUMNS without id)
+STATUS_COLUMN = INSERT_COLUMNS.index('status') - 1
+DEVICE_INFO_COLUMN = INSERT_COLUMNS.index('device_info') - 1
+
+
+class PendingRows:
+    """ Last row queued by write_data for each device, until it is committed
+
+    A flip of a device whose last row is still in the write buffer or the
+    spool is recorded here and applied when the row is inserted, so it
+    applies to the reading the device just showed instead of the one
+    before. Rows are told apart by their device_info. Only rows written
+    by this process are known (service.py).
+    """
+
+    def __init__(self):
+        # (warehouse_id, device_id) -> [device_info, status] of the last row
+        self._latest = {}
+        # device_info -> flipped status, until the row is committed
+        self._flips = {}
+        # device_info of the rows being inserted
+        self._inserting = set()
+        # (warehouse_id, device_id) -> MAC ID
+        self._mac_ids = {}
+        self._cond = threading.Condition()
+
+    def add(self, row, mac_id):
+        key = (str(row[0]), str(row[1]))
+        with self._cond:
+            self._latest[key] = [row[DEVICE_INFO_COLUMN], row[STATUS_COLUMN]]
+            self._mac_ids[key] = mac_id
+
+    def mac_id(self, warehouse_id, device_id):
+        """ MAC ID of a device that wrote rows, None if unknown """
+        return self._mac_ids.get((str(warehouse_id), str(device_id)))
+
+    def flip(self, warehouse_id, device_id, timeout):
+        """ Flips the status of the device's pending row
+
+        Returns:
+            The flipped status, None if the device has no pending row (or its
+            row is still being inserted after `timeout` seconds)
+        """
+        key = (str(warehouse_id), str(device_id))
+        with self._cond:
+            # A row being inserted is committed or pending again soon
+            self._cond.wait_for(lambda: key not in self._latest or self._latest[key][0] not in self._inserting,
+                                timeout)
+            entry = self._latest.get(key)
+            if entry is None or entry[0] in self._inserting:
+                return None
+
+            entry[1] = 1 if entry[1] == 0 else entry[1]
+            self._flips[entry[0]] = entry[1]
+            return entry[1]
+
+    def begin(self, batch):
+        """ Returns the batch with the flips applied, its rows are being inserted """
+        rows = []
+        with self._cond:
+            for row in batch:
+                status = self._flips.get(row[DEVICE_INFO_COLUMN])
+                if status is not None:
+                    row = row[:STATUS_COLUMN] + (status,) + row[STATUS_COLUMN + 1:]
+                rows.append(row)
+                self._inserting.add(row[DEVICE_INFO_COLUMN])
+        return rows
+
+    def end(self, batch, done):
+        """ Rows of batch are no longer being inserted. `done` if they were
+        committed or dropped, otherwise they are pending again """
+        with self._cond:
+            for row in batch:
+                device_info = row[DEVICE_INFO_COLUMN]
+                self._inserting.discard(device_info)
+                if done:
+                    self._flips.pop(device_info, None)
+                    key = (str(row[0]), str(row[1]))
+                    entry = self._latest.get(key)
+                    if entry is not None and entry[0] == device_info:
+                        del self._latest[key]
+            self._cond.notify_all()
+
+
+# Rows of write_data not yet committed, see flip_status
+pending_rows = PendingRows()
+
+
+class IdAllocator:
+    """ Hands out primary keys for the main table
+
+    IDs are reserved from a PostgreSQL sequence in blocks of `block_size`,
+    so inserts need no extra query most of the time. Sequences never hand
+    out the same value twice, so any number of threads and processes can
+    allocate IDs at the same time. IDs of a block that is not used up before
+    the process exits are skipped.
+
+    Parameters
+    ----------
+    sequence: str
+        Name of the sequence, see migrations/001_warehouse_data_id_seq.sql
+    block_size: int
+        Number of IDs reserved per round-trip
+    """
+
+    def __init__(self, sequence, block_size):
+        self.sequence = sequence
+        self.block_size = block_size
+        self._ids = deque()
+        self._lock = threading.Lock()
+
+    def take(self, count, cursor):
+        """ Returns `count` unused IDs, reserving new blocks with `cursor` when needed """
+        with self._lock:
+            while len(self._ids) < count:
+                cursor.execute(RESERVE_IDS_QUERY,
+                               (self.sequence, max(self.block_size, count - len(self._ids))))
+                self._ids.extend(row[0] for row in cursor.fetchall())
+
+            return [self._ids.popleft() for _ in range(count)]
+
+
+class BufferedWriter:
+    """ Write-behind buffer for the main table
+
+    Rows are collected in memory and inserted by a background thread with a
+    single multi-row INSERT and one commit per batch. A batch is flushed once
+    it reaches `batch_size` rows or `flush_interval` seconds after the
+    oldest row was added, whichever comes first.
+
+    Parameters
+    ----------
+    batch_size: int
+        Number of rows that triggers a flush
+    flush_interval: float
+        Maximum seconds a row waits in the buffer
+    max_buffer: int
+        Maximum number of buffered rows. add() blocks while the buffer is
+        full and raises once `buffer_timeout` seconds have passed
+    buffer_timeout: float
+        Seconds add() waits for space in a full buffer
+    open_spool: callable
+        Called when the writer starts, returns the Spool that takes the
+        batches PSQL cannot be reached for. Without one (None, or the call
+        failing) they are kept in the buffer instead. While the spool holds
+        rows, new batches are appended after them and a second thread
+        replays them in order
+    replay_batch: int
+        Rows replayed from the spool per transaction
+    replay_rate: float
+        Maximum rows replayed per second, so live batches still get
+        connections while a backlog is replayed
+    """
+
+    def __init__(self, batch_size, flush_interval, max_buffer, buffer_timeout,
+                 open_spool=None, replay_batch=1000, replay_rate=5000):
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_buffer = max_buffer
+        self.buffer_timeout = buffer_timeout
+        self.open_spool = open_spool
+        self.spool = None
+        self.replay_batch = replay_batch
+        self.replay_rate = replay_rate
+
+        self._rows = []
+        self._first_added = None
+        self._closed = False
+        self._cond = threading.Condition()
+        self._thread = None
+        self._replay_thread = None
+
+    def start(self):
+        """ Starts the writer thread, and the replay of rows left in the spool """
+        with self._cond:
+            self._start()
+
+    def _start(self):
+        if self._thread is not None:
+            return
+        # Only processes that write rows open the spool
+        if self.open_spool is not None:
+            try:
+                self.spool = self.open_spool()
+            except OSError as e:
+                logging.error("Failed to open the spool, rows are kept in memory - %s" % e)
+
+        self._thread = threading.Thread(target=self._run, name="psql-writer", daemon=True)
+        self._thread.start()
+        if self.spool is not None:
+            self._replay_thread = threading.Thread(target=self._replay, name="psql-replay", daemon=True)
+            self._replay_thread.start()
+
+    def add(self, row):
+        """ Buffers one row (all columns of INSERT_QUERY except id) """
+        with self._cond:
+            if self._closed:
+                raise RuntimeError("Writer is closed")
+
+            self._start()
+
+            if not self._cond.wait_for(lambda: len(self._rows) < self.max_buffer,
+                                       self.buffer_timeout):
+                raise RuntimeError("Write buffer is full (%d rows)" % len(self._rows))
+
+            if not self._rows:
+                self._first_added = time.monotonic()
+            self._rows.append(row)
+
+            if len(self._rows) >= self.batch_size:
+                self._cond.notify_all()
+
+    def close(self):
+        """ Flushes the remaining rows and stops the writer thread. Without a
+        spool, rows PSQL cannot take at the last attempt are dropped.
+        Rows still in the spool are replayed after the next start """
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+            thread = self._thread
+        if thread is not None:
+            thread.join()
+            if self._replay_thread is not None:
+                self._replay_thread.join()
+        if self.spool is not None:
+            self.spool.close()
+
+    def pending(self):
+        with self._cond:
+            return len(self._rows)
+
+    def _due(self):
+        if self._closed or len(self._rows) >= self.batch_size:
+            return True
+        return bool(self._rows) and time.monotonic() - self._first_added >= self.flush_interval
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._due():
+                    timeout = None
+                    if self._rows:
+                        timeout = self._first_added + self.flush_interval - time.monotonic()
+                    self._cond.wait(timeout)
+
+                if not self._rows:
+                    # Closed and fully flushed
+                    return
+
+                batch = self._rows[:self.batch_size]
+                del self._rows[:self.batch_size]
+                self._first_added = time.monotonic() if self._rows else None
+                self._cond.notify_all()
+
+            self._flush(batch)
+
+    def _flush(self, batch):
+        # Behind the spooled rows, so rows are stored in order
+        if self.spool is not None and not self.spool.empty():
+            self._spool(batch)
+            return
+
+        with STAGE_SECONDS.time('db_flush'):
+            dropped, unsaved, e = self._insert_valid(batch)
+        if dropped:
+            DB_FAILURES.inc('flush')
+        if unsaved:
+            DB_FAILURES.inc('flush')
+            if self.spool is not None:
+                logging.error("Failed to flush %d rows, spooled - %s" % (len(unsaved), e))
+                self._spool(unsaved)
+            else:
+                # Connection problem, keep the rows for the next flush
+                logging.error("Failed to flush %d rows, retrying - %s" % (len(unsaved), e))
+                self._requeue(unsaved)
+
+    def _insert_valid(self, batch):
+        """ Inserts rows in order. A batch PSQL rejects is split in halves
+        until the rows it rejects on their own are found, only those are
+        dropped
+
+        Returns
+        -------
+        tuple
+            (number of rows dropped, rows not inserted because PSQL is
+            unavailable, the error that stopped them). The rows not inserted
+            are the last ones of batch
+        """
+        chunks = [batch]
+        dropped = 0
+        while chunks:
+            chunk = chunks.pop(0)
+            try:
+                self._insert(chunk)
+            except UNAVAILABLE_ERRORS as e:
+                return dropped, chunk + [row for rest in chunks for row in rest], e
+            except Exception as e:
+                if len(chunk) > 1:
+                    half = len(chunk) // 2
+                    chunks[:0] = [chunk[:half], chunk[half:]]
+                    continue
+                dropped += 1
+                pending_rows.end(chunk, True)
+                logging.error("Failed to store a row of %s/%s, dropped - %s" % (chunk[0][0], chunk[0][1], e))
+        return dropped, [], None
+
+    def _insert(self, batch):
+        """ Inserts rows in one transaction, with the flips of pending_rows """
+        batch = pending_rows.begin(batch)
+        try:
+            with pool.cursor() as cursor:
+                # ID (Primary Key)
+                ids = id_allocator.take(len(batch), cursor)
+                rows = [(id_pk,) + tuple(row) for id_pk, row in zip(ids, batch)]
+                execute_values(cursor, INSERT_QUERY, rows, page_size=len(rows))
+
+                # Same transaction, so flips never see a row that was not committed
+                last_rows = {}
+                for row in rows:
+                    last_rows[row[1], row[2]] = row[0]
+                execute_values(cursor, LAST_READING_QUERY,
+                               [key + (id_pk,) for key, id_pk in last_rows.items()],
+                               page_size=len(last_rows))
+        except Exception:
+            pending_rows.end(batch, False)
+            raise
+
+        # Committed, flips in this process can skip the lookup
+        for (warehouse_id, device_id), id_pk in last_rows.items():
+            last_row_ids[str(warehouse_id), str(device_id)] = id_pk
+        pending_rows.end(batch, True)
+
+    def _spool(self, batch):
+        try:
+            appended = self.spool.append(batch)
+        except OSError as e:
+            logging.error("Failed to spool %d rows - %s" % (len(batch), e))
+            appended = 0
+        SPOOL_ROWS.inc('spooled', amount=appended)
+        if appended < len(batch):
+            pending_rows.end(batch[appended:], True)
+            SPOOL_ROWS.inc('dropped', amount=len(batch) - appended)
+            logging.error("Spool full, dropped %d rows" % (len(batch) - appended))
+
+    def _replay(self):
+        """ Inserts the spooled rows in order, at most replay_rate rows per second """
+        while True:
+            with self._cond:
+                if self._closed:
+                    return
+            if self.spool.empty():
+                self._wait(self.flush_interval)
+                continue
+
+            start = time.monotonic()
+            try:
+                rows, position = self.spool.read(self.replay_batch)
+            except OSError as e:
+                logging.error("Failed to read the spool - %s" % e)
+                self._wait(self.flush_interval)
+                continue
+
+            dropped, unsaved = 0, []
+            if rows:
+                with STAGE_SECONDS.time('db_replay'):
+                    dropped, unsaved, e = self._insert_valid(rows)
+                replayed = len(rows) - len(unsaved) - dropped
+                if replayed:
+                    SPOOL_ROWS.inc('replayed', amount=replayed)
+                    logging.info("Replayed %d spooled rows" % replayed)
+                if dropped:
+                    DB_FAILURES.inc('replay')
+                    SPOOL_ROWS.inc('dropped', amount=dropped)
+
+            if unsaved:
+                # Still unavailable, try the rest again later
+                DB_FAILURES.inc('replay')
+                logging.error("Failed to replay %d spooled rows - %s" % (len(unsaved), e))
+                if len(unsaved) < len(rows):
+                    self._commit_replayed(len(rows) - len(unsaved))
+                self._wait(self.flush_interval)
+                continue
+
+            try:
+                self.spool.commit(position)
+            except OSError as e:
+                logging.error("Failed to commit the spool position - %s" % e)
+            self._wait(len(rows) / self.replay_rate - (time.monotonic() - start))
+
+    def _commit_replayed(self, count):
+        # Position after the first `count` rows, so they are not replayed twice
+        try:
+            self.spool.commit(self.spool.read(count)[1])
+        except OSError as e:
+            logging.error("Failed to commit the spool position - %s" % e)
+
+    def _wait(self, seconds):
+        # Woken early by close()
+        if seconds > 0:
+            with self._cond:
+                self._cond.wait_for(lambda: self._closed, seconds)
+
+    def _requeue(self, batch):
+        with self._cond:
+            if self._closed:
+                # That was the last attempt, the remaining rows would fail the same way
+                dropped = len(batch) + len(self._rows)
+                pending_rows.end(batch + self._rows, True)
+                self._rows = []
+                self._first_added = None
+                self._cond.notify_all()
+                logging.error("Writer closed while PSQL is unavailable, dropped %d rows" % dropped)
+                return
+
+            space = self.max_buffer - len(self._rows)
+            if space < len(batch):
+                pending_rows.end(batch[max(space, 0):], True)
+                logging.error("Write buffer full, dropped %d rows" % (len(batch) - space))
+            self._rows[:0] = batch[:max(space, 0)]
+            self._first_added = time.monotonic()
+
+            # Back off before retrying, close() makes the next attempt the last one
+            self._cond.wait(self.flush_interval)
+
+
 def write_data(warehouse_id,device_id, device_readings, brix, status, fruit, variety, batch_number, vendor_code,mac_id):
-    """ Writes the data passed to the main table
+    """ Queues the data passed for the main table
+
+    The row is written by `writer` in a later batch.
 
     Parameters
     ----------
@@ -51,8 +534,21 @@ def write_data(warehouse_id,device_id, device_readings, brix, status, fruit, var
     status: float
         The status of the fruit for the current reading
     """
+    row = build_row(warehouse_id, device_id, device_readings, brix, status,
+                    fruit, variety, batch_number, vendor_code, mac_id)
+    # Flips of this device apply to this row from now on
+    pending_rows.add(row, mac_id)
+    try:
+        writer.add(row)
+    except Exception:
+        pending_rows.end([row], True)
+        raise
 
 
+def build_row(warehouse_id, device_id, device_readings, brix, status, fruit, variety, batch_number, vendor_code, mac_id):
+    """ Returns the values of a main table row, except the ID.
+    Takes the same parameters as write_data
+    """
     # Time related data
     now = datetime.now(tz=TIMEZONE)
     date_stamp = str(now.date())
@@ -60,38 +556,17 @@ def write_data(warehouse_id,device_id, device_readings, brix, status, fruit, var
 
     # Unique Key
     device_info = f"{warehouse_id}/{device_id}/{date_stamp}/{time_stamp}"
-    print(device_info)
-    print(brix)
-    # ID (Primary Key)
-    id_pk = read_most_recent_id()[0] + 1
-    print(device_readings)
-    for reading in range(len(device_readings)):
-        if math.isnan(device_readings[reading]):
-            device_readings[reading]=0.0
-    print(device_readings)        
-    
-    # Device readings
-    sensor_dict = create_dictionary(DEVICE_READINGS, device_readings)
-
-    # SQL insert query
-    insert_query = """INSERT INTO warehouse_data(id,warehouse_id,device_id,
-                                                 fruit,variety,batch_number,
-                                                 brix,status,date,timestamp,device_info,
-                                                 wv_610nm,wv_680nm,wv_730nm,wv_760nm,wv_810nm,wv_860nm,mac_id)
-                      VALUES (%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s)"""
+
+    # Wavelength readings, NaN is stored as 0
+    wavelengths = [0.0 if math.isnan(reading) else float(reading)
+                   for reading in device_readings[:6]]
 
     # Data to be inserted
-    params = (id_pk, warehouse_id, device_id, fruit, variety,
+    params = (warehouse_id, device_id, fruit, variety,
               batch_number, brix, status, date_stamp, time_stamp, device_info,
-              device_readings[0],device_readings[1],device_readings[2],device_readings[3],
-              device_readings[4],device_readings[5],mac_id)
+              *wavelengths, mac_id)
 
-    # Executing and commiting
-    print(params)
-    x  = cur.execute(insert_query, params)
-    #print(cur.fetch())
-    conn.commit()
-    print("Done with write")
+    return params
 
 
 def get_device_data(mac_id: str):
@@ -109,18 +584,45 @@ def get_device_data(mac_id: str):
     The fruit name, fruit variety, batch number and vendor code
     associated with the device
     """
-    #print('psql')
-    try:
-        fetch_query = """SELECT fruit_name AS fruit, variety, white_standard, batch_number, vendor_code,device_id,W.warehouse_id FROM devices D, fruit_varieties V, fruits F, device_types T,warehouses W WHERE D.mac_id=%s AND D.FRUIT_VARIETY_ID = V.ID AND V.FRUIT_ID = F.ID AND D.device_type_id = T.id AND D.warehouse_id = W.id"""
-    except Exception as e:
-        print(e)
-    #print(fetch_query)
-    cur.execute(fetch_query, (mac_id,))
-    response = cur.fetchall()
+    with pool.cursor() as cur:
+        cur.execute(DEVICE_DATA_QUERY, (mac_id,))
+        response = cur.fetchall()
     #print ( "response = ", response)
     return response
 
 
+def get_device_settings(mac_id):
+    """ Returns a device's settings, cached for DEVICE_CACHE_TTL seconds
+
+    Parameters
+    ----------
+    mac_id: str
+        MAC ID of the device
+
+    Returns
+    -------
+    DeviceSettings with the white standard parsed into a read-only
+    float array. Raises IndexError if the device is not registered
+    """
+    device_settings = device_cache.get(mac_id)
+    if device_settings is None:
+        device_settings = device_settings_from_row(get_device_data(mac_id)[0])
+        device_cache.set(mac_id, device_settings)
+
+    return device_settings
+
+
+def device_settings_from_row(row):
+    """ Builds DeviceSettings from a row of DEVICE_DATA_QUERY """
+    fruit, variety, white_standard, batch_number, vendor_code, device_id, warehouse_id = row
+
+    white_standard = np.array([float(x) for x in white_standard.values()])
+    white_standard.setflags(write=False)
+
+    return DeviceSettings(fruit, variety, white_standard, batch_number,
+                          vendor_code, device_id, warehouse_id)
+
+
 def read_most_recent_id():
     """
     Returns the most recent ID from the warehouse data table
@@ -129,8 +631,9 @@ def read_most_recent_id():
                 ORDER BY id DESC LIMIT 1;"""
 
     try:
-        cur.execute(query)
-        return cur.fetchall()[0]
+        with pool.cursor() as cur:
+            cur.execute(query)
+            return cur.fetchall()[0]
     except Exception:
         return -1
 
@@ -144,8 +647,9 @@ def read_most_recent_item(warehouse_id, device_id):
                 ORDER BY id DESC limit 1"""
 
     try:
-        cur.execute(query, (warehouse_id, device_id))
-        return cur.fetchall()[0]
+        with pool.cursor() as cur:
+            cur.execute(query, (warehouse_id, device_id))
+            return cur.fetchall()[0]
     except:
         return (-1, -1)
 
@@ -160,30 +664,80 @@ def update_item(status, device_info):
 
     if device_info != -1:
         query = """UPDATE warehouse_data SET status=%s WHERE device_info=%s"""
-        cur.execute(query, (str(status), device_info))
-        conn.commit()
+        with pool.cursor() as cur:
+            cur.execute(query, (str(status), device_info))
 
     return status
 
 
+def check_schema():
+    """ Raises RuntimeError if a migration writer depends on was not run,
+    every batch would be rejected otherwise. Skipped while PSQL is unavailable
+    """
+    try:
+        with pool.cursor() as cur:
+            cur.execute(SCHEMA_QUERY, (settings.PSQL_ID_SEQUENCE,))
+            sequence, last_reading = cur.fetchone()
+    except UNAVAILABLE_ERRORS as e:
+        logging.error("Failed to check the PSQL schema - %s" % e)
+        return
+
+    missing = []
+    if sequence is None:
+        missing.append("sequence %s (migrations/001_warehouse_data_id_seq.sql)" % settings.PSQL_ID_SEQUENCE)
+    if last_reading is None:
+        missing.append("table device_last_reading (migrations/003_device_last_reading.sql)")
+    if missing:
+        raise RuntimeError("PSQL schema is missing %s" % ", ".join(missing))
+
+
 def flip_status(warehouse_id, device_id):
     """
     params: warehouse_id, device_id: To uniquely identify the device
-    return: The updated status value
+    return: The updated status value, -1 if the device has no rows
     """
+    # The device's last row may not be flushed yet
+    status = pending_rows.flip(warehouse_id, device_id, settings.PSQL_POOL_TIMEOUT)
+    if status is not None:
+        return status
 
-    status, device_info = read_most_recent_item(warehouse_id, device_id)
-    status = update_item(status, device_info)
-    return status
+    row_id = last_row_ids.get((str(warehouse_id), str(device_id)))
+    with pool.cursor() as cur:
+        if row_id is not None:
+            cur.execute(FLIP_ROW_STATUS_QUERY, (row_id,))
+        else:
+            cur.execute(FLIP_STATUS_QUERY, (warehouse_id, device_id, warehouse_id, device_id))
+        response = cur.fetchall()
+
+    return response[0][0] if response else -1
 
 
 def get_fruit_variety_list():
     fetch_query = """SELECT fruit_name AS fruit, variety from fruits, fruit_varieties where fruit_varieties.fruit_id = fruits.id"""
-    cur.execute(fetch_query)
-    response = cur.fetchall()
+    with pool.cursor() as cur:
+        cur.execute(fetch_query)
+        response = cur.fetchall()
+    return response
+
+
+
+def get_fruit_variety_catalog():
+    """Returns (fruit_variety_id, fruit, variety) for every variety"""
+    with pool.cursor() as cur:
+        cur.execute(FRUIT_VARIETY_CATALOG_QUERY)
+        response = cur.fetchall()
     return response
 
 
+def listen_connection(channel):
+    """Opens a dedicated autocommit connection that LISTENs on a channel.
+    Poll it and read conn.notifies to receive the notifications"""
+    listen_conn = connect()
+    listen_conn.autocommit = True
+    with listen_conn.cursor() as cursor:
+        cursor.execute(f"LISTEN {channel};")
+    return listen_conn
+
 
 def read_most_recent_fruit_id(mac_id):
     """Returns the most recent ID from the warehouse data table"""
@@ -194,36 +748,68 @@ def read_most_recent_fruit_id(mac_id):
                join fruits as F
                on V.fruit_id = F.id
                where d.mac_id =%s"""
-    print("read_most_recent",mac_id)
     try:
-        print(type(mac_id),mac_id)
-        cur.execute(query,(mac_id,))
-        return cur.fetchall()[0]
+        with pool.cursor() as cur:
+            cur.execute(query,(mac_id,))
+            return cur.fetchall()[0]
     except Exception as e:
-        print(e)
+        logging.error("Failed to read the fruit of %s - %s" % (mac_id, e))
         return -1
 
 def change_fruit_variety(model_id,mac_id):
-    print('changing fruit variety') 
-    fetch_query = """UPDATE public.devices SET fruit_variety_id =%s::integer WHERE mac_id =%s;"""
     try:
-        cur.execute(fetch_query,(model_id,(mac_id,)))
-        conn.commit()
-        print('donee')
+        with pool.cursor() as cur:
+            cur.execute(CHANGE_FRUIT_VARIETY_QUERY,(model_id,(mac_id,)))
+        # The device now runs on a different model
+        device_cache.invalidate(mac_id)
         response = model_id
     except Exception as e:
-        print('oops')
-        print(e)
-        respose = cur.fetchhall()[0]
-    print(response)
+        logging.error("Failed to change the fruit variety of %s - %s" % (mac_id, e))
+        raise
+    logging.info("Changed the fruit variety of %s to %s" % (mac_id, response))
     return response
-conn = psycopg2.connect(database=settings.PSQL_DB_NAME,
-                        user=settings.PSQL_USER,
-                        password=settings.PSQL_PASSWORD,
-                        host=settings.PSQL_HOST,
-                        port=settings.PSQL_PORT)
 
-cur = conn.cursor()
+
+def connect():
+    """Opens a new connection to the PSQL database"""
+    return psycopg2.connect(database=settings.PSQL_DB_NAME,
+                            user=settings.PSQL_USER,
+                            password=settings.PSQL_PASSWORD,
+                            host=settings.PSQL_HOST,
+                            port=settings.PSQL_PORT,
+                            connect_timeout=settings.PSQL_CONNECT_TIMEOUT)
+
+
+# Connections are opened on first use, importing this module never blocks
+pool = ConnectionPool(connect,
+                      settings.PSQL_POOL_MIN,
+                      settings.PSQL_POOL_MAX,
+                      settings.PSQL_HEALTH_CHECK_INTERVAL,
+                      settings.PSQL_POOL_TIMEOUT)
+
+# Primary keys for the main table, see IdAllocator
+id_allocator = IdAllocator(settings.PSQL_ID_SEQUENCE, settings.ID_BLOCK_SIZE)
+
+
+def open_spool():
+    """ Spool of the rows PSQL could not take, replayed by writer """
+    spool = Spool(settings.SPOOL_DIR,
+                  settings.SPOOL_SEGMENT_BYTES,
+                  settings.SPOOL_MAX_BYTES,
+                  settings.SPOOL_MMAP)
+    SPOOL_BYTES.set_function(spool.pending_bytes)
+    return spool
+
+
+# Batches rows for the main table, see BufferedWriter
+writer = BufferedWriter(settings.WRITE_BATCH_SIZE,
+                        settings.WRITE_FLUSH_INTERVAL,
+                        settings.WRITE_BUFFER_LIMIT,
+                        settings.WRITE_BUFFER_TIMEOUT,
+                        open_spool if settings.SPOOL_DIR else None,
+                        settings.SPOOL_REPLAY_BATCH,
+                        settings.SPOOL_REPLAY_RATE)
+WRITE_BUFFER.set_function(writer.pending)
 
 if __name__ == '__main__':
 
@@ -239,3 +825,4 @@ if __name__ == '__main__':
     status = 1
 
     write_data(warehouse_id, device_id, device_readings, brix, status, f, v, b, vc)
+    writer.close()
@@ -0,0 +1,112 @@
+# Basic libraries
+import logging
+import threading
+from collections import OrderedDict
+
+# MQTT Library
+import paho.mqtt.client as mqttClient
+
+
+class Publisher:
+    """Sends outgoing messages from one thread, through a bounded queue.
+
+    Only the newest message of a kind is kept per topic: when feedback for
+    a device is queued before its previous feedback was sent, the previous
+    one is dropped as stale and the new one queued last. Messages of
+    different kinds on one topic (boot response and feedback) never replace
+    each other. Messages go out in the order they were queued.
+    While `max_queued` messages are waiting, new ones are dropped. Messages
+    paho refuses (not connected, or its own queue full) are retried every
+    `retry_interval` seconds unless a newer one has replaced them.
+
+    Args:
+        max_queued (int): Maximum number of messages waiting to be sent
+        retry_interval (float): Seconds between attempts while paho refuses messages
+        on_drop (callable): Called with the reason ('stale' or 'full') of every dropped message
+    """
+
+    def __init__(self, max_queued, retry_interval, on_drop=None):
+        self.max_queued = max_queued
+        self.retry_interval = retry_interval
+        self.on_drop = on_drop
+
+        # (topic, kind) -> (client, payload), oldest first
+        self._pending = OrderedDict()
+        self._condition = threading.Condition()
+        self._stopping = False
+        self._thread = threading.Thread(target=self._run, name="publisher", daemon=True)
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        """Sends what is queued and waits for the thread"""
+        with self._condition:
+            self._stopping = True
+            self._condition.notify()
+        self._thread.join()
+
+    def publish(self, client, topic, payload, kind='feedback'):
+        """Queues payload for topic, replacing a queued one of the same kind
+
+        Args:
+            client (mqttClient): Client the message is sent through
+            topic (str): Topic to publish on
+            payload (str): Message
+            kind (str): Kind of the message, e.g. 'feedback' or 'boot'
+
+        Returns:
+            bool: False if the message was dropped because the queue is full
+        """
+        key = (topic, kind)
+        with self._condition:
+            if key in self._pending:
+                self._drop('stale')
+                # Behind the messages queued after the stale one
+                self._pending.move_to_end(key)
+            elif len(self._pending) >= self.max_queued:
+                self._drop('full')
+                logging.error("Publish queue full, dropped message for %s" % topic)
+                return False
+
+            self._pending[key] = (client, payload)
+            self._condition.notify()
+        return True
+
+    def queue_depth(self):
+        return len(self._pending)
+
+    def _drop(self, reason):
+        if self.on_drop is not None:
+            self.on_drop(reason)
+
+    def _run(self):
+        while True:
+            with self._condition:
+                while not self._pending and not self._stopping:
+                    self._condition.wait()
+                if not self._pending:
+                    return
+                key, (client, payload) = self._pending.popitem(last=False)
+            topic = key[0]
+
+            try:
+                info = client.publish(topic, payload)
+            except Exception as e:
+                logging.error("Failed to publish on %s - %s" % (topic, e))
+                continue
+
+            # Clients other than paho's return nothing
+            rc = getattr(info, 'rc', mqttClient.MQTT_ERR_SUCCESS)
+            if rc in (mqttClient.MQTT_ERR_NO_CONN, mqttClient.MQTT_ERR_QUEUE_SIZE):
+                with self._condition:
+                    if self._stopping:
+                        logging.error("Not sent on %s while stopping, rc %s" % (topic, rc))
+                        continue
+                    # Put back first in line, unless a newer message replaced it
+                    if key not in self._pending:
+                        self._pending[key] = (client, payload)
+                        self._pending.move_to_end(key, last=False)
+                    self._condition.wait(self.retry_interval)
+            elif rc != mqttClient.MQTT_ERR_SUCCESS:
+                logging.error("Failed to publish on %s, rc %s" % (topic, rc))
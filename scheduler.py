@@ -0,0 +1,109 @@
+# Basic libraries
+import heapq
+import itertools
+import logging
+import threading
+import time
+
+
+class DeadlineScheduler:
+    """Keeps one deadline per key in a min-heap and fires a callback
+    when a deadline passes.
+
+    A single timer thread sleeps until the earliest deadline instead of
+    polling every key, so an idle process uses no CPU.
+    Arming and re-arming a key is O(log n). Cancelling is O(1): stale heap
+    entries are skipped when they reach the top and compacted when they
+    start to outnumber the live ones.
+
+    Args:
+        callback (callable): Called with the key once its deadline passes
+        name (str): Name of the timer thread
+    """
+
+    def __init__(self, callback, name="deadline-scheduler"):
+        self._callback = callback
+        self._heap = []
+        self._armed = {}
+        self._counter = itertools.count()
+        self._cond = threading.Condition()
+        self._stopped = False
+        self._thread = threading.Thread(target=self._run, name=name, daemon=True)
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        with self._cond:
+            self._stopped = True
+            self._cond.notify()
+        self._thread.join()
+
+    def arm(self, key, delay):
+        """Sets (or moves) the deadline of a key to now + delay seconds
+
+        Args:
+            key (hashable): Key passed back to the callback
+            delay (float): Seconds until the deadline
+        """
+        deadline = time.monotonic() + delay
+        with self._cond:
+            seq = next(self._counter)
+            self._armed[key] = seq
+            heapq.heappush(self._heap, (deadline, seq, key))
+            self._compact()
+            # Wake the timer thread only if the earliest deadline changed
+            if self._heap[0][1] == seq:
+                self._cond.notify()
+
+    def cancel(self, key):
+        """Removes the deadline of a key, if any"""
+        with self._cond:
+            self._armed.pop(key, None)
+
+    def is_armed(self, key):
+        with self._cond:
+            return key in self._armed
+
+    def __len__(self):
+        with self._cond:
+            return len(self._armed)
+
+    def _compact(self):
+        # Rebuild the heap once stale entries make up most of it
+        if len(self._heap) > 64 and len(self._heap) > 2 * len(self._armed):
+            self._heap = [entry for entry in self._heap
+                          if self._armed.get(entry[2]) == entry[1]]
+            heapq.heapify(self._heap)
+
+    def _run(self):
+        while True:
+            with self._cond:
+                key = None
+                while key is None and not self._stopped:
+                    # Drop cancelled or re-armed entries
+                    while self._heap and self._armed.get(self._heap[0][2]) != self._heap[0][1]:
+                        heapq.heappop(self._heap)
+
+                    if not self._heap:
+                        self._cond.wait()
+                        continue
+
+                    deadline, seq, head = self._heap[0]
+                    delay = deadline - time.monotonic()
+                    if delay > 0:
+                        self._cond.wait(delay)
+                        continue
+
+                    heapq.heappop(self._heap)
+                    del self._armed[head]
+                    key = head
+
+                if self._stopped:
+                    return
+
+            # Run the callback without holding the lock so it can re-arm
+            try:
+                self._callback(key)
+            except Exception as e:
+                logging.error("Deadline callback for %s failed - %s" % (key, e))
@@ -0,0 +1,140 @@
+"""
+Runs main.py and update_status_mqtt.py in one process.
+
+One broker connection subscribes to the reading, boot/model change and
+status update topics, and every kind of message goes to its own handler.
+All handlers share main.py's dispatcher, device cache, model registry and
+psql_func's connection pool, and status flips use the row IDs this process
+has just written (psql_func.last_row_ids) instead of looking them up.
+
+Replaces feedback.service and status_update.service. The status update
+topic is subscribed with MQTT_USER, which needs access to it.
+ec2_mqtt.py uses another message format on SUB_TOPIC and is not included.
+
+Usage: python service.py
+"""
+
+# Basic libraries
+import logging
+import signal
+
+# MQTT Library
+import paho.mqtt.client as mqttClient
+
+# Custom modules
+import main, psql_func, settings, update_status_mqtt
+
+
+class ServiceEngine:
+    """Routes the messages of several topics to one handler per message kind.
+
+    A topic is registered with its kind, or with a function returning the
+    kind of each message when one topic carries several. Handlers are
+    called with (client, message) on the paho network thread, so they must
+    hand slow work to a worker.
+    """
+
+    def __init__(self):
+        self._kinds = {}
+        self._handlers = {}
+
+    @property
+    def topics(self):
+        return list(self._kinds)
+
+    def add_topic(self, topic, kind):
+        """
+        Args:
+            topic (str): Topic to subscribe to
+            kind (str or callable): Kind of its messages, or a function of the payload returning it
+        """
+        self._kinds[topic] = kind
+
+    def add_handler(self, kind, handler):
+        self._handlers[kind] = handler
+
+    def on_message(self, client, userdata, message):
+        kind = self._kinds.get(message.topic)
+        if callable(kind):
+            kind = kind(message.payload)
+
+        handler = self._handlers.get(kind)
+        if handler is None:
+            logging.error("No handler for %s message on %s" % (kind, message.topic))
+            return
+        handler(client, message)
+
+    def create_client(self, user, password):
+        client = mqttClient.Client()
+        client.username_pw_set(user, password=password)
+        client.max_inflight_messages_set(settings.MQTT_MAX_INFLIGHT)
+        client.max_queued_messages_set(settings.MQTT_MAX_QUEUED)
+
+        # Callbacks
+        client.on_connect = main.on_connect
+        client.on_disconnect = main.on_disconnect
+        client.on_message = self.on_message
+        return client
+
+    def subscribe(self, client):
+        client.subscribe([(topic, 0) for topic in self.topics])
+
+
+def on_status_message(client, message):
+    """Status flip request, "<warehouse_id>, <device_id>".
+    Flipped on a dispatcher worker, in order with the device's batches once
+    one was written, otherwise with the device's other flips"""
+    fields = message.payload.decode("utf-8").split(",")
+    warehouse_id, device_id = fields[0].strip(), fields[1].strip()
+    key = psql_func.pending_rows.mac_id(warehouse_id, device_id) or f"{warehouse_id}/{device_id}"
+    main.dispatcher.submit(key, handle_status, client, message)
+
+
+def handle_status(client, message):
+    """Flips the status and queues the feedback on the publisher"""
+    topic, flipped_status = update_status_mqtt.flip(message)
+    main.publisher.publish(client, topic, flipped_status, 'status')
+
+
+def create_engine():
+    engine = ServiceEngine()
+
+    # Readings, boot and model change requests
+    engine.add_topic(settings.SUB_TOPIC, main.message_kind)
+    for kind, handler in main.MESSAGE_HANDLERS.items():
+        engine.add_handler(kind, handler)
+
+    # Status flips
+    engine.add_topic(settings.UPDATE_SUB_TOPIC, 'status')
+    engine.add_handler('status', on_status_message)
+
+    # Profiling commands
+    engine.add_topic(settings.CONTROL_TOPIC, 'control')
+    engine.add_handler('control', lambda client, message: main.on_control(client, None, message))
+    return engine
+
+
+if __name__ == "__main__":
+
+    # systemctl stop sends SIGTERM, handled like Ctrl+C so stop_services runs
+    signal.signal(signal.SIGTERM, signal.default_int_handler)
+
+    main.start_services()
+    if not main.wait_until_ready(settings.READY_TIMEOUT, settings.READY_RETRY_INTERVAL):
+        main.stop_services()
+        raise SystemExit(1)
+
+    engine = create_engine()
+    client = engine.create_client(settings.MQTT_USER, settings.MQTT_PASSWORD)
+    client.connect(settings.BROKER_ADDRESS, port=settings.MQTT_PORT)
+    engine.subscribe(client)
+    logging.info("Service subscribed to %s" % ', '.join(engine.topics))
+
+    try:
+        client.loop_forever()
+    finally:
+        # Keep the network loop running while the queued feedback is sent
+        client.loop_start()
+        main.stop_services()
+        client.loop_stop()
+        client.disconnect()
@@ -9,6 +9,16 @@ LOG_DIR = f"{BASE_DIR}log/"
 MQTT_LOG_FILE = f'{LOG_DIR}mqtt.log'
 STATUS_UPDATE_LOG_FILE = f'{LOG_DIR}status_update.log'
 
+# Log files are written by a background thread and rotated at LOG_MAX_BYTES.
+# LOG_SAMPLE_RATES keeps only a share of the records of a level, e.g. one in
+# a hundred per-batch debug records. Records are dropped while LOG_QUEUE_SIZE
+# records wait to be written.
+LOG_LEVEL = 'INFO'
+LOG_MAX_BYTES = 50 * 1024 * 1024
+LOG_BACKUP_COUNT = 5
+LOG_QUEUE_SIZE = 10000
+LOG_SAMPLE_RATES = {'DEBUG': 0.01}
+
 MODEL_DIR = f'{BASE_DIR}models/'
 TIMEZONE = 'Asia/Kolkata'
 
@@ -34,9 +44,103 @@ MESSAGE_LIMIT = 2
 DEFAULT_BRIX_MODEL = f"{MODEL_DIR}default_brix.sav"
 DEFAULT_CLF_MODEL = f"{MODEL_DIR}default_clf.sav"
 
+# Load the models of every variety at startup instead of on first use
+MODEL_PRELOAD = True
+# Model files loaded at the same time by the preload
+MODEL_PRELOAD_WORKERS = 8
+# Least recently used models are unloaded above this many bytes
+MODEL_MEMORY_BUDGET = 512 * 1024 * 1024
+# Evaluate linear models with NumPy instead of sklearn when results match
+MODEL_FAST_PATH = True
+# Weights of NumPy kernels are memory-mapped from here, shared by all processes
+MODEL_SHARED_DIR = '/dev/shm/qzense_models/'
+# Memory-map the artifacts written by convert_models.py instead of unpickling
+# the .sav files they were converted from
+MODEL_ARTIFACTS = True
+# Varieties without their own model file are checked for a new one this often
+MODEL_RECHECK_INTERVAL = 60
+
 DEFAULT_WHITE_STANDARD = [1, 1, 1, 1, 1, 1]
 DEVICE_READINGS = ['610nm', '680nm', '730nm', '760nm', '810nm', '860nm', 'temp', 'humidity', 'temperature']
 
+# Device settings from PSQL are cached for DEVICE_CACHE_TTL seconds
+DEVICE_CACHE_TTL = 300
+DEVICE_CACHE_SIZE = 20000
+
+# Fruit/variety catalog is reloaded every CATALOG_REFRESH_INTERVAL seconds
+# or when PSQL sends a NOTIFY on CATALOG_CHANNEL
+CATALOG_REFRESH_INTERVAL = 600
+CATALOG_CHANNEL = 'catalog_changed'
+
+# Messages are only subscribed to once the catalog and default models are
+# loaded. Loading is retried every READY_RETRY_INTERVAL seconds, the service
+# exits if it is not ready after READY_TIMEOUT seconds.
+READY_TIMEOUT = 300
+READY_RETRY_INTERVAL = 10
+
+# Dispatcher Settings
+# Completed batches are processed by DISPATCH_WORKERS threads.
+# Messages of the same device always go to the same worker.
+DISPATCH_WORKERS = 16
+DISPATCH_QUEUE_SIZE = 1000
+DISPATCH_SUBMIT_TIMEOUT = 1
+
+# Predictions are batched across devices for INFERENCE_BATCH_WINDOW seconds
+# or until INFERENCE_BATCH_SIZE readings are pending. Each dispatcher worker
+# waits for its prediction, so batches hold at most DISPATCH_WORKERS readings.
+INFERENCE_BATCH_WINDOW = 0.005
+INFERENCE_BATCH_SIZE = 64
+
+# Feedback is sent by one publisher thread (publisher.py). Up to
+# PUBLISH_QUEUE_SIZE messages wait to be sent, only the newest message of a
+# kind is kept per topic. MQTT_MAX_INFLIGHT and MQTT_MAX_QUEUED bound paho's own
+# window and outgoing queue, refused messages are retried every
+# PUBLISH_RETRY_INTERVAL seconds.
+PUBLISH_QUEUE_SIZE = 10000
+PUBLISH_RETRY_INTERVAL = 0.5
+MQTT_MAX_INFLIGHT = 20
+MQTT_MAX_QUEUED = 1000
+
+# With INFERENCE_PROCESSES > 0 predictions run on that many forked processes
+# sharing the loaded models (inference_server.py) instead of the batcher.
+# Results not ready after INFERENCE_TIMEOUT seconds are given up.
+# The predict_brix/predict_status stage metrics are not recorded then.
+INFERENCE_PROCESSES = 0
+INFERENCE_TIMEOUT = 5
+
+# Prometheus metrics are served on http://METRICS_ADDRESS:METRICS_PORT/metrics,
+# 0 disables the endpoint
+METRICS_PORT = 9108
+METRICS_ADDRESS = '127.0.0.1'
+
+# Profiling is switched on by a message on CONTROL_TOPIC (see profiling.py)
+# for at most PROFILE_MAX_SECONDS. The summary is published on
+# PROFILE_RESULT_TOPIC and written to PROFILE_DIR.
+CONTROL_TOPIC = '/proto/control'
+PROFILE_RESULT_TOPIC = '/proto/control/profile'
+PROFILE_MAX_SECONDS = 120
+PROFILE_INTERVAL = 0.005
+PROFILE_TOP = 25
+PROFILE_DIR = f'{LOG_DIR}profiles/'
+
+# asyncio service (async_service.py)
+# Inference runs on ASYNC_EXECUTOR_WORKERS threads, reading from the broker
+# pauses while ASYNC_MAX_PENDING jobs are in flight.
+ASYNC_EXECUTOR_WORKERS = 8
+ASYNC_MAX_PENDING = 10000
+
+# Multi-process deployment (supervisor.py)
+# SUPERVISOR_MODE 'route': the supervisor subscribes and routes by MAC ID
+# 'share': workers join $share/SHARE_GROUP/SUB_TOPIC, see supervisor.py
+# Every worker has its own PSQL pool of up to PSQL_POOL_MAX connections.
+SUPERVISOR_WORKERS = 4
+SUPERVISOR_MODE = 'route'
+SHARE_GROUP = 'ingest'
+HASH_RING_REPLICAS = 64
+SUPERVISOR_RESTART_DELAY = 1
+SUPERVISOR_MAX_RESTART_DELAY = 60
+SUPERVISOR_STOP_TIMEOUT = 30
+
 # SSH Credentials
 REMOTE_HOST = "65.1.238.16"
 REMOTE_SSH_PORT = 22
@@ -55,3 +159,33 @@ PSQL_PASSWORD = 'eFirst2019'
 
 PSQL_MAIN_TABLE = 'warehouse_data'
 PSQL_DEVICE_SETTINGS_TABLE = 'devices'
+PSQL_ID_SEQUENCE = 'warehouse_data_id_seq'
+
+# Connection pool shared by all threads of a process
+PSQL_POOL_MIN = 2
+PSQL_POOL_MAX = 10
+PSQL_POOL_TIMEOUT = 5
+PSQL_CONNECT_TIMEOUT = 10
+PSQL_HEALTH_CHECK_INTERVAL = 30
+
+# IDs reserved from PSQL_ID_SEQUENCE per round-trip
+ID_BLOCK_SIZE = 1000
+
+# Rows for the main table are inserted in batches of up to WRITE_BATCH_SIZE,
+# at the latest WRITE_FLUSH_INTERVAL seconds after they were queued
+WRITE_BATCH_SIZE = 200
+WRITE_FLUSH_INTERVAL = 1
+WRITE_BUFFER_LIMIT = 10000
+WRITE_BUFFER_TIMEOUT = 1
+
+# Batches PSQL cannot be reached for are appended to segment files of
+# SPOOL_SEGMENT_BYTES in SPOOL_DIR (spool.py), up to SPOOL_MAX_BYTES, and
+# replayed in order SPOOL_REPLAY_BATCH rows per transaction and at most
+# SPOOL_REPLAY_RATE rows per second. SPOOL_MMAP writes through a memory map.
+# None keeps the rows in the write buffer instead.
+SPOOL_DIR = f'{BASE_DIR}spool/'
+SPOOL_SEGMENT_BYTES = 16 * 1024 * 1024
+SPOOL_MAX_BYTES = 1024 * 1024 * 1024
+SPOOL_MMAP = False
+SPOOL_REPLAY_BATCH = 1000
+SPOOL_REPLAY_RATE = 5000
@@ -0,0 +1,300 @@
+# Basic libraries
+import fcntl
+import json
+import logging
+import mmap
+import os
+import struct
+import threading
+import zlib
+
+# Length and CRC32 of the JSON payload in front of every record
+RECORD_HEADER = struct.Struct('<II')
+
+# Bytes read from a segment at a time
+READ_CHUNK = 1024 * 1024
+
+CURSOR_FILE = 'cursor'
+LOCK_FILE = 'lock'
+SEGMENT_SUFFIX = '.seg'
+
+
+def _encode(row):
+    # Predictions may be NumPy scalars
+    payload = json.dumps(row, default=lambda value: value.item()).encode("utf-8")
+    return RECORD_HEADER.pack(len(payload), zlib.crc32(payload)) + payload
+
+
+class Spool:
+    """Append-only spool of rows on disk, read back in the order they were added.
+
+    Rows are appended as records to numbered segment files of up to
+    `segment_bytes` in `directory`. The position up to which rows were
+    replayed is kept in a cursor file, segments before it are deleted, so
+    rows left over when the process stops are read again after a restart.
+    A record that was cut off by a crash ends its segment. A directory is
+    used by one process at a time, it is locked until close().
+
+    Appends are not fsynced: rows survive the process crashing, not the
+    machine. Rows read but not committed before a crash are read again.
+
+    Args:
+        directory (str): Directory of the segments, created if missing
+        segment_bytes (int): Size of a segment, larger than any row
+        max_bytes (int): Maximum size of all segments, rows beyond it are dropped
+        use_mmap (bool): Write through a memory map of segments preallocated to
+            `segment_bytes` instead of appending to the files
+    """
+
+    def __init__(self, directory, segment_bytes, max_bytes, use_mmap=False):
+        self.directory = directory
+        self.segment_bytes = segment_bytes
+        self.max_bytes = max_bytes
+        self.use_mmap = use_mmap
+
+        self._lock = threading.Lock()
+
+        # Segment numbers oldest first, and their size on disk
+        self._segments = []
+        self._sizes = {}
+        self._next_segment = 0
+
+        # Segment being written
+        self._active = None
+        self._file = None
+        self._map = None
+        self._write_offset = 0
+
+        # (segment, offset) of the next row to replay
+        self._read_position = None
+
+        self._lock_file = None
+        self._lock_directory()
+        self._load()
+
+    def _path(self, number):
+        return os.path.join(self.directory, f"{number:010d}{SEGMENT_SUFFIX}")
+
+    def _lock_directory(self):
+        """Raises OSError if another process uses the directory, it could
+        replay or delete the segments of this one"""
+        os.makedirs(self.directory, exist_ok=True)
+        self._lock_file = open(os.path.join(self.directory, LOCK_FILE), 'a')
+        try:
+            fcntl.flock(self._lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            self._lock_file.close()
+            self._lock_file = None
+            raise OSError("Spool %s is used by another process" % self.directory) from None
+
+    def _load(self):
+        """Picks up the segments and cursor left by a previous run"""
+        for name in sorted(os.listdir(self.directory)):
+            if name.endswith(SEGMENT_SUFFIX):
+                number = int(name[:-len(SEGMENT_SUFFIX)])
+                self._segments.append(number)
+                self._sizes[number] = os.path.getsize(self._path(number))
+
+        cursor = (self._segments[0], 0) if self._segments else None
+        try:
+            with open(os.path.join(self.directory, CURSOR_FILE)) as f:
+                segment, offset = (int(value) for value in f.read().split())
+            cursor = (segment, offset)
+        except FileNotFoundError:
+            pass
+        except ValueError as e:
+            logging.error("Invalid spool cursor, replaying from the oldest segment - %s" % e)
+
+        if cursor is not None:
+            self._read_position = cursor
+            self._delete_before(cursor[0])
+            self._next_segment = cursor[0]
+        if self._segments:
+            self._next_segment = max(self._next_segment, self._segments[-1] + 1)
+            logging.info("Spool has %d bytes to replay" % self._pending_bytes())
+
+    def empty(self):
+        """True when every appended row was replayed"""
+        with self._lock:
+            if not self._segments:
+                return True
+            return (self._segments == [self._active]
+                    and self._read_position == (self._active, self._write_offset))
+
+    def pending_bytes(self):
+        """Bytes of the segments on disk"""
+        with self._lock:
+            return self._pending_bytes()
+
+    def _pending_bytes(self):
+        return sum(self._sizes.values())
+
+    def append(self, rows):
+        """Appends rows after the ones already spooled
+
+        Returns:
+            int: Number of rows appended, the rest did not fit in max_bytes
+        """
+        appended = 0
+        with self._lock:
+            for row in rows:
+                record = _encode(row)
+                if not self.use_mmap and self._pending_bytes() + len(record) > self.max_bytes:
+                    break
+                if self._active is None or self._write_offset + len(record) > self.segment_bytes:
+                    if not self._roll():
+                        break
+
+                if self.use_mmap:
+                    self._map[self._write_offset:self._write_offset + len(record)] = record
+                else:
+                    self._file.write(record)
+                    self._sizes[self._active] += len(record)
+                self._write_offset += len(record)
+                appended += 1
+
+            if self._file is not None and not self.use_mmap:
+                self._file.flush()
+        return appended
+
+    def _roll(self):
+        """Starts a new segment, False if it would exceed max_bytes"""
+        if self.use_mmap and self._pending_bytes() + self.segment_bytes > self.max_bytes:
+            return False
+
+        self._close_segment()
+
+        number = self._next_segment
+        self._next_segment += 1
+        self._file = open(self._path(number), 'w+b' if self.use_mmap else 'ab')
+        if self.use_mmap:
+            # Zero filled, a zero length ends the records
+            self._file.truncate(self.segment_bytes)
+            self._map = mmap.mmap(self._file.fileno(), self.segment_bytes)
+            self._sizes[number] = self.segment_bytes
+        else:
+            self._sizes[number] = 0
+
+        self._segments.append(number)
+        self._active = number
+        self._write_offset = 0
+        if self._read_position is None:
+            self._read_position = (number, 0)
+        return True
+
+    def _close_segment(self):
+        if self._map is not None:
+            self._map.close()
+            self._map = None
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+        self._active = None
+
+    def read(self, max_rows):
+        """Reads up to max_rows rows from the replay position, without
+        consuming them. Pass the returned position to commit() once the rows
+        are stored
+
+        Returns:
+            tuple: (rows, position after the rows)
+        """
+        with self._lock:
+            if self._read_position is None:
+                return [], None
+            segment, offset = self._read_position
+            segments = list(self._segments)
+            active, write_offset = self._active, self._write_offset
+
+        rows = []
+        while segment in segments and len(rows) < max_rows:
+            limit = write_offset if segment == active else None
+            records, offset, finished = self._read_segment(segment, offset, limit, max_rows - len(rows))
+            rows.extend(records)
+            if not finished:
+                break
+
+            # Continue with the next segment
+            later = [number for number in segments if number > segment]
+            segment, offset = (later[0] if later else segment + 1), 0
+
+        return rows, (segment, offset)
+
+    def _read_segment(self, number, offset, limit, max_rows):
+        """Records of a segment from offset, up to limit for the active one.
+
+        Returns:
+            tuple: (rows, offset after them, whether the segment is finished)
+        """
+        rows = []
+        with open(self._path(number), 'rb') as f:
+            f.seek(offset)
+            size = READ_CHUNK if limit is None else min(READ_CHUNK, limit - offset)
+            data = f.read(size)
+        at_end = len(data) < READ_CHUNK
+
+        position = 0
+        while len(rows) < max_rows:
+            if position + RECORD_HEADER.size > len(data):
+                return rows, offset + position, at_end and limit is None
+
+            length, crc = RECORD_HEADER.unpack_from(data, position)
+            if length == 0:
+                # Unused part of a preallocated segment
+                return rows, offset + position, limit is None
+
+            payload = data[position + RECORD_HEADER.size:position + RECORD_HEADER.size + length]
+            if len(payload) < length and not at_end:
+                # Record continues in the next chunk
+                break
+            if len(payload) < length or zlib.crc32(payload) != crc:
+                logging.error("Spool segment %d is cut off at %d" % (number, offset + position))
+                return rows, offset + position, limit is None
+
+            rows.append(tuple(json.loads(payload)))
+            position += RECORD_HEADER.size + length
+
+        return rows, offset + position, False
+
+    def commit(self, position):
+        """Marks the rows before position as replayed"""
+        with self._lock:
+            self._read_position = position
+            self._delete_before(position[0])
+            self._write_cursor()
+
+    def _write_cursor(self):
+        path = os.path.join(self.directory, CURSOR_FILE)
+        with open(path + '.tmp', 'w') as f:
+            f.write("%d %d" % self._read_position)
+        os.replace(path + '.tmp', path)
+
+    def _delete_before(self, segment):
+        for number in [number for number in self._segments if number < segment]:
+            if number == self._active:
+                continue
+            self._segments.remove(number)
+            del self._sizes[number]
+            try:
+                os.remove(self._path(number))
+            except FileNotFoundError:
+                pass
+
+    def close(self):
+        """Closes the segment being written, deleting it if it was fully
+        replayed, and unlocks the directory"""
+        with self._lock:
+            if self._file is not None and not self.use_mmap:
+                self._file.flush()
+
+            replayed = self._active is not None and self._read_position == (self._active, self._write_offset)
+            self._close_segment()
+            if replayed:
+                # Otherwise the next run cannot tell the segment has no rows left
+                self._read_position = (self._next_segment, 0)
+                self._delete_before(self._next_segment)
+                self._write_cursor()
+
+            if self._lock_file is not None:
+                self._lock_file.close()
+                self._lock_file = None
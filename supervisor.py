@@ -0,0 +1,332 @@
+"""
+Runs the ingestion service on SUPERVISOR_WORKERS processes.
+
+Every batch of a device has to be collected by a single worker, so
+messages are spread by MAC ID, never round robin:
+
+    route   The supervisor subscribes to SUB_TOPIC and hands every message
+            to a worker picked from a consistent hash ring of MAC IDs.
+            Works with any broker.
+    share   Every worker subscribes to $share/SHARE_GROUP/SUB_TOPIC. Only
+            correct if the broker keeps each publisher on one subscriber
+            (e.g. EMQX with shared_subscription_strategy = hash_clientid),
+            since every device is its own MQTT client.
+
+Workers that die are restarted. In route mode their devices are moved to
+the other workers until the restarted worker is back on the ring; partial
+batches of the moved devices time out and are discarded.
+
+Usage: python supervisor.py
+"""
+
+# Basic libraries
+import bisect
+import hashlib
+import logging
+import multiprocessing
+import os
+import queue
+import signal
+import threading
+import time
+from collections import namedtuple
+
+# MQTT Library
+import paho.mqtt.client as mqttClient
+
+# Custom modules
+import calculations, settings
+from log_setup import configure_logging
+
+# Workers are started fresh, nothing (PSQL pool, writer thread) is inherited
+mp = multiprocessing.get_context('spawn')
+
+# The part of a paho message used by main.on_message
+RoutedMessage = namedtuple('RoutedMessage', ['payload'])
+
+
+def _hash(key):
+    return int.from_bytes(hashlib.md5(key.encode("utf-8")).digest()[:8], 'big')
+
+
+class HashRing:
+    """Consistent hash ring mapping MAC IDs to workers.
+
+    Removing a worker only moves the MAC IDs it owned, the other devices
+    keep their worker. Rings are immutable, build a new one when the
+    workers change.
+
+    Args:
+        nodes (list): Worker indexes
+        replicas (int): Points per worker on the ring
+    """
+
+    def __init__(self, nodes, replicas):
+        self.nodes = frozenset(nodes)
+        points = sorted((_hash(f"{node}-{replica}"), node)
+                        for node in self.nodes for replica in range(replicas))
+        self._keys = [point for point, _ in points]
+        self._nodes = [node for _, node in points]
+
+    def __len__(self):
+        return len(self.nodes)
+
+    def get(self, key):
+        """Worker owning a key, None if the ring is empty"""
+        if not self._keys:
+            return None
+        index = bisect.bisect(self._keys, _hash(key)) % len(self._keys)
+        return self._nodes[index]
+
+
+"""
+WORKERS
+"""
+
+
+def _worker_settings(index):
+    # Every worker logs to its own file and serves its metrics on its own port,
+    # set before main is imported
+    root, extension = os.path.splitext(settings.MQTT_LOG_FILE)
+    settings.MQTT_LOG_FILE = f"{root}-worker{index}{extension}"
+    if settings.METRICS_PORT:
+        settings.METRICS_PORT += index
+    if settings.SPOOL_DIR:
+        settings.SPOOL_DIR = f"{settings.SPOOL_DIR}worker{index}/"
+
+
+def route_worker(index, inbox, ready):
+    """Worker of route mode, runs main.on_message on the payloads in its inbox
+    and publishes feedback through its own connection. Sets `ready` once it
+    passed main.wait_until_ready, the supervisor only routes to it after that
+    """
+    # Ctrl+C reaches the whole process group, the supervisor stops workers
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    _worker_settings(index)
+    import main
+
+    main.start_services()
+    if not main.wait_until_ready(settings.READY_TIMEOUT, settings.READY_RETRY_INTERVAL):
+        main.stop_services()
+        raise SystemExit(1)
+    client = main.create_client()
+    client.connect(settings.BROKER_ADDRESS, port=settings.MQTT_PORT)
+    # Readings come through the inbox, only profiling commands from the broker
+    client.subscribe(settings.CONTROL_TOPIC)
+    client.loop_start()
+    ready.set()
+    logging.info("Worker %d ready" % index)
+
+    try:
+        while True:
+            payload = inbox.get()
+            if payload is None:
+                break
+            main.on_message(client, None, RoutedMessage(payload))
+    finally:
+        main.stop_services()
+        client.loop_stop()
+        client.disconnect()
+
+
+def share_worker(index, topic, ready):
+    """Worker of share mode, a main.py joining the shared subscription once ready"""
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    _worker_settings(index)
+    import main
+
+    main.start_services()
+    if not main.wait_until_ready(settings.READY_TIMEOUT, settings.READY_RETRY_INTERVAL):
+        main.stop_services()
+        raise SystemExit(1)
+    client = main.create_client()
+    client.connect(settings.BROKER_ADDRESS, port=settings.MQTT_PORT)
+    client.subscribe(topic)
+    client.subscribe(settings.CONTROL_TOPIC)
+    # Sent by Supervisor.stop(), leaves loop_forever
+    signal.signal(signal.SIGTERM, lambda signum, frame: client.disconnect())
+    ready.set()
+    logging.info("Worker %d subscribed to %s" % (index, topic))
+
+    try:
+        client.loop_forever()
+    finally:
+        main.stop_services()
+
+
+"""
+SUPERVISOR
+"""
+
+
+class Supervisor:
+    """Starts `workers` worker processes, restarts the ones that die and,
+    in route mode, routes incoming messages to them.
+
+    A worker that dies within `restart_delay` * 10 seconds of its start is
+    restarted after twice its previous delay, up to `max_restart_delay`.
+    Workers are only put on the ring once they report being ready, and
+    SUB_TOPIC is subscribed once the first one is.
+
+    Args:
+        workers (int): Number of worker processes
+        mode (str): 'route' or 'share', see the module docstring
+        share_group (str): Shared subscription group used in share mode
+        replicas (int): Points per worker on the hash ring
+        restart_delay (float): Seconds before a dead worker is restarted
+        max_restart_delay (float): Upper bound of the restart delay
+    """
+
+    def __init__(self, workers, mode='route', share_group=None, replicas=64,
+                 restart_delay=1, max_restart_delay=60):
+        if mode not in ('route', 'share'):
+            raise ValueError("Unknown supervisor mode %r" % mode)
+
+        self.workers = workers
+        self.mode = mode
+        self.share_topic = f"$share/{share_group}/{settings.SUB_TOPIC}"
+        self.replicas = replicas
+        self.restart_delay = restart_delay
+        self.max_restart_delay = max_restart_delay
+
+        self._processes = {}
+        self._inboxes = {}
+        self._ready = {}
+        self._started_at = {}
+        self._delays = {index: restart_delay for index in range(workers)}
+        self._restart_at = {}
+        self._ring = HashRing([], replicas)
+        self._stopped = threading.Event()
+        self._client = None
+        self._subscribed = False
+
+    def start(self):
+        for index in range(self.workers):
+            self._start_worker(index)
+
+        if self.mode == 'route':
+            # Subscribed by _rebalance once a worker is ready
+            self._client = mqttClient.Client()
+            self._client.username_pw_set(settings.MQTT_USER, password=settings.MQTT_PASSWORD)
+            self._client.on_message = self.route
+            self._client.connect(settings.BROKER_ADDRESS, port=settings.MQTT_PORT)
+            self._client.loop_start()
+        self._rebalance()
+
+        logging.info("Supervisor started %d workers in %s mode" % (self.workers, self.mode))
+
+    def run(self):
+        """Watches the workers until stop() is called"""
+        while not self._stopped.wait(1):
+            self._check_workers()
+
+    def stop(self):
+        self._stopped.set()
+        if self._client is not None:
+            self._client.loop_stop()
+            self._client.disconnect()
+
+        for index, process in self._processes.items():
+            if self.mode == 'route':
+                self._inboxes[index].put(None)
+            else:
+                process.terminate()
+        for process in self._processes.values():
+            process.join(settings.SUPERVISOR_STOP_TIMEOUT)
+            if process.is_alive():
+                logging.error("Killing %s, it did not stop in time" % process.name)
+                process.kill()
+
+    def route(self, client, userdata, message):
+        """paho on_message of route mode"""
+        try:
+            mac_id = calculations.message_mac_id(message.payload)
+        except Exception as e:
+            logging.error("Failed to route message %r - %s" % (message.payload, e))
+            return
+
+        index = self._ring.get(mac_id)
+        if index is None:
+            logging.error("No worker alive, dropped message of %s" % mac_id)
+            return
+        try:
+            self._inboxes[index].put(message.payload, timeout=settings.DISPATCH_SUBMIT_TIMEOUT)
+        except queue.Full:
+            logging.error("Worker %d is full, dropped message of %s" % (index, mac_id))
+
+    def _start_worker(self, index):
+        ready = self._ready[index] = mp.Event()
+        if self.mode == 'route':
+            # A fresh inbox, the old one may be locked by the dead worker
+            inbox = self._inboxes[index] = mp.Queue(settings.DISPATCH_QUEUE_SIZE)
+            target, args = route_worker, (index, inbox, ready)
+        else:
+            target, args = share_worker, (index, self.share_topic, ready)
+
+        # Not daemonic, workers start the processes of INFERENCE_PROCESSES.
+        # stop() ends them
+        process = mp.Process(target=target, args=args, name=f"ingest-worker-{index}")
+        process.start()
+        self._processes[index] = process
+        self._started_at[index] = time.monotonic()
+
+    def _rebalance(self):
+        alive = [index for index, process in self._processes.items()
+                 if process.is_alive() and self._ready[index].is_set()]
+        if set(alive) != self._ring.nodes:
+            self._ring = HashRing(alive, self.replicas)
+            logging.info("Routing to workers %s" % sorted(alive))
+
+        if self._client is not None and alive and not self._subscribed:
+            self._client.subscribe(settings.SUB_TOPIC)
+            self._subscribed = True
+            logging.info("Supervisor subscribed to %s" % settings.SUB_TOPIC)
+
+    def _check_workers(self):
+        now = time.monotonic()
+        for index, process in self._processes.items():
+            if process.is_alive() or index in self._restart_at:
+                continue
+
+            # Restart quickly after a long run, back off while it keeps dying
+            if now - self._started_at[index] < 10 * self.restart_delay:
+                self._delays[index] = min(2 * self._delays[index], self.max_restart_delay)
+            else:
+                self._delays[index] = self.restart_delay
+            self._restart_at[index] = now + self._delays[index]
+            logging.error("%s exited with code %s, restarting in %ss"
+                          % (process.name, process.exitcode, self._delays[index]))
+
+        for index, restart_at in list(self._restart_at.items()):
+            if restart_at <= now and not self._stopped.is_set():
+                del self._restart_at[index]
+                self._start_worker(index)
+
+        self._rebalance()
+
+
+if __name__ == "__main__":
+    # Not at import, spawned workers import this module too
+    configure_logging(settings.MQTT_LOG_FILE,
+                      settings.LOG_LEVEL,
+                      settings.LOG_MAX_BYTES,
+                      settings.LOG_BACKUP_COUNT,
+                      settings.LOG_QUEUE_SIZE,
+                      settings.LOG_SAMPLE_RATES)
+
+    supervisor = Supervisor(settings.SUPERVISOR_WORKERS,
+                            settings.SUPERVISOR_MODE,
+                            settings.SHARE_GROUP,
+                            settings.HASH_RING_REPLICAS,
+                            settings.SUPERVISOR_RESTART_DELAY,
+                            settings.SUPERVISOR_MAX_RESTART_DELAY)
+    # Stop the same way on SIGTERM (systemctl stop) as on Ctrl+C
+    signal.signal(signal.SIGTERM, signal.default_int_handler)
+
+    try:
+        supervisor.start()
+        supervisor.run()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        supervisor.stop()
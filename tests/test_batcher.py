@@ -0,0 +1,56 @@
+import numpy as np
+import pytest
+from sklearn.linear_model import LinearRegression
+from sklearn.tree import DecisionTreeClassifier
+
+from batcher import InferenceBatcher, predict_values
+
+
+@pytest.fixture
+def models():
+    rng = np.random.RandomState(0)
+    values = rng.rand(40, 6)
+    brix = values.sum(axis=1) * 3
+    brix_model = LinearRegression().fit(values, brix)
+    clf_model = DecisionTreeClassifier(random_state=0).fit(np.column_stack([values, brix]), brix > 9)
+    return values, brix_model, clf_model
+
+
+def test_rejected_reading_does_not_fail_the_others(models):
+    values, brix_model, clf_model = models
+    batch = values[:5].copy()
+    batch[2, 0] = np.inf
+
+    predictions = predict_values(batch, brix_model, clf_model)
+    alone = [predict_values(batch[i:i + 1], brix_model, clf_model)[0] for i in (0, 1, 3, 4)]
+
+    assert predictions[2].brix == -1
+    assert predictions[2].status == -100
+    assert [predictions[i] for i in (0, 1, 3, 4)] == alone
+    assert all(prediction.status >= 0 for prediction in alone)
+
+
+def test_nan_reading_gets_default_brix(models):
+    values, brix_model, clf_model = models
+    batch = values[:3].copy()
+    batch[1, 3] = np.nan
+
+    predictions = predict_values(batch, brix_model, clf_model)
+
+    assert predictions[1].brix == -1
+    assert predictions[0].brix == pytest.approx(brix_model.predict(values[:1])[0])
+    assert predictions[2].brix == pytest.approx(brix_model.predict(values[2:3])[0])
+
+
+def test_batcher_predicts_readings_alone_when_the_group_fails(models):
+    values, brix_model, clf_model = models
+    batcher = InferenceBatcher(0.05, 10)
+    batcher.start()
+    try:
+        good = batcher.submit('key', values[0], brix_model, clf_model)
+        # Cannot be stacked with the other readings
+        bad = batcher.submit('key', values[1, :4], brix_model, clf_model)
+        assert good.result(5).brix == pytest.approx(brix_model.predict(values[:1])[0])
+        assert bad.result(5).brix == -1
+    finally:
+        batcher.stop()
@@ -0,0 +1,53 @@
+import numpy as np
+import pytest
+
+from calculations import (BINARY_MAGIC, message_mac_id, pack_binary_reading, parse_binary_reading,
+                          parse_reading)
+
+
+def test_parse_reading():
+    mac_id, values = parse_reading(b'1, 2, 3, 4, 5, 6, 82.5, WC0001, AC:67:B2:3C:00:1C')
+
+    assert mac_id == 'AC:67:B2:3C:00:1C'
+    assert values.tolist() == [1.0, 2.0, 3.0, 4.0, 5.0, 6.0, 82.5]
+
+
+@pytest.mark.parametrize('payload', [
+    b'1, 2, x, 4, 5, 6, 82.5, WC0001, AC:67:B2:3C:00:1C',
+    b'1, 2, 3, 4, 5, 6, 82.5,, WC0001, AC:67:B2:3C:00:1C',
+    b'AC:67:B2:3C:00:1C',
+])
+def test_invalid_reading_raises(payload):
+    with pytest.raises(ValueError):
+        parse_reading(payload)
+
+
+def test_binary_reading_round_trip():
+    values = [1.5, 2.25, 3.0, 4.0, 5.0, 6.0, 82.5]
+    payload = pack_binary_reading('AC:67:B2:3C:00:1C', values)
+
+    assert payload.startswith(BINARY_MAGIC)
+    mac_id, parsed = parse_binary_reading(payload)
+    assert mac_id == 'AC:67:B2:3C:00:1C'
+    assert parsed.dtype == float
+    assert parsed.tolist() == values
+
+
+def test_binary_and_text_readings_give_the_same_values():
+    text = parse_reading(b'1, 2, 3, 4, 5, 6, 82.5, WC0001, AC:67:B2:3C:00:1C')
+    binary = parse_binary_reading(pack_binary_reading('AC:67:B2:3C:00:1C', text[1]))
+
+    assert binary[0] == text[0]
+    assert np.allclose(binary[1], text[1])
+
+
+def test_truncated_binary_reading_raises():
+    payload = pack_binary_reading('AC:67:B2:3C:00:1C', [1.0, 2.0])
+    with pytest.raises(ValueError):
+        parse_binary_reading(payload[:-1])
+
+
+def test_message_mac_id():
+    assert message_mac_id(b'1, 2, 3, WC0001, AC:67:B2:3C:00:1C') == 'AC:67:B2:3C:00:1C'
+    assert message_mac_id(b'MR, AC:67:B2:3C:00:1C') == 'AC:67:B2:3C:00:1C'
+    assert message_mac_id(pack_binary_reading('AC:67:B2:3C:00:1C', [1.0])) == 'AC:67:B2:3C:00:1C'
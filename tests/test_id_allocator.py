@@ -0,0 +1,60 @@
+import itertools
+import threading
+
+from psql_func import RESERVE_IDS_QUERY, IdAllocator
+
+
+class SequenceCursor:
+    """Answers RESERVE_IDS_QUERY like a PSQL sequence shared by all cursors"""
+
+    def __init__(self, sequence):
+        self.sequence = sequence
+        self.calls = []
+
+    def execute(self, query, params):
+        assert query == RESERVE_IDS_QUERY
+        self.calls.append(params)
+        self._rows = [(next(self.sequence),) for _ in range(params[1])]
+
+    def fetchall(self):
+        return self._rows
+
+
+def test_ids_come_from_reserved_blocks():
+    cursor = SequenceCursor(itertools.count(1))
+    allocator = IdAllocator('warehouse_data_id_seq', 10)
+
+    assert allocator.take(4, cursor) == [1, 2, 3, 4]
+    assert allocator.take(6, cursor) == [5, 6, 7, 8, 9, 10]
+    assert cursor.calls == [('warehouse_data_id_seq', 10)]
+
+    assert allocator.take(1, cursor) == [11]
+    assert len(cursor.calls) == 2
+
+
+def test_large_request_reserves_what_is_missing():
+    cursor = SequenceCursor(itertools.count(1))
+    allocator = IdAllocator('warehouse_data_id_seq', 10)
+
+    allocator.take(7, cursor)
+    assert allocator.take(25, cursor) == list(range(8, 33))
+    assert cursor.calls[-1] == ('warehouse_data_id_seq', 22)
+
+
+def test_threads_never_get_the_same_id():
+    sequence = itertools.count(1)
+    allocator = IdAllocator('warehouse_data_id_seq', 7)
+    taken = []
+
+    def take():
+        cursor = SequenceCursor(sequence)
+        for _ in range(200):
+            taken.extend(allocator.take(3, cursor))
+
+    threads = [threading.Thread(target=take) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert len(taken) == len(set(taken)) == 4 * 200 * 3
@@ -0,0 +1,117 @@
+import pickle
+
+import numpy as np
+import pytest
+from sklearn.linear_model import LinearRegression, LogisticRegression, SGDClassifier
+from sklearn.pipeline import make_pipeline
+from sklearn.preprocessing import MinMaxScaler, StandardScaler
+from sklearn.tree import DecisionTreeClassifier
+
+from linear_models import (ARTIFACT_WEIGHTS, LinearKernel, compile_model, export_linear,
+                           load_artifact, matches, save_artifact)
+
+
+@pytest.fixture
+def data():
+    rng = np.random.RandomState(0)
+    values = rng.uniform(0, 2, (60, 6))
+    target = values.dot(np.arange(1, 7)) + rng.normal(0, 0.1, 60)
+    return values, target
+
+
+def test_scalers_are_folded_into_the_coefficients(data):
+    values, target = data
+    model = make_pipeline(StandardScaler(), MinMaxScaler(), LinearRegression()).fit(values, target)
+
+    kernel = compile_model(model)
+
+    assert isinstance(kernel, LinearKernel)
+    assert np.allclose(kernel.predict(values), model.predict(values))
+
+
+def test_binary_classifier_probabilities_match(data):
+    values, target = data
+    model = make_pipeline(StandardScaler(), LogisticRegression()).fit(values, target > np.median(target))
+
+    kernel = compile_model(model)
+
+    assert isinstance(kernel, LinearKernel)
+    assert np.array_equal(kernel.predict(values), model.predict(values))
+    assert np.allclose(kernel.predict_proba(values), model.predict_proba(values))
+
+
+@pytest.mark.parametrize('model, multi_class', [
+    (LogisticRegression(max_iter=1000), 'softmax'),
+    (SGDClassifier(loss='log_loss', random_state=0), 'ovr'),
+])
+def test_multiclass_picks_the_matching_probabilities(data, model, multi_class):
+    values, target = data
+    model.fit(values, np.digitize(target, np.percentile(target, [33, 66])))
+
+    kernel = compile_model(model)
+
+    assert isinstance(kernel, LinearKernel)
+    assert kernel.multi_class == multi_class
+    assert np.allclose(kernel.predict_proba(values), model.predict_proba(values))
+
+
+def test_mismatching_kernel_is_rejected(data):
+    values, target = data
+    model = LinearRegression().fit(values, target)
+    kernel = export_linear(model)[0]
+    assert matches(kernel, model)
+
+    kernel.intercept = kernel.intercept + 1
+    assert not matches(kernel, model)
+
+
+def test_other_models_are_kept(data):
+    values, target = data
+    model = DecisionTreeClassifier().fit(values, target > np.median(target))
+
+    assert export_linear(model) == []
+    assert compile_model(model) is model
+
+
+def save(tmp_path, model):
+    source = str(tmp_path / 'model.sav')
+    with open(source, 'wb') as f:
+        pickle.dump(model, f)
+    root = str(tmp_path / 'model')
+    save_artifact(compile_model(model), root, type(model).__name__, source)
+    return root, source
+
+
+def test_artifact_round_trip(tmp_path, data):
+    values, target = data
+    model = LogisticRegression().fit(values, target > np.median(target))
+    root, source = save(tmp_path, model)
+
+    kernel = load_artifact(root, source)
+
+    # Views of the read-only memory map, not copies
+    assert not kernel.coef.flags.owndata and not kernel.coef.flags.writeable
+    assert np.array_equal(kernel.predict(values), model.predict(values))
+    assert np.allclose(kernel.predict_proba(values), model.predict_proba(values))
+
+
+def test_artifact_of_another_pickle_is_rejected(tmp_path, data):
+    values, target = data
+    root, source = save(tmp_path, LinearRegression().fit(values, target))
+
+    with open(source, 'wb') as f:
+        pickle.dump(LinearRegression().fit(values, -target), f)
+
+    with pytest.raises(ValueError):
+        load_artifact(root, source)
+
+
+def test_incomplete_weights_are_rejected(tmp_path, data):
+    values, target = data
+    root, source = save(tmp_path, LinearRegression().fit(values, target))
+
+    with open(root + ARTIFACT_WEIGHTS, 'r+b') as f:
+        f.truncate(8)
+
+    with pytest.raises(ValueError):
+        load_artifact(root, source)
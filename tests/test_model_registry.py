@@ -0,0 +1,42 @@
+import os
+import pickle
+
+import pytest
+from sklearn.linear_model import LinearRegression
+
+from model_registry import BRIX, CLF, ModelRegistry
+
+
+def save_model(path, offset):
+    model = LinearRegression().fit([[0.0], [1.0]], [offset, offset + 1])
+    with open(path, 'wb') as f:
+        pickle.dump(model, f)
+
+
+def registry(tmp_path, recheck_interval):
+    model_dir = str(tmp_path) + os.sep
+    save_model(model_dir + 'default_brix.sav', 0)
+    save_model(model_dir + 'default_clf.sav', 0)
+    return model_dir, ModelRegistry(model_dir,
+                                    {BRIX: model_dir + 'default_brix.sav', CLF: model_dir + 'default_clf.sav'},
+                                    10 ** 9, recheck_interval=recheck_interval)
+
+
+def test_model_added_after_startup_is_used(tmp_path):
+    model_dir, models = registry(tmp_path, 0)
+    assert models.uses_default('APPLE', 'FUJI')
+    assert models.get(BRIX, 'APPLE', 'FUJI').predict([[0.0]])[0] == pytest.approx(0)
+
+    save_model(model_dir + 'BRIX_APPLE_FUJI.sav', 10)
+
+    assert models.get(BRIX, 'APPLE', 'FUJI').predict([[0.0]])[0] == pytest.approx(10)
+    assert models.path(BRIX, 'APPLE', 'FUJI') == os.path.realpath(model_dir + 'BRIX_APPLE_FUJI.sav')
+
+
+def test_default_is_kept_until_the_recheck_interval(tmp_path):
+    model_dir, models = registry(tmp_path, 3600)
+    default = models.path(BRIX, 'APPLE', 'FUJI')
+
+    save_model(model_dir + 'BRIX_APPLE_FUJI.sav', 10)
+
+    assert models.path(BRIX, 'APPLE', 'FUJI') == default
@@ -0,0 +1,78 @@
+import threading
+
+import psql_func
+from psql_func import STATUS_COLUMN, PendingRows
+
+
+def row(device_info, status=0, device_id='D1'):
+    return ('W1', device_id, 'APPLE', 'FUJI', 'B1', 10.0, status, 'date', 'time', device_info)
+
+
+def test_flip_applies_to_the_pending_row():
+    pending = PendingRows()
+    pending.add(row('info1'), 'mac1')
+
+    assert pending.flip('W1', 'D1', 1) == 1
+    inserted = pending.begin([row('info1')])
+    assert inserted[0][STATUS_COLUMN] == 1
+
+    pending.end(inserted, True)
+    assert pending.flip('W1', 'D1', 0) is None
+
+
+def test_flip_without_pending_row():
+    pending = PendingRows()
+    pending.add(row('info1', device_id='D2'), 'mac2')
+
+    assert pending.flip('W1', 'D1', 0) is None
+    assert pending.mac_id('W1', 'D2') == 'mac2'
+    assert pending.mac_id('W1', 'D1') is None
+
+
+def test_flip_applies_to_the_newest_row_only():
+    pending = PendingRows()
+    pending.add(row('info1'), 'mac1')
+    pending.add(row('info2'), 'mac1')
+
+    assert pending.flip('W1', 'D1', 1) == 1
+    inserted = pending.begin([row('info1'), row('info2')])
+    assert [r[STATUS_COLUMN] for r in inserted] == [0, 1]
+
+
+def test_status_other_than_zero_is_kept():
+    pending = PendingRows()
+    pending.add(row('info1', status=-1), 'mac1')
+
+    assert pending.flip('W1', 'D1', 1) == -1
+
+
+def test_failed_insert_keeps_the_flip_for_the_retry():
+    pending = PendingRows()
+    pending.add(row('info1'), 'mac1')
+    pending.flip('W1', 'D1', 1)
+
+    pending.end(pending.begin([row('info1')]), False)
+
+    assert pending.begin([row('info1')])[0][STATUS_COLUMN] == 1
+
+
+def test_flip_waits_for_the_row_being_inserted():
+    pending = PendingRows()
+    pending.add(row('info1'), 'mac1')
+    inserted = pending.begin([row('info1')])
+
+    timer = threading.Timer(0.05, pending.end, (inserted, True))
+    timer.start()
+    # Committed meanwhile, so it is flipped in PSQL instead
+    assert pending.flip('W1', 'D1', 5) is None
+    timer.join()
+
+
+def test_flip_status_uses_the_pending_row(monkeypatch):
+    pending = PendingRows()
+    pending.add(row('info1'), 'mac1')
+    monkeypatch.setattr(psql_func, 'pending_rows', pending)
+    # Fails the test if PSQL is used
+    monkeypatch.setattr(psql_func, 'pool', None)
+
+    assert psql_func.flip_status('W1', 'D1') == 1
@@ -0,0 +1,40 @@
+from publisher import Publisher
+
+
+class RecordingClient:
+
+    def __init__(self):
+        self.sent = []
+
+    def publish(self, topic, payload):
+        self.sent.append((topic, payload))
+
+
+def test_replaced_message_goes_out_after_later_ones():
+    client = RecordingClient()
+    drops = []
+    publisher = Publisher(10, 0.01, drops.append)
+
+    publisher.publish(client, '/mac', 'feedback 1')
+    publisher.publish(client, '/mac', 'boot', 'boot')
+    publisher.publish(client, '/mac', 'feedback 2')
+    publisher.start()
+    publisher.stop()
+
+    assert client.sent == [('/mac', 'boot'), ('/mac', 'feedback 2')]
+    assert drops == ['stale']
+
+
+def test_full_queue_drops_new_messages():
+    client = RecordingClient()
+    drops = []
+    publisher = Publisher(2, 0.01, drops.append)
+
+    assert publisher.publish(client, '/a', 'a')
+    assert publisher.publish(client, '/b', 'b')
+    assert not publisher.publish(client, '/c', 'c')
+    publisher.start()
+    publisher.stop()
+
+    assert client.sent == [('/a', 'a'), ('/b', 'b')]
+    assert drops == ['full']
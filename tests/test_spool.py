@@ -0,0 +1,107 @@
+import os
+
+import pytest
+
+from spool import CURSOR_FILE, LOCK_FILE, Spool
+
+
+def rows(name, count):
+    return [(name, i, i / 2) for i in range(count)]
+
+
+def drain(spool, batch):
+    read = []
+    while not spool.empty():
+        records, position = spool.read(batch)
+        read.extend(records)
+        spool.commit(position)
+    return read
+
+
+@pytest.fixture(params=[False, True], ids=['file', 'mmap'])
+def use_mmap(request):
+    return request.param
+
+
+def test_reads_rows_in_order_across_segments(tmp_path, use_mmap):
+    spool = Spool(str(tmp_path), 200, 100000, use_mmap)
+    assert spool.empty()
+
+    assert spool.append(rows('a', 25)) == 25
+    assert len(os.listdir(tmp_path)) > 2
+
+    assert drain(spool, 4) == rows('a', 25)
+    assert spool.empty()
+
+
+def test_read_without_commit_is_read_again(tmp_path, use_mmap):
+    spool = Spool(str(tmp_path), 200, 100000, use_mmap)
+    spool.append(rows('a', 5))
+
+    first, _ = spool.read(3)
+    again, position = spool.read(3)
+    assert first == again == rows('a', 3)
+
+    spool.commit(position)
+    assert drain(spool, 10) == rows('a', 5)[3:]
+
+
+def test_reopen_continues_after_the_cursor(tmp_path, use_mmap):
+    spool = Spool(str(tmp_path), 200, 100000, use_mmap)
+    spool.append(rows('a', 10))
+    records, position = spool.read(4)
+    spool.commit(position)
+    spool.close()
+
+    # Uncommitted rows of the previous run come first
+    spool = Spool(str(tmp_path), 200, 100000, use_mmap)
+    assert not spool.empty()
+    spool.append(rows('b', 3))
+    assert drain(spool, 3) == rows('a', 10)[4:] + rows('b', 3)
+    spool.close()
+
+    spool = Spool(str(tmp_path), 200, 100000, use_mmap)
+    assert spool.empty()
+    spool.append(rows('c', 2))
+    assert drain(spool, 10) == rows('c', 2)
+
+
+def test_replayed_segments_are_deleted(tmp_path, use_mmap):
+    spool = Spool(str(tmp_path), 200, 100000, use_mmap)
+    spool.append(rows('a', 25))
+    drain(spool, 100)
+
+    segments = [name for name in os.listdir(tmp_path) if name not in (CURSOR_FILE, LOCK_FILE)]
+    assert len(segments) == 1
+
+
+def test_rows_beyond_max_bytes_are_dropped(tmp_path, use_mmap):
+    spool = Spool(str(tmp_path), 200, 600, use_mmap)
+    appended = spool.append(rows('a', 100))
+
+    assert 0 < appended < 100
+    assert spool.pending_bytes() <= 600
+    assert drain(spool, 100) == rows('a', appended)
+
+
+def test_cut_off_record_ends_the_segment(tmp_path):
+    spool = Spool(str(tmp_path), 10000, 100000)
+    spool.append(rows('a', 3))
+    spool.close()
+
+    # A crash in the middle of the last record
+    segment = os.path.join(tmp_path, sorted(os.listdir(tmp_path))[0])
+    with open(segment, 'r+b') as f:
+        f.truncate(os.path.getsize(segment) - 3)
+
+    spool = Spool(str(tmp_path), 10000, 100000)
+    assert drain(spool, 10) == rows('a', 2)
+
+
+def test_directory_is_used_by_one_spool_at_a_time(tmp_path):
+    spool = Spool(str(tmp_path), 200, 100000)
+    with pytest.raises(OSError):
+        Spool(str(tmp_path), 200, 100000)
+
+    spool.close()
+    Spool(str(tmp_path), 200, 100000).close()
@@ -0,0 +1,89 @@
+from contextlib import contextmanager
+
+import psycopg2
+import pytest
+
+import psql_func
+from psql_func import BufferedWriter
+
+
+def rows(count):
+    return [('W1', 'D%d' % i, 'APPLE', 'FUJI', 'B1', 10.0, 0, 'date', 'time', 'info%d' % i)
+            for i in range(count)]
+
+
+class FakeCursor:
+
+    def __init__(self, result):
+        self.result = result
+
+    def execute(self, query, params=()):
+        pass
+
+    def fetchone(self):
+        return self.result
+
+
+class FakePool:
+
+    def __init__(self, result):
+        self.result = result
+
+    @contextmanager
+    def cursor(self):
+        yield FakeCursor(self.result)
+
+
+def writer_storing(stored, fails):
+    """Writer whose inserts store into `stored`, rejecting any batch with a row for which fails(row)"""
+    writer = BufferedWriter(10, 1, 100, 1)
+
+    def insert(batch):
+        for row in batch:
+            fails(row)
+        stored.extend(batch)
+    writer._insert = insert
+    return writer
+
+
+def test_data_error_drops_only_the_rejected_rows():
+    stored = []
+
+    def fails(row):
+        if row[1] in ('D3', 'D12'):
+            raise psycopg2.DataError("bad row")
+
+    batch = rows(20)
+    dropped, unsaved, error = writer_storing(stored, fails)._insert_valid(batch)
+
+    assert dropped == 2
+    assert unsaved == [] and error is None
+    assert stored == [row for row in batch if row[1] not in ('D3', 'D12')]
+
+
+def test_unavailable_psql_returns_the_rows_not_inserted():
+    stored = []
+
+    def fails(row):
+        if row[1] == 'D2':
+            raise psycopg2.DataError("bad row")
+        if row[1] == 'D5':
+            raise psycopg2.OperationalError("connection lost")
+
+    batch = rows(8)
+    dropped, unsaved, error = writer_storing(stored, fails)._insert_valid(batch)
+
+    assert dropped == 1
+    assert isinstance(error, psycopg2.OperationalError)
+    # Stored and dropped rows come first, so the rest can be retried in order
+    assert stored == batch[:2] + batch[3:4]
+    assert unsaved == batch[4:]
+
+
+def test_check_schema_raises_for_missing_migrations(monkeypatch):
+    monkeypatch.setattr(psql_func, 'pool', FakePool(('warehouse_data_id_seq', None)))
+    with pytest.raises(RuntimeError, match='device_last_reading'):
+        psql_func.check_schema()
+
+    monkeypatch.setattr(psql_func, 'pool', FakePool(('warehouse_data_id_seq', 'device_last_reading')))
+    psql_func.check_schema()
@@ -9,17 +9,10 @@ import paho.mqtt.client as mqttClient
 # Custom modules
 import psql_func
 import settings
+from log_setup import configure_logging
 
 filterwarnings('ignore')
 
-# Logging
-logging.basicConfig(
-    filename=settings.STATUS_UPDATE_LOG_FILE,
-    filemode="a",
-    format="%(asctime)s - %(levelname)s %(message)s",
-    level=logging.INFO,
-)
-
 # Topic
 SUB_TOPIC = settings.UPDATE_SUB_TOPIC
 
@@ -52,16 +45,26 @@ def on_disconnect(client, userdata, rc):
         logging.error("Still running on the status")
 
 
-def on_message(client, userdata, message):
+def flip(message):
+    """Updates the status for a flip request
+
+    Returns:
+        tuple: (topic, flipped status) of the feedback to the device
+    """
     msg = str(message.payload.decode("utf-8"))
 
     warehouse_id = msg.split(",")[0].strip()
     device_id = msg.split(",")[1].strip()
 
-    # Updates the new status value and sends feedback to device
     flipped_status = psql_func.flip_status(warehouse_id, device_id)
     logging.info('Flipping status for %s/%s ' % (warehouse_id, device_id))
-    client.publish(f"/{warehouse_id}/{device_id}", flipped_status)
+    return f"/{warehouse_id}/{device_id}", flipped_status
+
+
+def on_message(client, userdata, message):
+    # Updates the new status value and sends feedback to device
+    topic, flipped_status = flip(message)
+    client.publish(topic, flipped_status)
 
 
 def create_client():
@@ -73,17 +76,27 @@ def create_client():
     # Create client instance
     mqtt_client = mqttClient.Client()
     mqtt_client.username_pw_set(USER, password=PASSWORD)
+    mqtt_client.max_inflight_messages_set(settings.MQTT_MAX_INFLIGHT)
+    mqtt_client.max_queued_messages_set(settings.MQTT_MAX_QUEUED)
 
     # Callbacks
     mqtt_client.on_connect = on_connect
     mqtt_client.on_message = on_message
     mqtt_client.on_disconnect = on_disconnect
 
-    return client
+    return mqtt_client
 
 
 if __name__ == "__main__":
 
+    # Logging, configured here since service.py imports this module
+    configure_logging(settings.STATUS_UPDATE_LOG_FILE,
+                      settings.LOG_LEVEL,
+                      settings.LOG_MAX_BYTES,
+                      settings.LOG_BACKUP_COUNT,
+                      settings.LOG_QUEUE_SIZE,
+                      settings.LOG_SAMPLE_RATES)
+
     # Create client
     client = create_client()
 